@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from telegram import Update
+
+from catalog import Catalog
+from outbox import Outbox
+
+# Offline load test for karma_bot.py: seeds a throwaway data directory with
+# N users and a large word filter list, then feeds synthetic Updates straight
+# into the handlers with a fake bot standing in for the Telegram API.
+#
+#   python bench/handlers.py --users 1000,100000,1000000 --updates 5000
+#   python bench/handlers.py --users 100000 --backend sqlite --rate 500 --concurrency 64
+#
+# Each user count runs in its own process so the reported peak RSS belongs
+# to that store size alone.
+
+SCENARIOS = ("rewards", "give", "buy", "leaderboard", "karma", "message")
+
+FILTERED_CHAT = -1001
+PLAIN_CHAT = -1002
+
+
+class FakeBot:
+    # Records every Bot API call instead of sending it
+    defaults = None
+
+    def __init__(self):
+        self.calls = Counter()
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        self.calls["get_chat_member"] += 1
+        return SimpleNamespace(status="member", user=SimpleNamespace(id=user_id, is_bot=False))
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            self.calls[name] += 1
+            return True
+        return call
+
+
+def seed(data_dir, users, filters, purchase_ratio, products):
+    from storage import atomic_write_json
+    rng = random.Random(1)
+    pids = list(products)
+    karma = {"users": {}, "purchases": {}}
+    for uid in range(1, users + 1):
+        karma["users"][str(uid)] = {"karma": rng.randint(0, 60000), "username": f"user{uid}"}
+        if rng.random() < purchase_ratio:
+            owned = rng.sample(pids, rng.randint(1, 3))
+            karma["purchases"][str(uid)] = {pid: "2024-01-01T00:00:00" for pid in owned}
+    atomic_write_json(os.path.join(data_dir, "karma.json"), karma)
+    words = [f"badword{i}" for i in range(filters)]
+    atomic_write_json(os.path.join(data_dir, "filters.json"), {"groups": {str(FILTERED_CHAT): words}})
+    return words
+
+
+class UpdateFactory:
+    def __init__(self, bot, users, words, hit_rate, products):
+        self.bot = bot
+        self.users = users
+        self.words = words
+        self.hit_rate = hit_rate
+        self.products = list(products)
+        self.rng = random.Random(2)
+        self.next_id = 0
+        self.vocab = [f"word{i}" for i in range(2000)]
+
+    def _user(self):
+        return self.rng.randint(1, self.users)
+
+    def make(self, text, user_id, chat_id=PLAIN_CHAT):
+        self.next_id += 1
+        data = {
+            "update_id": self.next_id,
+            "message": {
+                "message_id": self.next_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        update = Update.de_json(data, self.bot)
+        context = SimpleNamespace(args=text.split()[1:] if text.startswith("/") else [], bot=self.bot)
+        return update, context
+
+    def scenario(self, name):
+        if name == "rewards":
+            return self.make("/rewards", self._user())
+        if name == "give":
+            return self.make(f"/give @user{self._user()} 1", self._user())
+        if name == "buy":
+            return self.make(f"/buy {self.rng.choice(self.products)}", self._user())
+        if name == "leaderboard":
+            return self.make("/leaderboard", self._user())
+        if name == "karma":
+            text = f"/karma @user{self._user()}" if self.rng.random() < 0.5 else "/karma"
+            return self.make(text, self._user())
+        if name == "message":
+            text = " ".join(self.rng.choice(self.vocab) for _ in range(12))
+            if self.words and self.rng.random() < self.hit_rate:
+                text += " " + self.rng.choice(self.words)
+            # Half the traffic comes from a chat without filters
+            chat_id = FILTERED_CHAT if self.rng.random() < 0.5 else PLAIN_CHAT
+            return self.make(text, self._user(), chat_id)
+        raise ValueError(f"Unknown scenario: {name}")
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def drive(handler, factory, name, count, rate, concurrency):
+    # Builds all updates up front so only handler time is measured
+    jobs = [factory.scenario(name) for _ in range(count)]
+    latencies = []
+    errors = 0
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(update, context):
+        nonlocal errors
+        async with gate:
+            start = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, (update, context) in enumerate(jobs):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(update, context)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "scenario": name,
+        "updates": count,
+        "errors": errors,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run(args):
+    data_dir = tempfile.mkdtemp(prefix="aegis-bench-")
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ.pop("SQLITE_PATH", None)
+    os.environ.pop("SHARED_STORAGE", None)
+    os.environ["KARMA_LEDGER"] = "1" if args.ledger else "0"
+    try:
+        import karma_bot
+        os.environ["BOT_OWNER_ID"] = "0"
+        karma_bot.DATA_DIR = data_dir
+        # Replies still go through the outbox, just without Telegram's pacing
+        karma_bot.outbox = Outbox(global_rate=1e9, chat_rate=1e9, group_rate=1e9, chat_burst=1e9)
+        karma_bot.moderation.outbox = karma_bot.outbox
+
+        catalog = Catalog()
+        catalog.load()
+        products = catalog.products
+        started = time.perf_counter()
+        words = seed(data_dir, args.users, args.filters, args.purchase_ratio, products)
+        seed_time = time.perf_counter() - started
+
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        karma_bot.init_storage()
+        load_time = time.perf_counter() - started
+
+        bot = FakeBot()
+        factory = UpdateFactory(bot, args.users, words, args.hit_rate, products)
+        handlers = {
+            "rewards": karma_bot.rewards,
+            "give": karma_bot.give,
+            "buy": karma_bot.buy,
+            "leaderboard": karma_bot.leaderboard,
+            "karma": karma_bot.check_karma,
+            "message": karma_bot.handle_message,
+        }
+        results = []
+        for name in args.scenarios:
+            result = await drive(handlers[name], factory, name, args.updates, args.rate, args.concurrency)
+            result["peak_rss_mb"] = peak_rss_mb()
+            if args.trace_memory:
+                result["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.reset_peak()
+            results.append(result)
+
+        karma_bot.moderation.flush_all()
+        await karma_bot.outbox.stop()
+
+        # Everything the scenarios touched is written back in one flush
+        started = time.perf_counter()
+        karma_bot.karma_store.flush(snapshot=True)
+        karma_bot.cooldowns.flush()
+        flush_time = time.perf_counter() - started
+        karma_bot.storage.close()
+
+        return {
+            "users": args.users,
+            "backend": args.backend,
+            "ledger": args.ledger,
+            "filters": args.filters,
+            "seed_s": seed_time,
+            "load_s": load_time,
+            "flush_s": flush_time,
+            "bot_calls": dict(bot.calls),
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def report(summary):
+    ledger = " + ledger" if summary["ledger"] else ""
+    print(f"\n👥 {summary['users']:,} users, {summary['backend']} backend{ledger}, {summary['filters']:,} filtered words")
+    print(f"   seed {summary['seed_s']:.2f}s  load {summary['load_s']:.3f}s  flush {summary['flush_s']:.3f}s")
+    print(f"   {'scenario':<12} {'updates':>8} {'errors':>6} {'upd/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+    for r in summary["results"]:
+        line = (f"   {r['scenario']:<12} {r['updates']:>8,} {r['errors']:>6} {r['throughput']:>10,.0f} "
+                f"{r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['peak_rss_mb']:>12.1f}")
+        if "peak_heap_mb" in r:
+            line += f"  heap {r['peak_heap_mb']:.1f} MB"
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline handler benchmark for karma_bot.py")
+    parser.add_argument("--users", default="1000,100000,1000000",
+                        help="comma separated store sizes, each run in its own process")
+    parser.add_argument("--updates", type=int, default=5000, help="updates per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--ledger", action="store_true", help="append karma changes to the ledger")
+    parser.add_argument("--filters", type=int, default=5000, help="words filtered in the busy chat")
+    parser.add_argument("--hit-rate", type=float, default=0.05, help="share of messages with a filtered word")
+    parser.add_argument("--purchase-ratio", type=float, default=0.1, help="share of users owning statuses")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64, help="updates handled at once")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+    return args
+
+
+def main():
+    args = parse_args()
+    sizes = [int(n) for n in args.users.split(",")]
+    if len(sizes) > 1:
+        # One process per size, so peak memory isn't carried over
+        argv = sys.argv[1:]
+        i = argv.index("--users") if "--users" in argv else None
+        if i is not None:
+            del argv[i:i + 2]
+        argv = [a for a in argv if not a.startswith("--users=")]
+        for size in sizes:
+            code = subprocess.call([sys.executable, os.path.abspath(__file__), "--users", str(size)] + argv)
+            if code:
+                sys.exit(code)
+        return
+    args.users = sizes[0]
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        report(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# Memory per user of the resident karma data, compared like for like:
+#
+#   dicts       the karma.json dicts as json.load returns them
+#   records     the compact records (records.py) holding the same data
+#   dict-store  dicts plus the username index and leaderboard the bot
+#               builds on top (what KarmaStore held before records.py)
+#   store       the whole KarmaStore: records + username index + leaderboard
+#
+#   python bench/memory.py --users 100000,1000000
+#
+# Each layout is loaded in its own process. "heap" is what tracemalloc sees
+# still allocated after loading, "peak RSS" includes the interpreter and
+# everything freed during the load.
+
+LAYOUTS = ("dicts", "records", "dict-store", "store")
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def child(layout, data_dir, users):
+    from storage import JsonBackend
+    backend = JsonBackend(data_dir)
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    if layout == "dicts":
+        data = backend.load_karma()
+    elif layout == "records":
+        from records import PidIndex, decode_hook, from_json
+        pids = PidIndex()
+        data = from_json(backend.load_karma(object_hook=decode_hook(pids)), pids)
+    elif layout == "dict-store":
+        # Same index and leaderboard as KarmaStore.load() builds
+        from karma_store import Leaderboard
+        karma = backend.load_karma()
+        usernames = {sys.intern(user["username"].lower()): uid
+                     for uid, user in karma["users"].items() if user.get("username")}
+        leaderboard = Leaderboard()
+        for uid in karma["purchases"]:
+            leaderboard.set(uid, 0)
+        data = (karma, usernames, leaderboard)
+    else:
+        from karma_store import KarmaStore
+        data = KarmaStore(backend)
+        data.load()
+    load_time = time.perf_counter() - started
+    gc.collect()
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(json.dumps({"layout": layout, "users": users, "heap_bytes": heap, "bytes_per_user": heap / users,
+                      "load_s": load_time, "peak_rss_mb": peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per user of the karma data layouts")
+    parser.add_argument("--users", default="100000,1000000", help="comma separated store sizes")
+    parser.add_argument("--purchase-ratio", type=float, default=0.1, help="share of users owning statuses")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--child", nargs=3, metavar=("LAYOUT", "DATA_DIR", "USERS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], int(args.child[2]))
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from catalog import Catalog
+    from handlers import seed
+    catalog = Catalog()
+    catalog.load()
+    results = []
+    for users in (int(n) for n in args.users.split(",")):
+        data_dir = tempfile.mkdtemp(prefix="aegis-memory-")
+        try:
+            seed(data_dir, users, 0, args.purchase_ratio, catalog.products)
+            for layout in LAYOUTS:
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", layout, data_dir, str(users)],
+                                     capture_output=True, text=True, check=True).stdout
+                results.append(json.loads(out))
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"\n   {'users':>10} {'layout':<10} {'bytes/user':>10} {'heap MB':>9} {'load s':>7} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"   {r['users']:>10,} {r['layout']:<10} {r['bytes_per_user']:>10.0f} "
+              f"{r['heap_bytes'] / (1024 * 1024):>9.1f} {r['load_s']:>7.2f} {r['peak_rss_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
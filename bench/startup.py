@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# Startup benchmark for karma_bot.py: measures the time from process start
+# to the first handled update. Each run is a fresh process that starts the
+# real bot (build_app() + start_bot()) against a fake Bot API answering
+# after --latency seconds. That API hands out a single /rewards update, and
+# the process shuts down once it has been handled.
+#
+#   python bench/startup.py --users 100000 --runs 5
+#   python bench/startup.py --users 100000 --backend sqlite --latency 0.1
+#
+# Reported phases come from karma_bot.startup_times; "data" and "connect"
+# run concurrently, so they overlap rather than add up.
+
+PHASES = ("imports", "data", "connect", "commands", "ready", "first_update")
+
+
+def fake_request_class():
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # Answers Bot API calls locally after `latency` seconds
+        def __init__(self, latency=0.0, updates=None):
+            self.latency = latency
+            self.updates = list(updates or [])
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            await asyncio.sleep(self.latency)
+            endpoint = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data is not None else {}
+            if endpoint == 'getMe':
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif endpoint == 'getUpdates':
+                result, self.updates = self.updates, []
+                if not result:
+                    await asyncio.sleep(0.05)
+            elif endpoint == 'sendMessage':
+                result = {"message_id": 1, "date": int(time.time()),
+                          "chat": {"id": params.get("chat_id", 1), "type": "private"},
+                          "text": params.get("text", "")}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeRequest
+
+
+async def child(args):
+    import karma_bot
+    karma_bot.DATA_DIR = args.data_dir
+    FakeRequest = fake_request_class()
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench", "username": "user1"},
+            "text": "/rewards",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 8}],
+        },
+    }
+    app = karma_bot.build_app(FakeRequest(args.latency), FakeRequest(args.latency, [update]))
+    task = asyncio.create_task(karma_bot.start_bot(app))
+    while "first_update" not in karma_bot.startup_times:
+        if task.done():
+            raise SystemExit("bot stopped before handling an update")
+        await asyncio.sleep(0.001)
+    handled_at = time.time()
+    os.kill(os.getpid(), signal.SIGTERM)
+    await task
+    print(json.dumps({"handled_at": handled_at, "phases": karma_bot.startup_times}))
+
+
+def run_once(args, data_dir):
+    env = dict(os.environ, BOT_TOKEN="123456:bench", BOT_OWNER_ID="0", METRICS_PORT="0",
+               STORAGE_BACKEND=args.backend, KARMA_LEDGER="1" if args.ledger else "0")
+    env.pop("SQLITE_PATH", None)
+    env.pop("SHARED_STORAGE", None)
+    argv = [sys.executable, os.path.abspath(__file__), "--child", "--data-dir", data_dir,
+            "--latency", str(args.latency)]
+    spawned = time.time()
+    out = subprocess.run(argv, env=env, capture_output=True, text=True, check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result["process_to_first_update"] = result["handled_at"] - spawned
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmark for karma_bot.py")
+    parser.add_argument("--users", type=int, default=100000, help="users in the seeded karma data")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--ledger", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Bot API round trip in seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(args))
+        return
+
+    from catalog import Catalog
+    from handlers import seed
+    data_dir = tempfile.mkdtemp(prefix="aegis-startup-")
+    try:
+        catalog = Catalog()
+        catalog.load()
+        seed(data_dir, args.users, 100, 0.1, catalog.products)
+        # The first run also migrates to SQLite / writes commands.json;
+        # later runs are plain restarts
+        run_once(args, data_dir)
+        runs = [run_once(args, data_dir) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    summary = {name: statistics.median(r["phases"].get(name, 0.0) for r in runs) for name in PHASES}
+    summary["process_to_first_update"] = statistics.median(r["process_to_first_update"] for r in runs)
+    if args.json:
+        print(json.dumps({"users": args.users, "backend": args.backend, "latency": args.latency, **summary}))
+        return
+    print(f"\n🚀 {args.users:,} users, {args.backend} backend, {args.latency * 1000:.0f}ms API latency, "
+          f"median of {args.runs} restarts")
+    for name in PHASES:
+        print(f"   {name:<14} {summary[name] * 1000:>9.1f} ms")
+    print(f"   {'process start → first update':<14} {summary['process_to_first_update'] * 1000:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
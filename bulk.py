@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+
+# Bulk karma changes for events: an owner uploads (user, delta) rows and
+# they are applied to the karma store in one batch.
+#
+#   CSV   user,delta per line, with an optional header line
+#         @alice,50
+#         123456789,-10
+#   JSON  [{"user": "@alice", "delta": 50}, ["123456789", -10]]
+#
+# `user` is a Telegram user id or a username. Rows are reported by line
+# (CSV) or position (JSON), both counted from 1.
+
+
+class BulkFormatError(ValueError):
+    pass
+
+
+def _delta(value):
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        return int(value)
+    raise ValueError
+
+
+def _parse_json(text):
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise BulkFormatError(f"invalid JSON: {e}")
+    if not isinstance(data, list):
+        raise BulkFormatError("JSON input must be a list of rows")
+    for number, item in enumerate(data, 1):
+        if isinstance(item, dict):
+            yield number, item.get("user", item.get("username", item.get("user_id"))), item.get("delta")
+        elif isinstance(item, list) and len(item) == 2:
+            yield number, item[0], item[1]
+        else:
+            yield number, None, None
+
+
+def _parse_csv(text):
+    for number, cells in enumerate(csv.reader(io.StringIO(text)), 1):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        if number == 1 and len(cells) == 2 and cells[1].lower() in ("delta", "karma", "amount"):
+            continue
+        yield number, cells[0] if cells else None, cells[1] if len(cells) == 2 else None
+
+
+def parse_rows(text):
+    # -> (rows, failed): rows as [(row number, user, delta)], failed as
+    # [(row number, reason)] for rows that don't parse
+    text = text.strip()
+    entries = _parse_json(text) if text[:1] in ('[', '{') else _parse_csv(text)
+    rows, failed = [], []
+    for number, user, delta in entries:
+        if user is None or delta is None or str(user).strip() in ('', '@'):
+            failed.append((number, "expected user and delta"))
+            continue
+        try:
+            rows.append((number, str(user).strip(), _delta(delta)))
+        except (TypeError, ValueError):
+            failed.append((number, f"bad delta {delta!r}"))
+    return rows, failed
+
+
+def apply_rows(store, text, allow_negative=False):
+    # Parses text and applies it to a KarmaStore. Returns a report:
+    # {"rows": n, "applied": [(row number, user id, balance)],
+    #  "failed": [(row number, reason)], "credited": k, "debited": k}
+    rows, failed = parse_rows(text)
+    applied, rejected = store.adjust_many([(user, delta) for _, user, delta in rows], allow_negative)
+    numbers = [number for number, _, _ in rows]
+    deltas = [delta for _, _, delta in rows]
+    failed += [(numbers[i], reason) for i, reason in rejected]
+    failed.sort()
+    return {
+        "rows": len(rows) + len(failed) - len(rejected),
+        "applied": [(numbers[i], user_id, balance) for i, user_id, balance in applied],
+        "failed": failed,
+        "credited": sum(deltas[i] for i, _, _ in applied if deltas[i] > 0),
+        "debited": -sum(deltas[i] for i, _, _ in applied if deltas[i] < 0),
+    }
@@ -0,0 +1,163 @@
+import bisect
+import json
+import os
+import time
+
+# The status catalog lives in catalog.json next to the bot:
+#
+#   {"version": 2,
+#    "tiers": [{"name": "🔥 *LEGENDARY TIER*", "min_rank": 17, "max_rank": 20}, ...],
+#    "products": {"P001": {"name": "🌠 Supreme Overlord", "price": 50000, "rank": 20}, ...}}
+#
+# Products keep the file's order. Editing the file is picked up while the
+# bot runs; an invalid edit is reported and the previous catalog is kept.
+
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def _build(data):
+    # Validates a parsed catalog file and returns its indexes
+    if not isinstance(data, dict) or not isinstance(data.get("products"), dict):
+        raise CatalogError("catalog needs a \"products\" object")
+    tiers = []
+    for tier in data.get("tiers", []):
+        try:
+            tiers.append((str(tier["name"]), int(tier["min_rank"]), int(tier["max_rank"])))
+        except (KeyError, TypeError, ValueError):
+            raise CatalogError(f"bad tier: {tier!r}")
+
+    products = {}
+    by_tier = {name: [] for name, _, _ in tiers}
+    by_rank = {}
+    by_price = []
+    for pid, product in data["products"].items():
+        pid = pid.upper()
+        try:
+            entry = {"name": str(product["name"]), "price": int(product["price"]), "rank": int(product["rank"])}
+        except (KeyError, TypeError, ValueError):
+            raise CatalogError(f"bad product {pid}: {product!r}")
+        if entry["price"] < 0:
+            raise CatalogError(f"negative price for {pid}")
+        entry["tier"] = next((name for name, low, high in tiers if low <= entry["rank"] <= high), None)
+        products[pid] = entry
+        if entry["tier"] is not None:
+            by_tier[entry["tier"]].append(pid)
+        by_rank.setdefault(entry["rank"], []).append(pid)
+        by_price.append((entry["price"], pid))
+    by_price.sort()
+    return {
+        "version": data.get("version"),
+        "tiers": [name for name, _, _ in tiers],
+        "products": products,
+        "by_tier": by_tier,
+        "by_rank": by_rank,
+        "by_price": by_price,
+        "prices": [price for price, _ in by_price],
+    }
+
+
+class Catalog:
+    # Indexed, hot-reloaded product catalog. Lookups by pid, tier and rank
+    # are dict reads; price queries bisect a sorted list. The file is
+    # re-checked at most every `recheck_interval` seconds and listeners
+    # registered with on_change() run after every successful reload.
+
+    def __init__(self, path=CATALOG_FILE, recheck_interval=5.0):
+        self.path = path
+        self.recheck_interval = recheck_interval
+        self.version = None
+        self.tiers = []
+        self.products = {}
+        self._by_tier = {}
+        self._by_rank = {}
+        self._by_price = []
+        self._prices = []
+        self._stamp = None
+        self._checked_at = 0.0
+        self._listeners = []
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def load(self):
+        stamp = self._file_stamp()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                indexes = _build(json.load(f))
+        except json.JSONDecodeError as e:
+            raise CatalogError(f"{self.path} is not valid JSON: {e}")
+        self.version = indexes["version"]
+        self.tiers = indexes["tiers"]
+        self.products = indexes["products"]
+        self._by_tier = indexes["by_tier"]
+        self._by_rank = indexes["by_rank"]
+        self._by_price = indexes["by_price"]
+        self._prices = indexes["prices"]
+        self._stamp = stamp
+        self._checked_at = time.monotonic()
+        for listener in self._listeners:
+            listener()
+
+    def on_change(self, listener):
+        self._listeners.append(listener)
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.recheck_interval:
+            return False
+        self._checked_at = now
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        try:
+            self.load()
+        except (OSError, CatalogError) as e:
+            # Keep serving the old catalog until the file is fixed
+            self._stamp = stamp
+            print(f"⚠️ Ignoring catalog change: {e}")
+            return False
+        print(f"✅ Reloaded catalog v{self.version} ({len(self.products)} products)")
+        return True
+
+    # Lookups
+    def get(self, pid):
+        self.maybe_reload()
+        return self.products.get(pid.upper())
+
+    def __contains__(self, pid):
+        return self.get(pid) is not None
+
+    def __len__(self):
+        return len(self.products)
+
+    def rank(self, pid):
+        product = self.products.get(pid)
+        return product["rank"] if product else 0
+
+    def name(self, pid):
+        # Statuses dropped from the catalog still show up by pid
+        self.maybe_reload()
+        product = self.products.get(pid)
+        return product["name"] if product else pid
+
+    def in_tier(self, tier):
+        self.maybe_reload()
+        return [(pid, self.products[pid]) for pid in self._by_tier.get(tier, ())]
+
+    def with_rank(self, rank):
+        self.maybe_reload()
+        return [(pid, self.products[pid]) for pid in self._by_rank.get(rank, ())]
+
+    def affordable(self, karma):
+        # Products priced at or below karma, cheapest first
+        self.maybe_reload()
+        end = bisect.bisect_right(self._prices, karma)
+        return [(pid, self.products[pid]) for _, pid in self._by_price[:end]]
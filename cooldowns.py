@@ -0,0 +1,236 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from storage import CorruptDataError
+
+# Named cooldowns ("rewards" per user, "ship" per chat, ...) kept in memory
+# as integer epoch deadlines. Deadlines are also filed into a timing wheel
+# of `granularity`-second slots so expired entries are purged in bulk
+# without scanning everything.
+
+DAY = 24 * 60 * 60
+
+
+def _parse_time(value):
+    # ISO time as written by either bot -> epoch seconds, None if unreadable.
+    # The Node bot writes a trailing 'Z', which fromisoformat only accepts
+    # from Python 3.11.
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        return int(datetime.fromisoformat(value).timestamp())
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _node_time(epoch):
+    # Same format as the Node bot's new Date().toISOString()
+    moment = datetime.fromtimestamp(epoch, timezone.utc)
+    return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class CooldownManager:
+    # With shared=True the cooldowns live in the (transactional) backend
+    # only, so several processes see the same deadlines; checks and sets
+    # become single-row statements and flush just purges expired rows.
+    #
+    # `legacy` is a JsonBackend over the Node bot's data directory. The Node
+    # bot keeps its /rewards cooldowns in cooldowns.json, so when given,
+    # rewards claims made there are picked up (the file is re-read when it
+    # changes) and ours are written back to it on flush.
+
+    def __init__(self, backend, flush_interval=5.0, granularity=60, shared=False, legacy=None):
+        if shared and not backend.transactional:
+            raise ValueError("Shared cooldowns need a transactional backend")
+        self.backend = backend
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.granularity = granularity
+        self._deadlines = {}
+        self._slots = {}
+        self._cursor = int(time.time()) // granularity
+        self._dirty = set()
+        self._expired = set()
+        self._task = None
+        self.legacy = legacy
+        self._legacy_seen = None
+        self._legacy_claims = {}
+        # Unreadable entries already warned about
+        self._legacy_bad = set()
+
+    def load(self):
+        if self.shared:
+            if self.backend.load_timers() is None:
+                self.backend.save_timers(self._from_legacy())
+            return
+        timers = self.backend.load_timers()
+        legacy = timers is None
+        if legacy:
+            timers = self._from_legacy()
+        self._deadlines.clear()
+        self._slots.clear()
+        now = int(time.time())
+        self._cursor = now // self.granularity
+        for key, deadline in timers.items():
+            if deadline > now:
+                self._file(key, deadline)
+        # Converted or already expired entries are written back on the next flush
+        self._dirty = set(self._deadlines) if legacy else set()
+        self._expired = {key for key in timers if key not in self._deadlines}
+        self._legacy_seen = None
+        self._sync_legacy()
+
+    def _from_legacy(self):
+        # Older data stored the time of the last claim / ship as ISO strings
+        timers = {}
+        for name, times in (("rewards", self.backend.load_cooldowns()),
+                            ("ship", self.backend.load_shipping()["last_ship"])):
+            for key, at in times.items():
+                epoch = _parse_time(at)
+                if epoch is None:
+                    print(f"⚠️ Skipping unreadable {name} cooldown for {key}: {at!r}")
+                    continue
+                timers[f"{name}:{key}"] = epoch + DAY
+        return timers
+
+    def _sync_legacy(self):
+        # Takes in rewards claims the Node bot wrote since we last looked
+        if self.legacy is None:
+            return
+        stamp = self.legacy.cooldowns_stamp()
+        if stamp == self._legacy_seen:
+            return
+        try:
+            claims = self.legacy.load_cooldowns()
+        except CorruptDataError as e:
+            # Most likely caught mid-write by the Node bot; retried next time
+            print(f"⚠️ Can't read the Node bot's cooldowns yet: {e}")
+            return
+        self._legacy_seen = stamp
+        now = int(time.time())
+        for user_id, claimed in claims.items():
+            epoch = _parse_time(claimed)
+            if epoch is None:
+                if (user_id, repr(claimed)) not in self._legacy_bad:
+                    self._legacy_bad.add((user_id, repr(claimed)))
+                    print(f"⚠️ Skipping unreadable rewards cooldown for {user_id}: {claimed!r}")
+                continue
+            key = f"rewards:{user_id}"
+            deadline = epoch + DAY
+            if deadline > now and deadline > self._deadlines.get(key, 0):
+                self._file(key, deadline)
+                self._dirty.add(key)
+                self._expired.discard(key)
+
+    def _file(self, key, deadline):
+        old = self._deadlines.get(key)
+        if old is not None:
+            slot = self._slots.get(old // self.granularity)
+            if slot is not None:
+                slot.discard(key)
+        self._deadlines[key] = deadline
+        # Deadlines already behind the wheel go in the next slot to be swept
+        slot = max(deadline // self.granularity, self._cursor)
+        self._slots.setdefault(slot, set()).add(key)
+
+    # Checks and updates - all O(1)
+    def remaining(self, name, key, now=None):
+        # Seconds left on the cooldown, 0 if it isn't running
+        now = int(time.time()) if now is None else now
+        if self.shared:
+            deadline = self.backend.get_timer(f"{name}:{key}")
+        else:
+            if name == "rewards":
+                self._sync_legacy()
+            deadline = self._deadlines.get(f"{name}:{key}")
+        return deadline - now if deadline is not None and deadline > now else 0
+
+    def start(self, name, key, duration, now=None):
+        now = int(time.time()) if now is None else now
+        full_key = f"{name}:{key}"
+        if self.shared:
+            self.backend.save_timers({full_key: now + int(duration)})
+            return
+        self._file(full_key, now + int(duration))
+        self._dirty.add(full_key)
+        self._expired.discard(full_key)
+        if name == "rewards" and self.legacy is not None:
+            self._legacy_claims[key] = _node_time(now)
+
+    def try_start(self, name, key, duration, now=None):
+        # Starts the cooldown unless it's already running. Returns 0 on
+        # success, otherwise the seconds left.
+        now = int(time.time()) if now is None else now
+        if self.shared:
+            return self.backend.try_start_timer(f"{name}:{key}", now + int(duration), now)
+        left = self.remaining(name, key, now)
+        if not left:
+            self.start(name, key, duration, now)
+        return left
+
+    def expire(self, now=None):
+        # Drops every cooldown whose slot has fully passed; returns how many
+        now = int(time.time()) if now is None else now
+        current = now // self.granularity
+        removed = 0
+        while self._cursor < current:
+            for key in self._slots.pop(self._cursor, ()):
+                deadline = self._deadlines.get(key)
+                if deadline is not None and deadline <= now:
+                    del self._deadlines[key]
+                    self._dirty.discard(key)
+                    self._expired.add(key)
+                    removed += 1
+            self._cursor += 1
+        return removed
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    # Persistence
+    def flush(self):
+        if self.shared:
+            self.backend.purge_timers(int(time.time()))
+            return
+        self.expire()
+        if self._dirty or self._expired:
+            self.backend.save_timers(self._deadlines, set(self._dirty), set(self._expired))
+            self._dirty.clear()
+            self._expired.clear()
+        if self._legacy_claims:
+            self._flush_legacy()
+
+    def _flush_legacy(self):
+        # Picks up the Node bot's latest claims first so they aren't lost
+        self._sync_legacy()
+        claims, self._legacy_claims = self._legacy_claims, {}
+        try:
+            self.legacy.save_cooldowns(claims)
+        except (CorruptDataError, OSError) as e:
+            print(f"⚠️ Not updating the Node bot's cooldowns yet: {e}")
+            self._legacy_claims = claims
+            return
+        self._legacy_seen = self.legacy.cooldowns_stamp()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Error flushing cooldowns: {e}")
+
+    def start_flusher(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
@@ -143,6 +143,8 @@ async function shutdown(signal) {
 // Register shutdown handlers
 process.once('SIGINT', () => shutdown('SIGINT'));
 process.once('SIGTERM', () => shutdown('SIGTERM'));
+// Sent by run_bots.py on Windows, where there is no SIGTERM
+process.once('SIGBREAK', () => shutdown('SIGBREAK'));
 
 // Start the bot
 startBot();
@@ -1,53 +1,118 @@
+import time
+
+# Process start, for the startup timing breakdown
+BOOT_STARTED = time.perf_counter()
+
 import os
-import json
 import asyncio  # Add this import
-from datetime import datetime, timedelta
+import gc
+import hashlib
+import json
+import signal
+from datetime import datetime
 import random
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, ChatMemberHandler, CommandHandler, ContextTypes, MessageHandler, TypeHandler, filters
 from telegram import Update, ChatMember
+from telegram.constants import ChatType
+from telegram.error import TelegramError
 from dotenv import load_dotenv
 import re
 from random import choice
-import aiohttp
-from urllib.parse import quote
+from karma_store import KarmaStore
+from ledger import KarmaLedger
+from shipping import ShipHistory
+from members import MemberCache
+from storage import JsonBackend, atomic_write_json, open_backend
+from word_filters import FilterCache
+from locks import KeyedLock, serialized
+from cooldowns import DAY, CooldownManager
+from metrics import Metrics, MetricsServer, TimedBackend, TimedRequest, instrument
+from templates import TemplateCache
+from catalog import CATALOG_FILE, Catalog
+from outbox import FUN, REPLY, Outbox
+from moderation import ModerationQueue
+from bulk import BulkFormatError, apply_rows
+
+# aiohttp (urban.py, webhook.py, the metrics endpoint) is only imported once
+# one of them is actually used
+
+# Seconds per startup phase, filled in as the bot starts and printed once
+# the first update has been handled
+startup_times = {"imports": time.perf_counter() - BOOT_STARTED}
 
 # Load environment variables
 load_dotenv()
 
-# Initialize data storage
+# Initialize data storage; the directory is created in init_storage()
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-KARMA_FILE = os.path.join(DATA_DIR, 'karma.json')
-COOLDOWN_FILE = os.path.join(DATA_DIR, 'cooldowns.json')
-FILTERS_FILE = os.path.join(DATA_DIR, 'filters.json')
-SHIPPING_FILE = os.path.join(DATA_DIR, 'shipping.json')
-
-# Create data directory if it doesn't exist
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
-
-# Product/Status definitions
-PRODUCTS = {
-    "P001": {"name": "🌠 Supreme Overlord", "price": 50000, "rank": 20},
-    "P002": {"name": "👑 Grand Emperor", "price": 45000, "rank": 19},
-    "P003": {"name": "⚜️ Royal Sovereign", "price": 40000, "rank": 18},
-    "P004": {"name": "🔱 Divine Master", "price": 35000, "rank": 17},
-    "P005": {"name": "💫 Celestial Lord", "price": 30000, "rank": 16},
-    "P006": {"name": "⚡ Thunder God", "price": 25000, "rank": 15},
-    "P007": {"name": "🌟 Astral King", "price": 20000, "rank": 14},
-    "P008": {"name": "🎯 Elite Champion", "price": 15000, "rank": 13},
-    "P009": {"name": "🔮 Mystic Sage", "price": 12000, "rank": 12},
-    "P010": {"name": "🌈 Rainbow Master", "price": 10000, "rank": 11},
-    "P011": {"name": "⚔️ War Chief", "price": 8000, "rank": 10},
-    "P012": {"name": "🛡️ Royal Guard", "price": 6000, "rank": 9},
-    "P013": {"name": "⚡ Alpha Elite", "price": 5000, "rank": 8},
-    "P014": {"name": "🌟 Sigma Prime", "price": 4000, "rank": 7},
-    "P015": {"name": "💫 Beta Supreme", "price": 3000, "rank": 6},
-    "P016": {"name": "✨ Omega Plus", "price": 2000, "rank": 5},
-    "P017": {"name": "🌙 Nova Star", "price": 1500, "rank": 4},
-    "P018": {"name": "💎 Crystal Knight", "price": 1000, "rank": 3},
-    "P019": {"name": "🎭 Shadow Agent", "price": 500, "rank": 2},
-    "P020": {"name": "🌱 Rising Star", "price": 250, "rank": 1}
-}
+
+# Storage backend (STORAGE_BACKEND=json|sqlite), opened in init_storage()
+storage = None
+
+# Karma data lives in memory and is flushed every KARMA_FLUSH_INTERVAL seconds
+karma_store = None
+
+# Word filters held in memory per chat, loaded in init_storage()
+filter_cache = None
+
+# Rewards / shipping cooldowns, held in memory and flushed with the karma data
+cooldowns = None
+
+# Recent /shipping couples per chat, bounded by SHIP_HISTORY_LIMIT and
+# SHIP_RETENTION_DAYS
+ship_history = None
+
+# Chat members and admin rosters, cached for MEMBER_CACHE_TTL / ADMIN_CACHE_TTL
+# seconds and kept current from chat_member updates
+members = MemberCache(
+    member_ttl=float(os.getenv('MEMBER_CACHE_TTL', '300')),
+    admin_ttl=float(os.getenv('ADMIN_CACHE_TTL', '600'))
+)
+
+# Shared HTTP session and Urban Dictionary client, created on the first /urban
+http_session = None
+urban_client = None
+
+# Updates run concurrently; these locks keep handlers that mutate the same
+# user's karma or the same chat's data from interleaving
+update_locks = KeyedLock()
+
+# Handler latency, storage and Bot API timings, served on METRICS_PORT
+metrics = Metrics()
+
+# Product/Status definitions from catalog.json (CATALOG_PATH), loaded in
+# init_storage() and reloaded when the file changes
+catalog = None
+
+# Pre-rendered /store, /help and /dev bodies, filled in init_templates()
+templates = TemplateCache()
+
+# Outbound sends, paced per chat and globally and retried on flood waits;
+# started on first use and drained in start_bot(). The global limit is per
+# bot token, so sharded workers (WORKER_COUNT, set by run_bots.py) split it;
+# a chat always lands on the same worker, so the per-chat limits stay whole
+outbox = Outbox(
+    global_rate=float(os.getenv('OUTBOX_GLOBAL_RATE', '30')) / int(os.getenv('WORKER_COUNT', '1')),
+    chat_rate=float(os.getenv('OUTBOX_CHAT_RATE', '1')),
+    group_rate=float(os.getenv('OUTBOX_GROUP_RATE', str(20 / 60))),
+    max_queue=int(os.getenv('OUTBOX_QUEUE_SIZE', '10000'))
+)
+
+# Filtered-word hits are deleted and warned about in batches per chat every
+# MODERATION_WINDOW seconds; MODERATION_ESCALATE_AT violations within
+# MODERATION_RESET seconds get a louder warning
+moderation = ModerationQueue(
+    outbox,
+    window=float(os.getenv('MODERATION_WINDOW', '1')),
+    escalate_at=int(os.getenv('MODERATION_ESCALATE_AT', '5')),
+    reset_after=float(os.getenv('MODERATION_RESET', '3600'))
+)
+
+# Joins within WELCOME_DELAY seconds get one welcome message
+WELCOME_DELAY = float(os.getenv('WELCOME_DELAY', '2'))
+
+# Hash of the last command list sent with set_my_commands
+COMMANDS_STAMP_FILE = 'commands.json'
 
 WELCOME_MESSAGES = [
     "🎉 Holy moly! {user} just crash-landed into our group! Quick, hide the memes!",
@@ -102,112 +167,145 @@ NHIE_QUESTIONS = [
     "Never have I ever accidentally liked an old post while stalking"
 ]
 
-# Owner check function
-def is_owner(user_id: str) -> bool:
-    owner_id = os.getenv('BOT_OWNER_ID')
-    return str(user_id) == owner_id
+def user_key(update, context):
+    return [f"user:{update.effective_user.id}"]
 
-# Data management functions
-def load_data():
-    try:
-        with open(KARMA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        data = {"users": {}, "purchases": {}}
-        save_data(data)
-        return data
-
-def save_data(data):
-    with open(KARMA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-def load_cooldowns():
-    try:
-        with open(COOLDOWN_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+def chat_key(update, context):
+    return [f"chat:{update.effective_chat.id}"]
 
-def save_cooldowns(cooldowns):
-    with open(COOLDOWN_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cooldowns, f, indent=2, ensure_ascii=False)
+def give_keys(update, context):
+    keys = user_key(update, context)
+    if context.args:
+        target_id = karma_store.find_by_username(context.args[0].replace("@", ""))
+        if target_id:
+            keys.append(f"user:{target_id}")
+    return keys
 
-def load_filters():
-    try:
-        with open(FILTERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"groups": {}}
+# Queues a reply to the update's message; the returned future can be awaited
+# for the sent Message but handlers don't wait on it
+def reply(update, text, priority=REPLY, **kwargs):
+    message = update.message
+    return outbox.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
 
-def save_filters(data):
-    with open(FILTERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+# Owner check function
+def is_owner(user_id: str) -> bool:
+    owner_id = os.getenv('BOT_OWNER_ID')
+    return str(user_id) == owner_id
 
-def load_shipping():
+# Admin check for group commands; the owner and private chats always pass
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if is_owner(update.effective_user.id) or update.effective_chat.type == ChatType.PRIVATE:
+        return True
     try:
-        with open(SHIPPING_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"last_ship": {}, "couples": {}}
+        return await members.is_admin(context.bot, update.effective_chat.id, update.effective_user.id)
+    except TelegramError:
+        return False
 
-def save_shipping(data):
-    with open(SHIPPING_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+# Data management functions
+def init_storage():
+    global storage, karma_store, filter_cache, cooldowns, catalog, ship_history
+    os.makedirs(DATA_DIR, exist_ok=True)
+    catalog = Catalog(os.getenv('CATALOG_PATH', CATALOG_FILE), float(os.getenv('CATALOG_RECHECK_INTERVAL', '5')))
+    catalog.load()
+    storage = TimedBackend(open_backend(DATA_DIR), metrics)
+    # Set by run_bots.py when several worker processes share one database
+    shared = os.getenv('SHARED_STORAGE') == '1'
+    # The Node bot's /rewards cooldowns live in data/cooldowns.json; keep
+    # both bots honouring each other's claims
+    legacy = None if shared else JsonBackend(DATA_DIR)
+    cooldowns = CooldownManager(storage, float(os.getenv('KARMA_FLUSH_INTERVAL', '5')), shared=shared, legacy=legacy)
+    cooldowns.load()
+    filter_cache = FilterCache(storage, float(os.getenv('FILTERS_RECHECK_INTERVAL', '2')))
+    filter_cache.load()
+    ship_history = ShipHistory(
+        storage,
+        limit=int(os.getenv('SHIP_HISTORY_LIMIT', '100')),
+        retention_days=float(os.getenv('SHIP_RETENTION_DAYS', '90'))
+    )
+    # KARMA_LEDGER=1 appends every karma change to data/ledger and only
+    # snapshots the karma data every KARMA_SNAPSHOT_INTERVAL seconds
+    ledger = None
+    if os.getenv('KARMA_LEDGER') == '1' and not shared:
+        ledger = KarmaLedger(
+            os.path.join(DATA_DIR, 'ledger'),
+            segment_bytes=int(os.getenv('LEDGER_SEGMENT_BYTES', str(4 * 1024 * 1024))),
+            retain=int(os.getenv('LEDGER_RETAIN', '16')),
+            # LEDGER_FSYNC=1 syncs each flush to disk so it survives power
+            # loss, not just a crash of the bot
+            fsync=os.getenv('LEDGER_FSYNC') == '1'
+        )
+        ledger.open()
+    karma_store = KarmaStore(
+        storage,
+        float(os.getenv('KARMA_FLUSH_INTERVAL', '5')),
+        rank_of=catalog.rank,
+        shared=shared,
+        ledger=ledger,
+        snapshot_interval=float(os.getenv('KARMA_SNAPSHOT_INTERVAL', '300'))
+    )
+    karma_store.load()
+    # New ranks reorder the leaderboard
+    catalog.on_change(karma_store.rerank)
+
+# Keep the member cache current with joins, leaves and promotions
+async def track_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    members.update(update.chat_member or update.my_chat_member)
+
+# Record when the first update gets handled, for the startup timings
+async def mark_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if "first_update" not in startup_times:
+        startup_times["first_update"] = time.perf_counter() - BOOT_STARTED
+        print_startup_times()
+
+# Keep stored usernames current when known users rename themselves
+async def track_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user and user.username:
+        karma_store.rename(str(user.id), user.username)
 
 # Command handlers
+@serialized(update_locks, user_key)
 async def rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     username = update.effective_user.username or str(user_id)
     
-    data = load_data()
-    cooldowns = load_cooldowns()
-    
     # Owner gets unlimited karma
     if is_owner(user_id):
-        if user_id not in data["users"]:
-            data["users"][user_id] = {"karma": 0, "username": username}
-        data["users"][user_id]["karma"] = 999999  # Set unlimited karma for owner
-        save_data(data)
-        await update.message.reply_text(
+        karma_store.ensure_user(user_id, username)
+        karma_store.set_karma(user_id, 999999)  # Set unlimited karma for owner
+        reply(update,
             "👑 *Owner Karma Refreshed*\n"
             "You now have unlimited karma points!", 
             parse_mode='Markdown'
         )
         return
 
-    # Check cooldown
-    if user_id in cooldowns:
-        last_claim = datetime.fromisoformat(cooldowns[user_id])
-        if datetime.now() < last_claim + timedelta(days=1):
-            time_left = (last_claim + timedelta(days=1) - datetime.now())
-            hours = int(time_left.total_seconds() / 3600)
-            minutes = int((time_left.total_seconds() % 3600) / 60)
-            await update.message.reply_text(
-                f"⏳ You can claim rewards again in {hours}h {minutes}m"
-            )
-            return
+    # Check cooldown and start a new one in the same step
+    time_left = cooldowns.try_start("rewards", user_id, DAY)
+    if time_left:
+        hours = time_left // 3600
+        minutes = time_left % 3600 // 60
+        reply(update,
+            f"⏳ You can claim rewards again in {hours}h {minutes}m"
+        )
+        return
 
     # Generate karma
     karma = random.randint(1, 300)
     
     # Update user data
-    if user_id not in data["users"]:
-        data["users"][user_id] = {"karma": 0, "username": username}
-    
-    data["users"][user_id]["karma"] += karma
-    cooldowns[user_id] = datetime.now().isoformat()
-    
-    save_data(data)
-    save_cooldowns(cooldowns)
+    karma_store.ensure_user(user_id, username)
+    balance = karma_store.add_karma(user_id, karma)
     
-    await update.message.reply_text(
+    reply(update,
         f"🎉 You received {karma} karma points!\n"
-        f"Current balance: {data['users'][user_id]['karma']} points"
+        f"Current balance: {balance} points"
     )
 
+@serialized(update_locks, give_keys)
 async def give(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) != 2:
-        await update.message.reply_text(
+        reply(update,
             "❌ Usage: /give @username amount"
         )
         return
@@ -220,176 +318,146 @@ async def give(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if amount <= 0:
             raise ValueError
     except ValueError:
-        await update.message.reply_text("❌ Please specify a valid amount")
+        reply(update, "❌ Please specify a valid amount")
         return
 
-    data = load_data()
-    
     # Check if sender has enough karma
-    if sender_id not in data["users"]:
-        await update.message.reply_text("❌ You don't have any karma points")
+    if karma_store.get(sender_id) is None:
+        reply(update, "❌ You don't have any karma points")
         return
     
-    if not is_owner(sender_id) and data["users"][sender_id]["karma"] < amount:
-        await update.message.reply_text("❌ Insufficient karma points")
+    if not is_owner(sender_id) and karma_store.karma(sender_id) < amount:
+        reply(update, "❌ Insufficient karma points")
         return
 
     # Find target user by username
-    target_id = None
-    for uid, user_data in data["users"].items():
-        if user_data.get("username") == target_username:
-            target_id = uid
-            break
+    target_id = karma_store.find_by_username(target_username)
 
     if not target_id:
-        await update.message.reply_text("❌ User not found")
+        reply(update, "❌ User not found")
         return
 
     # Process transfer
-    if not is_owner(sender_id):
-        data["users"][sender_id]["karma"] -= amount
-    data["users"][target_id]["karma"] = data["users"][target_id].get("karma", 0) + amount
-
-    save_data(data)
+    balance = karma_store.transfer(sender_id, target_id, amount, debit=not is_owner(sender_id))
+    if balance is None:
+        reply(update, "❌ Insufficient karma points")
+        return
     
-    await update.message.reply_text(
+    reply(update,
         f"✅ Successfully sent {amount} karma to @{target_username}\n" +
-        (f"Your new balance: {data['users'][sender_id]['karma']}" if not is_owner(sender_id) else "")
+        (f"Your new balance: {balance}" if not is_owner(sender_id) else "")
     )
 
-async def store(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    store_text = "*🏪 ═══ Karma Store ═══*\n\n"
-    
+def render_store():
     # Group products by tier
-    tiers = {
-        "🔥 *LEGENDARY TIER*": range(17, 21),
-        "💫 *EPIC TIER*": range(13, 17),
-        "✨ *RARE TIER*": range(9, 13),
-        "🌟 *UNCOMMON TIER*": range(5, 9),
-        "🌱 *STARTER TIER*": range(1, 5)
-    }
-    
-    for tier_name, tier_range in tiers.items():
-        store_text += f"\n{tier_name}\n"
-        store_text += "┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄\n"
-        
-        # Filter products for this tier
-        tier_products = {k: v for k, v in PRODUCTS.items() 
-                        if v["rank"] in tier_range}
-        
-        for pid, product in tier_products.items():
-            store_text += f"• {product['name']}\n"
-            store_text += f"  💰 Price: {product['price']:,} karma\n"
-            store_text += f"  🔑 PID: `{pid}`\n\n"
-    
-    store_text += "\n*How to purchase:*\n"
-    store_text += "Use command: `/buy PID`"
-    
-    await update.message.reply_text(store_text, parse_mode='Markdown')
+    parts = ["*🏪 ═══ Karma Store ═══*\n\n"]
+    for tier_name in catalog.tiers:
+        parts.append(f"\n{tier_name}\n")
+        parts.append("┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄\n")
+        for pid, product in catalog.in_tier(tier_name):
+            parts.append(
+                f"• {product['name']}\n"
+                f"  💰 Price: {product['price']:,} karma\n"
+                f"  🔑 PID: `{pid}`\n\n"
+            )
+    parts.append("\n*How to purchase:*\n")
+    parts.append("Use command: `/buy PID`")
+    return "".join(parts)
+
+async def store(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    catalog.maybe_reload()
+    reply(update, templates.get("store"), parse_mode='Markdown')
 
 # Update the buy function
+@serialized(update_locks, user_key)
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
     if not context.args:
-        await update.message.reply_text("❌ Please specify a Product ID (PID)")
+        reply(update, "❌ Please specify a Product ID (PID)")
         return
 
     pid = context.args[0].upper()
-    if pid not in PRODUCTS:
-        await update.message.reply_text("❌ Invalid Product ID")
+    product = catalog.get(pid)
+    if product is None:
+        reply(update, "❌ Invalid Product ID")
         return
 
-    data = load_data()
-    
-    if user_id not in data["users"]:
-        data["users"][user_id] = {"karma": 0, "username": update.effective_user.username or str(user_id)}
-        save_data(data)
+    karma_store.ensure_user(user_id, update.effective_user.username or str(user_id))
 
-    product = PRODUCTS[pid]
-    user_karma = data["users"][user_id]["karma"]
+    user_karma = karma_store.karma(user_id)
 
     # Skip karma check for owner
     if not is_owner(user_id) and user_karma < product["price"]:
         needed = product["price"] - user_karma
-        await update.message.reply_text(
+        reply(update,
             f"❌ Insufficient karma points\n"
             f"You need {needed:,} more points"
         )
         return
 
     # Check for existing purchase
-    if user_id in data["purchases"] and pid in data["purchases"][user_id]:
-        await update.message.reply_text("❌ You already own this status")
+    if karma_store.has_purchase(user_id, pid):
+        reply(update, "❌ You already own this status")
         return
 
     # Process purchase (don't deduct karma for owner)
-    if not is_owner(user_id):
-        data["users"][user_id]["karma"] -= product["price"]
-    
-    if user_id not in data["purchases"]:
-        data["purchases"][user_id] = {}
-    data["purchases"][user_id][pid] = datetime.now().isoformat()
-    
-    save_data(data)
+    balance = karma_store.purchase(
+        user_id, pid, product["price"], datetime.now().isoformat(), debit=not is_owner(user_id)
+    )
+    if balance is None:
+        reply(update, "❌ Purchase failed, please try again")
+        return
     
-    await update.message.reply_text(
+    reply(update,
         f"✅ Successfully purchased {product['name']}\n" +
-        (f"Remaining karma: {data['users'][user_id]['karma']:,}" if not is_owner(user_id) else "")
+        (f"Remaining karma: {balance:,}" if not is_owner(user_id) else "")
     )
 
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = load_data()
-    
-    # Calculate user scores
-    user_scores = []
-    for user_id, purchases in data.get("purchases", {}).items():
-        total_rank = sum(PRODUCTS[pid]["rank"] for pid in purchases)
-        username = data["users"][user_id]["username"]
-        statuses = [PRODUCTS[pid]["name"] for pid in purchases]
-        user_scores.append((username, total_rank, statuses))
-
-    # Sort by rank
-    user_scores.sort(key=lambda x: x[1], reverse=True)
+    # Top 10 straight from the maintained ranking. In shared mode get()
+    # drops users whose row was deleted by another worker from the ranking,
+    # so look again until all ten are still there
+    while True:
+        top_users = [(user_id, karma_store.get(user_id)) for user_id, _ in karma_store.leaderboard.top(10)]
+        if all(user is not None for _, user in top_users):
+            break
     
-    if not user_scores:
-        await update.message.reply_text("No purchases yet!")
+    if not top_users:
+        reply(update, "No purchases yet!")
         return
 
     # Format leaderboard
     lb_text = "*🏆 Status Leaderboard*\n\n"
-    for i, (username, score, statuses) in enumerate(user_scores[:10], 1):
+    for i, (user_id, user) in enumerate(top_users, 1):
         medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
+        username = user.username or user_id
+        statuses = [catalog.name(pid) for pid in karma_store.owned(user_id)]
         lb_text += f"{medal} @{username}\n"
         lb_text += f"Statuses: {' '.join(statuses)}\n\n"
 
-    await update.message.reply_text(lb_text, parse_mode='Markdown')
+    position = karma_store.leaderboard.position(str(update.effective_user.id))
+    if position:
+        lb_text += f"📍 You are #{position:,} of {len(karma_store.leaderboard):,}"
+
+    reply(update, lb_text, parse_mode='Markdown')
 
 # Add after other command handlers
 async def check_karma(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = load_data()
-    
     # Check if a username is provided
     if context.args:
         target_username = context.args[0].replace("@", "")
         # Find user by username
-        target_id = None
-        for uid, user_data in data["users"].items():
-            if user_data.get("username") == target_username:
-                target_id = uid
-                break
+        target_id = karma_store.find_by_username(target_username)
         
         if not target_id:
-            await update.message.reply_text("❌ User not found")
+            reply(update, "❌ User not found")
             return
             
-        user_data = data["users"][target_id]
-        karma = user_data["karma"]
+        karma = karma_store.karma(target_id)
         
         # Get user's statuses
-        statuses = []
-        if target_id in data.get("purchases", {}):
-            statuses = [PRODUCTS[pid]["name"] for pid in data["purchases"][target_id]]
+        statuses = [catalog.name(pid) for pid in karma_store.owned(target_id)]
         
         # Format response
         response = (
@@ -400,23 +468,19 @@ async def check_karma(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if statuses:
             response += f"🏆 *Owned Statuses:*\n{' '.join(statuses)}"
         
-        await update.message.reply_text(response, parse_mode='Markdown')
+        reply(update, response, parse_mode='Markdown')
         
     else:
         # Show karma for command user
         user_id = str(update.effective_user.id)
         username = update.effective_user.username or str(user_id)
         
-        if user_id not in data["users"]:
-            data["users"][user_id] = {"karma": 0, "username": username}
-            save_data(data)
+        karma_store.ensure_user(user_id, username)
         
-        karma = data["users"][user_id]["karma"]
+        karma = karma_store.karma(user_id)
         
         # Get user's statuses
-        statuses = []
-        if user_id in data.get("purchases", {}):
-            statuses = [PRODUCTS[pid]["name"] for pid in data["purchases"][user_id]]
+        statuses = [catalog.name(pid) for pid in karma_store.owned(user_id)]
         
         # Format response
         response = (
@@ -426,10 +490,17 @@ async def check_karma(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if statuses:
             response += f"🏆 *Your Statuses:*\n{' '.join(statuses)}"
+            position = karma_store.leaderboard.position(user_id)
+            if position:
+                response += f"\n📍 *Leaderboard Position:* #{position:,}"
         else:
-            response += "\n💫 *Tip:* Use `/store` to see available statuses!"
+            affordable = len(catalog.affordable(karma))
+            if affordable:
+                response += f"\n💫 *Tip:* You can afford {affordable} statuses, see `/store`!"
+            else:
+                response += "\n💫 *Tip:* Use `/store` to see available statuses!"
         
-        await update.message.reply_text(response, parse_mode='Markdown')
+        reply(update, response, parse_mode='Markdown')
 
 # Add after the existing imports
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -437,10 +508,9 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Get target user (either replied to or command sender)
         if update.message.reply_to_message:
             user = update.message.reply_to_message.from_user
-            member = await context.bot.get_chat_member(update.effective_chat.id, user.id)
         else:
             user = update.effective_user
-            member = await context.bot.get_chat_member(update.effective_chat.id, user.id)
+        member = await members.get_member(context.bot, update.effective_chat.id, user.id)
 
         # Get chat member status
         status_emoji = {
@@ -453,13 +523,10 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
 
         # Get karma data
-        data = load_data()
-        karma = data["users"].get(str(user.id), {}).get("karma", 0)
+        karma = karma_store.karma(str(user.id))
         
         # Get user's statuses
-        statuses = []
-        if str(user.id) in data.get("purchases", {}):
-            statuses = [PRODUCTS[pid]["name"] for pid in data["purchases"][str(user.id)]]
+        statuses = [catalog.name(pid) for pid in karma_store.owned(str(user.id))]
 
         # Format join date
         joined_date = datetime.fromtimestamp(user.id >> 22).strftime('%B %d, %Y')
@@ -507,89 +574,98 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             info.extend(f"  • {flag}" for flag in flags)
 
         # Send the formatted message
-        await update.message.reply_text(
+        reply(update,
             "\n".join(info),
             parse_mode='Markdown'
         )
 
     except Exception as e:
-        await update.message.reply_text(f"❌ Error fetching user info: {str(e)}")
+        reply(update, f"❌ Error fetching user info: {str(e)}")
 
+@serialized(update_locks, chat_key)
 async def manage_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Only admins can manage filters!")
+        reply(update, "❌ Only admins can manage filters!")
         return
 
     chat_id = str(update.effective_chat.id)
-    filters_data = load_filters()
-
-    if chat_id not in filters_data["groups"]:
-        filters_data["groups"][chat_id] = []
+    words = filter_cache.words(chat_id)
 
     if not context.args:
         # Show current filters
-        if not filters_data["groups"][chat_id]:
-            await update.message.reply_text("No filtered words set.\nUse: /filters add <word>")
+        if not words:
+            reply(update, "No filtered words set.\nUse: /filters add <word>")
             return
         
-        filter_list = "\n".join(f"• {word}" for word in filters_data["groups"][chat_id])
-        await update.message.reply_text(
+        filter_list = "\n".join(f"• {word}" for word in words)
+        reply(update,
             f"*Filtered Words:*\n{filter_list}\n\nCommands:\n"
             "/filters add <word>\n"
-            "/filters remove <word>",
+            "/filters remove <word>\n"
+            "/filters wholeword <on/off>\n"
+            "/filters casefold <on/off>",
             parse_mode='Markdown'
         )
         return
 
     action = context.args[0].lower()
     if len(context.args) < 2:
-        await update.message.reply_text("❌ Please specify a word!")
+        reply(update, "❌ Please specify a word!")
+        return
+
+    # Matching mode toggles
+    if action in ("wholeword", "casefold"):
+        value = context.args[1].lower()
+        if value not in ("on", "off"):
+            reply(update, f"Usage: /filters {action} <on/off>")
+            return
+        settings = filter_cache.settings(chat_id)
+        settings["whole_word" if action == "wholeword" else "casefold"] = value == "on"
+        filter_cache.set_settings(chat_id, settings)
+        reply(update, f"✅ {'Whole-word' if action == 'wholeword' else 'Casefold'} matching turned {value}")
         return
 
     word = context.args[1].lower()
 
     if action == "add":
-        if word in filters_data["groups"][chat_id]:
-            await update.message.reply_text("This word is already filtered!")
+        if word in words:
+            reply(update, "This word is already filtered!")
             return
-        filters_data["groups"][chat_id].append(word)
-        save_filters(filters_data)
-        await update.message.reply_text(f"✅ Added '{word}' to filtered words")
+        filter_cache.add(chat_id, word)
+        reply(update, f"✅ Added '{word}' to filtered words")
 
     elif action == "remove":
-        if word not in filters_data["groups"][chat_id]:
-            await update.message.reply_text("This word is not in the filter list!")
+        if word not in words:
+            reply(update, "This word is not in the filter list!")
             return
-        filters_data["groups"][chat_id].remove(word)
-        save_filters(filters_data)
-        await update.message.reply_text(f"✅ Removed '{word}' from filtered words")
+        filter_cache.remove(chat_id, word)
+        reply(update, f"✅ Removed '{word}' from filtered words")
 
+@serialized(update_locks, chat_key)
 async def ship_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
-    shipping_data = load_shipping()
 
     # Check cooldown
-    if chat_id in shipping_data["last_ship"]:
-        last_ship = datetime.fromisoformat(shipping_data["last_ship"][chat_id])
-        if datetime.now() < last_ship + timedelta(days=1):
-            time_left = (last_ship + timedelta(days=1) - datetime.now())
-            hours = int(time_left.total_seconds() / 3600)
-            minutes = int((time_left.total_seconds() % 3600) / 60)
-            await update.message.reply_text(
-                f"⏳ Next shipping in {hours}h {minutes}m"
-            )
-            return
+    time_left = cooldowns.remaining("ship", chat_id)
+    if time_left:
+        hours = time_left // 3600
+        minutes = time_left % 3600 // 60
+        reply(update,
+            f"⏳ Next shipping in {hours}h {minutes}m",
+            priority=FUN
+        )
+        return
 
     try:
         # Get chat members
-        members = await context.bot.get_chat_administrators(update.effective_chat.id)
+        admins = await members.administrators(context.bot, update.effective_chat.id)
         member_list = []
-        for member in members:
+        for member in admins:
             if not member.user.is_bot:
                 member_list.append(member.user)
 
         if len(member_list) < 2:
-            await update.message.reply_text("Not enough members for shipping! 💔")
+            reply(update, "Not enough members for shipping! 💔", priority=FUN)
             return
 
         # Select random couple
@@ -606,160 +682,198 @@ async def ship_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else: heart = "💔"
 
         # Save shipping data
-        shipping_data["last_ship"][chat_id] = datetime.now().isoformat()
-        if chat_id not in shipping_data["couples"]:
-            shipping_data["couples"][chat_id] = []
-        shipping_data["couples"][chat_id].append({
+        cooldowns.start("ship", chat_id, DAY)
+        ship_history.record(chat_id, {
             "couple": [partner1.username or str(partner1.id), 
                       partner2.username or str(partner2.id)],
             "percentage": love_percent,
             "date": datetime.now().isoformat()
         })
-        save_shipping(shipping_data)
 
         # Send shipping message
-        await update.message.reply_text(
+        reply(update,
             f"🎯 *Today's Love Match* 🎯\n\n"
             f"@{partner1.username} + @{partner2.username} = {heart}\n\n"
             f"Love Percentage: {love_percent}%\n\n"
             f"{'Perfect Match! 🎉' if love_percent >= 80 else 'Interesting couple! 🤔'}",
-            parse_mode='Markdown'
+            parse_mode='Markdown',
+            priority=FUN
         )
 
     except Exception as e:
-        await update.message.reply_text(f"❌ Error in shipping: {str(e)}")
+        reply(update, f"❌ Error in shipping: {str(e)}", priority=FUN)
+
+async def ship_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    if context.args:
+        name = context.args[0].replace("@", "")
+    else:
+        name = update.effective_user.username or str(update.effective_user.id)
+
+    recent = ship_history.recent(chat_id, 5)
+    if not recent:
+        reply(update, "No couples shipped here yet! Try /shipping 💘", priority=FUN)
+        return
+
+    lines = ["*💞 Recent Couples*"]
+    for ship in recent:
+        first, second = ship["couple"]
+        lines.append(f"• @{first} + @{second} ({ship['percentage']}%)")
+
+    partners = ship_history.partners(chat_id, name)
+    if partners:
+        lines.append(f"\n*💘 @{name} was shipped with:*")
+        lines.extend(f"• @{partner} ×{count}" for partner, count in partners[:5])
+
+    reply(update, "\n".join(lines), parse_mode='Markdown', priority=FUN)
 
 async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    bot = context.bot
+
+    def build(names):
+        if len(names) > 10:
+            names = names[:10] + [f"{len(names) - 10} others"]
+        user = names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+        welcome_msg = choice(WELCOME_MESSAGES).format(user=user)
+        return lambda: bot.send_message(chat_id, welcome_msg, parse_mode='Markdown')
+
+    # A raid of joins becomes one message per chat instead of one per member
     for new_member in update.message.new_chat_members:
         if new_member.is_bot:
             continue
-
-        welcome_msg = choice(WELCOME_MESSAGES).format(
-            user=f"@{new_member.username}" if new_member.username else new_member.first_name
-        )
-        
-        await update.message.reply_text(welcome_msg, parse_mode='Markdown')
+        name = f"@{new_member.username}" if new_member.username else new_member.first_name
+        outbox.coalesce(("welcome", chat_id), name, chat_id, build, delay=WELCOME_DELAY)
 
 # Add message handler for filtered words
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
 
-    chat_id = str(update.effective_chat.id)
-    filters_data = load_filters()
-
-    if chat_id in filters_data["groups"]:
-        message_lower = update.message.text.lower()
-        for word in filters_data["groups"][chat_id]:
-            if word in message_lower:
-                try:
-                    await update.message.delete()
-                    await update.message.reply_text(
-                        f"⚠️ @{update.message.from_user.username} used a filtered word!"
-                    )
-                except Exception:
-                    pass
-                break
+    # Chats without filters return here without touching storage
+    matcher = filter_cache.matcher(str(update.effective_chat.id))
+    if matcher is None:
+        return
+
+    if matcher.search(update.message.text):
+        moderation.report(context.bot, update.message)
 
 # Add these new command handlers
 async def urban_dict(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("Usage: /urban <word>")
+        reply(update, "Usage: /urban <word>", priority=FUN)
         return
     
     word = " ".join(context.args)
-    url = f"https://api.urbandictionary.com/v0/define?term={quote(word)}"
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data["list"]:
-                        definition = data["list"][0]
-                        message = (
-                            f"📚 *{word}*\n\n"
-                            f"*Definition:*\n{definition['definition'][:1000]}...\n\n"
-                            f"*Example:*\n{definition['example'][:500]}...\n\n"
-                            f"👍 {definition['thumbs_up']} | 👎 {definition['thumbs_down']}"
-                        )
-                        await update.message.reply_text(message, parse_mode='Markdown')
-                    else:
-                        await update.message.reply_text(f"No definition found for '{word}'")
-        except Exception as e:
-            await update.message.reply_text("Error accessing Urban Dictionary")
+    try:
+        definition = await get_urban_client().define(word)
+    except Exception:
+        reply(update, "Error accessing Urban Dictionary", priority=FUN)
+        return
+
+    if definition:
+        message = (
+            f"📚 *{word}*\n\n"
+            f"*Definition:*\n{definition['definition'][:1000]}...\n\n"
+            f"*Example:*\n{definition['example'][:500]}...\n\n"
+            f"👍 {definition['thumbs_up']} | 👎 {definition['thumbs_down']}"
+        )
+        reply(update, message, parse_mode='Markdown', priority=FUN)
+    else:
+        reply(update, f"No definition found for '{word}'", priority=FUN)
 
 async def truth_or_dare(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text(
+        reply(update,
             "Usage: /tod <truth/dare>\n"
-            "Example: /tod truth"
+            "Example: /tod truth",
+            priority=FUN
         )
         return
     
     choice = context.args[0].lower()
     if choice == "truth":
         question = random.choice(TRUTH_QUESTIONS)
-        await update.message.reply_text(
+        reply(update,
             f"🤔 *Truth Question:*\n\n{question}",
-            parse_mode='Markdown'
+            parse_mode='Markdown',
+            priority=FUN
         )
     elif choice == "dare":
         challenge = random.choice(DARE_CHALLENGES)
-        await update.message.reply_text(
+        reply(update,
             f"😈 *Dare Challenge:*\n\n{challenge}",
-            parse_mode='Markdown'
+            parse_mode='Markdown',
+            priority=FUN
         )
     else:
-        await update.message.reply_text("Please choose either 'truth' or 'dare'")
+        reply(update, "Please choose either 'truth' or 'dare'", priority=FUN)
 
 async def never_have_i_ever(update: Update, context: ContextTypes.DEFAULT_TYPE):
     question = random.choice(NHIE_QUESTIONS)
-    await update.message.reply_text(
+    reply(update,
         f"🎮 *Never Have I Ever...*\n\n{question}\n\n"
         "Reply with 🙋‍♂️ if you have\n"
         "Reply with 🙅‍♂️ if you haven't",
-        parse_mode='Markdown'
+        parse_mode='Markdown',
+        priority=FUN
     )
 
+BOT_COMMANDS = [
+    # Karma Commands
+    ("rewards", "Get daily karma points"),
+    ("store", "View karma store"),
+    ("buy", "Purchase status with PID"),
+    ("give", "Give karma to another user"),
+    ("karma", "Check karma points"),
+    ("leaderboard", "View status leaderboard"),
+    
+    # Fun Commands
+    ("urban", "Search Urban Dictionary"),
+    ("tod", "Play Truth or Dare"),
+    ("nhie", "Play Never Have I Ever"),
+    ("ships", "Recent couples and shipping stats"),
+    
+    # Moderation Commands
+    ("warn", "Warn a user (Admin)"),
+    ("warns", "Check user warnings"),
+    ("mute", "Temporarily mute user (Admin)"),
+    ("unmute", "Remove user's mute (Admin)"),
+    ("ban", "Ban user from group (Admin)"),
+    ("unban", "Remove user's ban (Admin)"),
+    ("clean", "Delete recent messages (Admin)"),
+    ("filters", "Manage word filters (Admin)"),
+    
+    # Utility Commands
+    ("poll", "Create a poll"),
+    ("pin", "Pin a message (Admin)"),
+    ("unpin", "Unpin current message (Admin)"),
+    ("tr", "Translate message")
+]
+
+def commands_digest(token):
+    # Tied to the bot id so switching tokens still registers the list
+    bot_id = (token or "").split(":")[0]
+    return hashlib.sha256(json.dumps([bot_id, BOT_COMMANDS]).encode()).hexdigest()
+
 # Add this after bot initialization in main():
 async def set_commands(app):
-    commands = [
-        # Karma Commands
-        ("rewards", "Get daily karma points"),
-        ("store", "View karma store"),
-        ("buy", "Purchase status with PID"),
-        ("give", "Give karma to another user"),
-        ("karma", "Check karma points"),
-        ("leaderboard", "View status leaderboard"),
-        
-        # Fun Commands
-        ("urban", "Search Urban Dictionary"),
-        ("tod", "Play Truth or Dare"),
-        ("nhie", "Play Never Have I Ever"),
-        
-        # Moderation Commands
-        ("warn", "Warn a user (Admin)"),
-        ("warns", "Check user warnings"),
-        ("mute", "Temporarily mute user (Admin)"),
-        ("unmute", "Remove user's mute (Admin)"),
-        ("ban", "Ban user from group (Admin)"),
-        ("unban", "Remove user's ban (Admin)"),
-        ("clean", "Delete recent messages (Admin)"),
-        ("filters", "Manage word filters (Admin)"),
-        
-        # Utility Commands
-        ("poll", "Create a poll"),
-        ("pin", "Pin a message (Admin)"),
-        ("unpin", "Unpin current message (Admin)"),
-        ("tr", "Translate message")
-    ]
-    
-    await app.bot.set_my_commands(commands)
+    # Skip the API call when the same list was already registered
+    path = os.path.join(DATA_DIR, COMMANDS_STAMP_FILE)
+    digest = commands_digest(app.bot.token)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if json.load(f).get("digest") == digest:
+                return
+    except (OSError, ValueError):
+        pass
+    await app.bot.set_my_commands(BOT_COMMANDS)
+    atomic_write_json(path, {"digest": digest})
 
 # Update the help command
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
+def render_help():
+    return """
 🤖 *AegisIX Bot v2.2.0*
 
 *Karma Commands:*
@@ -772,6 +886,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 *Fun Commands:*
 /shipping - Ship two random members
+/ships - Recent couples and shipping stats
 /info - View detailed user info
 /urban <word> - Search Urban Dictionary
 /tod <truth/dare> - Truth or Dare game
@@ -801,10 +916,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💡 Bot Version: 2.2.0
 👨‍💻 Developer: @BeMyChase
 """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
 
-async def dev_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    dev_info = """
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(update, templates.get("help"), parse_mode='Markdown')
+
+def render_dev():
+    return """
 🛠 *Developer Information*
 Developer: @BeMyChase
 Version: 2.2.0
@@ -824,62 +941,337 @@ Language: Python 3.9+
 • 10 Welcome messages
 • 9+ Bot commands
 """
-    await update.message.reply_text(dev_info, parse_mode='Markdown')
+
+async def dev_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(update, templates.get("dev"), parse_mode='Markdown')
+
+def init_templates():
+    # Rendered once here; call templates.invalidate() when the data changes
+    templates.register("store", render_store)
+    templates.register("help", render_help)
+    templates.register("dev", render_dev)
+    templates.render_all()
+    catalog.on_change(lambda: templates.invalidate("store"))
+
+def register_gauges(webhook=None):
+    # State owned by other components, read whenever /metrics is scraped
+    metrics.register("karma_users", lambda: len(karma_store.users))
+    metrics.register("leaderboard_users", lambda: len(karma_store.leaderboard))
+    metrics.register("cooldowns_active", lambda: len(cooldowns))
+    metrics.register("filter_messages_skipped", lambda: filter_cache.skipped)
+    metrics.register("filter_messages_checked", lambda: filter_cache.checked)
+    metrics.register("urban_cache_hits", lambda: urban_client.cache.hits if urban_client else 0)
+    metrics.register("urban_requests", lambda: urban_client.requests if urban_client else 0)
+    metrics.register("member_cache_hits", lambda: members.members.hits + members.admins.hits)
+    metrics.register("member_api_fetches", lambda: members.fetches)
+    if webhook is not None:
+        metrics.register("webhook_queue_depth", lambda: webhook.depth)
+        metrics.register("webhook_rejected_full", lambda: webhook.stats["rejected_full"])
+    metrics.register("outbox_queue_depth", lambda: outbox.depth)
+    for name in ("violations", "batches", "warnings"):
+        metrics.register(f"moderation_{name}", lambda name=name: moderation.stats[name])
+    for name in ("sent", "retried", "failed", "dropped", "coalesced"):
+        metrics.register(f"outbox_{name}", lambda name=name: outbox.stats[name])
+
+def _timing_lines(name, label):
+    lines = []
+    for key, h in sorted(metrics.histograms.get(name, {}).items(), key=lambda item: -item[1].count):
+        value = dict(key)[label]
+        lines.append(
+            f"• `{value}` {h.count:,}x avg {h.sum / h.count * 1000:.1f}ms "
+            f"p50≤{h.quantile(0.5) * 1000:g}ms p99≤{h.quantile(0.99) * 1000:g}ms"
+        )
+    return lines
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_owner(update.effective_user.id):
+        reply(update, "❌ This command is only available to the bot owner")
+        return
+
+    errors = {dict(key)["handler"]: n for key, n in metrics.counters.get("handler_errors_total", {}).items()}
+    in_flight = sum(metrics.gauges.get("handler_in_flight", {}).values())
+    lines = ["*📊 Bot Stats*", "", "*Handlers:*"]
+    lines += _timing_lines("handler_latency_seconds", "handler") or ["• No updates handled yet"]
+    if errors:
+        lines.append("❌ Errors: " + ", ".join(f"`{name}` {n}" for name, n in errors.items()))
+    lines.append(f"⏳ In flight: {in_flight}")
+    lines += ["", "*Storage:*"] + (_timing_lines("storage_seconds", "op") or ["• No storage calls yet"])
+    lines += ["", "*Bot API:*"] + (_timing_lines("bot_api_seconds", "method") or ["• No API calls yet"])
+    lines += [
+        "",
+        f"👥 Users: {len(karma_store.users):,}",
+        f"🔇 Filter checks: {filter_cache.checked:,} (skipped {filter_cache.skipped:,})",
+        f"📚 Urban: {urban_client.cache.hits if urban_client else 0:,} cache hits, "
+        f"{urban_client.requests if urban_client else 0:,} API calls",
+        f"📤 Outbox: {outbox.depth:,} queued, {outbox.stats['sent']:,} sent, {outbox.stats['retried']:,} retried, "
+        f"{outbox.stats['failed']:,} failed, {outbox.stats['dropped']:,} dropped",
+        f"🔇 Moderation: {moderation.stats['violations']:,} violations in {moderation.stats['batches']:,} batches",
+    ]
+    reply(update, "\n".join(lines), parse_mode='Markdown')
+
+# Owner-only: credit / debit many users at once from CSV or JSON rows
+# (see bulk.py), either after the command or in a replied-to file
+async def bulk_karma(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_owner(update.effective_user.id):
+        reply(update, "❌ This command is only available to the bot owner")
+        return
+
+    source = update.message.reply_to_message
+    if source is not None and source.document is not None:
+        file = await context.bot.get_file(source.document.file_id)
+        text = bytes(await file.download_as_bytearray()).decode('utf-8-sig')
+    else:
+        parts = update.message.text.split(None, 1)
+        text = parts[1] if len(parts) > 1 else ""
+    if not text.strip():
+        reply(update,
+            "Usage: /bulkkarma followed by one user,delta per line\n"
+            "Example:\n/bulkkarma\n@alice,50\n123456789,-10\n\n"
+            "Or reply to a .csv / .json file with /bulkkarma"
+        )
+        return
+
+    try:
+        report = apply_rows(karma_store, text)
+    except BulkFormatError as e:
+        reply(update, f"❌ {e}")
+        return
+    # One write for the whole batch
+    saved = True
+    try:
+        await karma_store.save()
+    except Exception as e:
+        # The batch stays applied in memory and queued for the next flush
+        print(f"❌ Error saving bulk karma: {e}")
+        saved = False
+
+    lines = [
+        f"✅ Applied {len(report['applied']):,} of {report['rows']:,} rows",
+        f"➕ {report['credited']:,} credited, ➖ {report['debited']:,} debited",
+    ]
+    if not saved:
+        lines.append("⚠️ Not saved yet: the changes are live and will be retried on the next flush, "
+                     "but a crash before then loses them")
+    if report["failed"]:
+        lines.append(f"\n❌ {len(report['failed']):,} failed:")
+        lines.extend(f"• row {number}: {reason}" for number, reason in report["failed"][:20])
+        if len(report["failed"]) > 20:
+            lines.append(f"… and {len(report['failed']) - 20:,} more")
+    reply(update, "\n".join(lines))
+
+def get_urban_client():
+    global http_session, urban_client
+    if urban_client is not None:
+        return urban_client
+    import aiohttp
+    from urban import URBAN_API_URL, UrbanClient
+    # One pooled session for the whole bot: connections, DNS and TLS are reused
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=int(os.getenv('HTTP_POOL_SIZE', '20')), ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=float(os.getenv('HTTP_TIMEOUT', '10')))
+    )
+    urban_client = UrbanClient(
+        http_session,
+        os.getenv('URBAN_API_URL', URBAN_API_URL),
+        timeout=float(os.getenv('URBAN_TIMEOUT', '5')),
+        cache_ttl=float(os.getenv('URBAN_CACHE_TTL', '3600'))
+    )
+    return urban_client
+
+def print_startup_times():
+    phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup_times.items())
+    print(f"⏱️ Startup: {phases}")
+
+async def timed_startup(name, work):
+    started = time.perf_counter()
+    result = await work
+    startup_times[name] = time.perf_counter() - started
+    return result
+
+async def close_http():
+    if http_session is not None:
+        await http_session.close()
 
 # Update the start_bot and main functions
-async def start_bot(app):
+async def start_bot(app, mode='polling'):
+    webhook = None
+    metrics_server = None
     try:
         print("🤖 Starting AegisIX Bot v2.2.0...")
+
+        # Load the data on a worker thread while the Bot API handshake runs
+        await asyncio.gather(
+            timed_startup("data", asyncio.to_thread(init_storage)),
+            timed_startup("connect", app.initialize())
+        )
+        init_templates()
+        # The loaded data lives as long as the process; keep the collector
+        # from rescanning it on every full collection
+        gc.freeze()
         
         # Set commands
-        await set_commands(app)
+        await timed_startup("commands", set_commands(app))
         
         # Start bot
-        await app.initialize()
         await app.start()
+        karma_store.start()
+        cooldowns.start_flusher()
         print("✅ Bot is ready!")
         
-        # Start polling in the background
-        await app.updater.start_polling()
+        if mode == 'webhook':
+            # Serve updates from a local endpoint instead of polling
+            from webhook import WebhookServer
+            webhook = WebhookServer(
+                app,
+                host=os.getenv('WEBHOOK_HOST', '127.0.0.1'),
+                port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                path=os.getenv('WEBHOOK_PATH', '/telegram'),
+                secret_token=os.getenv('WEBHOOK_SECRET'),
+                queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+                workers=int(os.getenv('CONCURRENT_UPDATES', '64'))
+            )
+            await webhook.start()
+            if os.getenv('WEBHOOK_URL'):
+                await app.bot.set_webhook(
+                    os.getenv('WEBHOOK_URL'),
+                    secret_token=os.getenv('WEBHOOK_SECRET'),
+                    allowed_updates=Update.ALL_TYPES
+                )
+        else:
+            # Start polling in the background
+            # chat_member updates are only sent when asked for
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        startup_times["ready"] = time.perf_counter() - BOOT_STARTED
+
+        # Prometheus-style /metrics on localhost (METRICS_PORT=0 turns it off);
+        # sharded workers each take the next port
+        register_gauges(webhook)
+        metrics_port = int(os.getenv('METRICS_PORT', '9464'))
+        if metrics_port:
+            metrics_server = MetricsServer(metrics, port=metrics_port + int(os.getenv('WORKER_INDEX', '0')))
+            try:
+                await metrics_server.start()
+            except OSError as e:
+                print(f"⚠️ Metrics endpoint unavailable: {e}")
+                metrics_server = None
         
-        # Keep the bot running until interrupted
-        await asyncio.Event().wait()
+        # Keep the bot running until interrupted; SIGTERM (sent by run_bots.py,
+        # or SIGBREAK on Windows) takes the same graceful path as Ctrl+C
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT, getattr(signal, 'SIGBREAK', None)):
+            if sig is None:
+                continue
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # No loop signal handlers on Windows
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+        await stop.wait()
         
     except Exception as e:
         print(f"❌ Error starting bot: {e}")
     finally:
-        await app.shutdown()
+        # Stop taking updates and let in-flight ones finish before flushing
+        if webhook is not None:
+            await webhook.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if app.updater is not None and app.updater.running:
+            await app.updater.stop()
+        # Deliver what handlers queued while the bot can still send
+        moderation.flush_all()
+        await outbox.stop(float(os.getenv('OUTBOX_DRAIN_TIMEOUT', '5')))
+        if app.running:
+            await app.stop()
+        await close_http()
+        # Storage may not have loaded if startup failed
+        if karma_store is not None:
+            await shutdown_step("saving karma", karma_store.stop)
+        if cooldowns is not None:
+            await shutdown_step("saving cooldowns", cooldowns.stop)
+        if storage is not None:
+            await shutdown_step("closing storage", storage.close)
+        await shutdown_step("shutting down the bot", app.shutdown)
+
+async def shutdown_step(name, step):
+    # A failing step mustn't skip the ones after it
+    try:
+        result = step()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        print(f"❌ Error {name}: {e}")
+
+def timed(name, callback):
+    return instrument(metrics, name, callback)
+
+def command(name, callback):
+    # CommandHandler whose callback reports latency / errors under its command name
+    return CommandHandler(name, timed(name, callback))
+
+def build_app(request=None, get_updates_request=None):
+    # Storage and templates are loaded by start_bot(); bench/startup.py
+    # passes fake requests to run the whole startup offline
+    builder = (
+        Application.builder()
+        .token(os.getenv('BOT_TOKEN'))
+        .concurrent_updates(int(os.getenv('CONCURRENT_UPDATES', '64')))
+        .request(request or TimedRequest(metrics, connection_pool_size=256))
+    )
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    app = builder.build()
+
+    # Runs before everything else (group -2), untimed
+    app.add_handler(TypeHandler(Update, mark_first_update), group=-2)
+
+    # Runs before every other handler (group -1)
+    app.add_handler(TypeHandler(Update, timed("track_username", track_username)), group=-1)
+
+    # Member / admin changes refresh the member cache
+    app.add_handler(ChatMemberHandler(timed("track_members", track_members), ChatMemberHandler.ANY_CHAT_MEMBER))
+
+    # Register commands
+    app.add_handler(command("start", help_command))
+    app.add_handler(command("help", help_command))
+    app.add_handler(command("dev", dev_command))
+    app.add_handler(command("rewards", rewards))
+    app.add_handler(command("store", store))
+    app.add_handler(command("buy", buy))
+    app.add_handler(command("give", give))
+    app.add_handler(command("karma", check_karma))
+    app.add_handler(command("leaderboard", leaderboard))
+    app.add_handler(command("info", user_info))
+    app.add_handler(command("filters", manage_filters))
+    app.add_handler(command("shipping", ship_members))
+    app.add_handler(command("ships", ship_stats))
+    
+    # Add message handlers
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed("handle_message", handle_message)))
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, timed("welcome_new_member", welcome_new_member)))
+
+    # Add new fun commands
+    app.add_handler(command("urban", urban_dict))
+    app.add_handler(command("tod", truth_or_dare))
+    app.add_handler(command("nhie", never_have_i_ever))
+
+    # Owner-only runtime stats
+    app.add_handler(command("stats", stats_command))
+    app.add_handler(command("bulkkarma", bulk_karma))
+    return app
 
 def main():
     try:
-        # Create application instance
-        app = Application.builder().token(os.getenv('BOT_TOKEN')).build()
-
-        # Register commands
-        app.add_handler(CommandHandler("start", help_command))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(CommandHandler("dev", dev_command))
-        app.add_handler(CommandHandler("rewards", rewards))
-        app.add_handler(CommandHandler("store", store))
-        app.add_handler(CommandHandler("buy", buy))
-        app.add_handler(CommandHandler("give", give))
-        app.add_handler(CommandHandler("karma", check_karma))
-        app.add_handler(CommandHandler("leaderboard", leaderboard))
-        app.add_handler(CommandHandler("info", user_info))
-        app.add_handler(CommandHandler("filters", manage_filters))
-        app.add_handler(CommandHandler("shipping", ship_members))
-        
-        # Add message handlers
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
-
-        # Add new fun commands
-        app.add_handler(CommandHandler("urban", urban_dict))
-        app.add_handler(CommandHandler("tod", truth_or_dare))
-        app.add_handler(CommandHandler("nhie", never_have_i_ever))
-        
+        app = build_app()
+
+        # BOT_MODE=webhook serves updates over HTTP instead of long polling
+        mode = os.getenv('BOT_MODE', 'polling').lower()
+        if mode == 'webhook' and not os.getenv('WEBHOOK_SECRET'):
+            raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+
         # Run the bot with proper async handling
-        asyncio.run(start_bot(app))
+        asyncio.run(start_bot(app, mode))
         
     except Exception as e:
         print(f"❌ Fatal error: {e}")
@@ -0,0 +1,617 @@
+import asyncio
+import bisect
+import gc
+import sys
+import time
+
+from records import PidIndex, PurchasesView, User, UsersView, decode_hook, from_json, to_epoch, to_iso
+from storage import ConcurrentWriteError, CorruptDataError
+
+
+class Leaderboard:
+    # Users grouped into buckets by total status rank. Totals are small
+    # integers with few distinct values, so top-k walks buckets from the
+    # highest score down and a position query only sums bucket sizes.
+
+    def __init__(self):
+        self.scores = {}
+        self._buckets = {}
+        self._order = []
+
+    def set(self, user_id, score):
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._drop(user_id, old)
+        self.scores[user_id] = score
+        bucket = self._buckets.get(score)
+        if bucket is None:
+            bucket = self._buckets[score] = {}
+            bisect.insort(self._order, score)
+        bucket[user_id] = None
+
+    def remove(self, user_id):
+        old = self.scores.pop(user_id, None)
+        if old is not None:
+            self._drop(user_id, old)
+
+    def _drop(self, user_id, score):
+        bucket = self._buckets[score]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[score]
+            del self._order[bisect.bisect_left(self._order, score)]
+
+    def top(self, k):
+        result = []
+        for score in reversed(self._order):
+            for user_id in self._buckets[score]:
+                result.append((user_id, score))
+                if len(result) == k:
+                    return result
+        return result
+
+    def position(self, user_id):
+        # 1-based position; users with the same score share a position
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        start = bisect.bisect_right(self._order, score)
+        return 1 + sum(len(self._buckets[s]) for s in self._order[start:])
+
+    def __len__(self):
+        return len(self.scores)
+
+
+class KarmaStore:
+    # Resident copy of the karma data, one records.User per user. Handlers
+    # read and mutate it in memory and a background task writes dirty users
+    # back to the storage backend every `flush_interval` seconds, so a hard
+    # crash loses at most one interval worth of karma changes. Transfers and
+    # purchases go straight to transactional backends (SQLite) so they can't
+    # be lost or doubled.
+
+    # With shared=True several processes use the same (transactional)
+    # backend: reads re-fetch the user's row, every change is written
+    # through as a single-row statement, and the leaderboard follows
+    # purchases made elsewhere by polling for new rows on each flush tick.
+
+    # With a ledger every change is also appended to it as it happens, and
+    # the backend is only written as a snapshot every `snapshot_interval`
+    # seconds; load() replays whatever the last snapshot missed.
+
+    # karma.json is also read and rewritten by the Node bot. Each flush
+    # first folds in whatever it changed (_merge_external), and the JSON
+    # rewrite runs on a worker thread from a frozen copy of the users dict;
+    # while it runs, records are copied before they are changed
+    # (_writable), so the thread never sees a half-applied change.
+
+    def __init__(self, backend, flush_interval=5.0, rank_of=None, shared=False,
+                 ledger=None, snapshot_interval=300.0):
+        if shared and not backend.transactional:
+            raise ValueError("Shared karma storage needs a transactional backend")
+        if shared and ledger is not None:
+            raise ValueError("The karma ledger can't be shared between processes")
+        self.backend = backend
+        self.shared = shared
+        self.ledger = ledger
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_at = time.monotonic()
+        self._purchase_cursor = 0
+        self.flush_interval = flush_interval
+        self.rank_of = rank_of or (lambda pid: 0)
+        self.leaderboard = Leaderboard()
+        self.pids = PidIndex()
+        self.users = {}
+        self.usernames = {}
+        self._usernames_dirty = False
+        self._dirty = set()
+        # Karma each changed user had as of the last save, for merging
+        self._base = {}
+        self._frozen = None
+        self._writing = None
+        self._task = None
+
+    def load(self):
+        # Every record is a new GC-tracked object; collecting while a million
+        # of them are created only rescans the ones already built
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            data = self.backend.load_karma(object_hook=decode_hook(self.pids))
+            self.users = from_json(data, self.pids)
+            del data
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self._dirty.clear()
+        self._base.clear()
+        index = self.backend.load_username_index()
+        if index is None:
+            index = {}
+            for uid, user in self.users.items():
+                if user.username:
+                    index[sys.intern(user.username.lower())] = uid
+            self._usernames_dirty = True
+        self.usernames = index
+        if self.ledger is not None:
+            self._replay()
+        self.rerank()
+        if self.shared:
+            self._purchase_cursor = self.backend.purchases_cursor()
+
+    def _replay(self):
+        # Brings the snapshot up to date with the ledger tail
+        for event in self.ledger.replay(self.ledger.snapshot_seq):
+            op, user_id = event["op"], event["user"]
+            user = self._user(user_id)
+            if op == "user":
+                self._index_username(user_id, user.username, event["username"])
+                user.rename(event["username"])
+            elif op in ("karma", "purchase"):
+                user.karma = event["balance"]
+            elif op == "transfer":
+                user.karma = event["balance"]
+                self._user(event["target"]).karma = event["target_balance"]
+                self.mark_dirty(event["target"])
+            if op == "purchase":
+                user.add(self.pids.bit(event["pid"]), to_epoch(event["at"]))
+            self.mark_dirty(user_id)
+
+    def _user(self, user_id):
+        # Record for a user the ledger knows but the snapshot may not
+        if user_id not in self.users:
+            self.users[user_id] = User(0, user_id)
+        return self._writable(user_id)
+
+    def _writable(self, user_id):
+        # The user's record, ready to be changed: a copy if a flush is still
+        # writing the current one
+        user = self.users[user_id]
+        if self._frozen is not None and self._frozen.get(user_id) is user:
+            user = self.users[user_id] = user.copy()
+        if not self.shared:
+            self._base.setdefault(user_id, user.karma)
+        return user
+
+    def _log(self, op, **fields):
+        if self.ledger is not None:
+            self.ledger.append(op, **fields)
+
+    def rerank(self):
+        # Rebuilds the leaderboard, e.g. after product ranks changed
+        self.leaderboard = Leaderboard()
+        for uid, user in self.users.items():
+            if user.owned:
+                self._rescore(uid)
+
+    def _sync(self, user_id):
+        # Shared mode: another process may have changed this user's row
+        if not self.shared:
+            return
+        row, owned = self.backend.load_user(user_id)
+        old = self.users.get(user_id)
+        if row is None:
+            # Gone from the database: drop it everywhere, ranking included
+            self.users.pop(user_id, None)
+            self.leaderboard.remove(user_id)
+            if old is not None:
+                self._index_username(user_id, old.username, None)
+            return
+        if old is None or old.username != row["username"]:
+            self._index_username(user_id, old and old.username, row["username"])
+        user = self.users[user_id] = User(row["karma"], row["username"])
+        for pid, purchased_at in owned.items():
+            user.add(self.pids.bit(pid), to_epoch(purchased_at))
+        if owned:
+            self._rescore(user_id)
+
+    def _poll_purchases(self):
+        rows, self._purchase_cursor = self.backend.purchases_after(self._purchase_cursor)
+        for user_id, pid, purchased_at in rows:
+            user = self.users.get(user_id)
+            if user is None:
+                # Someone we haven't seen: their row brings all their
+                # purchases; a purchase without a users row isn't ranked
+                self._sync(user_id)
+                continue
+            user.add(self.pids.bit(pid), to_epoch(purchased_at))
+            self._rescore(user_id)
+
+    # Reads
+    def get(self, user_id):
+        self._sync(user_id)
+        return self.users.get(user_id)
+
+    def karma(self, user_id):
+        self._sync(user_id)
+        user = self.users.get(user_id)
+        return user.karma if user is not None else 0
+
+    def find_by_username(self, username):
+        if self.shared:
+            return self.backend.find_user_id(username)
+        return self.usernames.get(username.lower())
+
+    def has_purchase(self, user_id, pid):
+        self._sync(user_id)
+        user = self.users.get(user_id)
+        bit = self.pids.bits.get(pid)
+        return bool(user is not None and bit is not None and user.has(bit))
+
+    def owned(self, user_id):
+        # Oldest purchase first
+        self._sync(user_id)
+        user = self.users.get(user_id)
+        return [pid for pid, _ in user.purchases(self.pids)] if user is not None else []
+
+    # Mutations - every one of these marks the user dirty (or writes
+    # through in shared mode)
+    def ensure_user(self, user_id, username):
+        self._sync(user_id)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = User(0, username)
+            self._index_username(user_id, None, username)
+            if self.shared:
+                self.backend.upsert_username(user_id, username)
+            else:
+                self._base.setdefault(user_id, 0)
+                self.mark_dirty(user_id)
+                self._log("user", user=user_id, username=username)
+        return user
+
+    def rename(self, user_id, username):
+        # Keeps the stored username in step with what Telegram reports
+        user = self.users.get(user_id)
+        if user is None or not username or user.username == username:
+            return
+        self._index_username(user_id, user.username, username)
+        self._writable(user_id).rename(username)
+        if self.shared:
+            self.backend.upsert_username(user_id, username)
+        else:
+            self.mark_dirty(user_id)
+            self._log("user", user=user_id, username=username)
+
+    def _index_username(self, user_id, old, new):
+        if old and self.usernames.get(old.lower()) == user_id:
+            del self.usernames[old.lower()]
+        if new:
+            self.usernames[sys.intern(new.lower())] = user_id
+        self._usernames_dirty = True
+
+    def add_karma(self, user_id, amount):
+        user = self.users[user_id]
+        if self.shared:
+            user.karma = self.backend.add_karma(user_id, amount)
+            return user.karma
+        balance = self._change(user_id, amount)
+        self._log("karma", user=user_id, delta=amount, balance=balance)
+        return balance
+
+    def _change(self, user_id, amount):
+        user = self._writable(user_id)
+        user.karma += amount
+        self.mark_dirty(user_id)
+        return user.karma
+
+    def set_karma(self, user_id, amount):
+        user = self._writable(user_id)
+        old = user.karma
+        user.karma = amount
+        if self.shared:
+            self.backend.set_karma(user_id, amount)
+        else:
+            self.mark_dirty(user_id)
+            self._log("karma", user=user_id, delta=amount - old, balance=amount)
+
+    def resolve(self, user):
+        # User id for a numeric id or a username (with or without @), None
+        # if there's no such user. Usernames can't be all digits.
+        user = str(user).strip().lstrip("@")
+        if user.isdigit():
+            return user if self.get(user) is not None else None
+        return self.find_by_username(user) if user else None
+
+    def adjust_many(self, rows, allow_negative=False):
+        # Applies [(user id or username, delta)] as one batch: a single
+        # backend transaction in shared mode, otherwise in memory for the
+        # caller to save() once. Rows naming unknown users or taking a
+        # balance below zero are skipped. Returns (applied, failed) with
+        # applied as [(row index, user id, new balance)] and failed as
+        # [(row index, reason)].
+        applied, failed, changes = [], [], []
+        for i, (user, delta) in enumerate(rows):
+            user_id = self.resolve(user)
+            if user_id is None:
+                failed.append((i, "unknown user"))
+            else:
+                changes.append((i, user_id, delta))
+
+        if self.shared:
+            balances = self.backend.add_karma_many([(uid, delta) for _, uid, delta in changes], allow_negative)
+            for (i, user_id, delta), balance in zip(changes, balances):
+                if balance is None:
+                    failed.append((i, "insufficient karma"))
+                    continue
+                if user_id in self.users:
+                    self.users[user_id].karma = balance
+                applied.append((i, user_id, balance))
+        else:
+            for i, user_id, delta in changes:
+                if not allow_negative and self.users[user_id].karma + delta < 0:
+                    failed.append((i, "insufficient karma"))
+                    continue
+                balance = self._change(user_id, delta)
+                self._log("karma", user=user_id, delta=delta, balance=balance)
+                applied.append((i, user_id, balance))
+        failed.sort()
+        return applied, failed
+
+    def add_purchase(self, user_id, pid, purchased_at):
+        self._writable(user_id).add(self.pids.bit(pid), to_epoch(purchased_at))
+        self._rescore(user_id)
+        if self.shared:
+            self.backend.purchase(user_id, pid, 0, purchased_at, debit=False)
+        else:
+            self.mark_dirty(user_id)
+
+    def _rescore(self, user_id):
+        self.leaderboard.set(user_id, sum(self.rank_of(pid) for pid in self.users[user_id].pids(self.pids)))
+
+    def transfer(self, sender_id, target_id, amount, debit=True):
+        # Moves karma between two users. Returns the sender's new balance, or
+        # None if they can't cover it.
+        if self.backend.transactional:
+            self._flush_users({sender_id, target_id})
+            balances = self.backend.transfer(sender_id, target_id, amount, debit)
+            if balances is None:
+                return None
+            for uid, balance in zip((sender_id, target_id), balances):
+                if uid in self.users:
+                    self._writable(uid).karma = balance
+            self._log("transfer", user=sender_id, target=target_id, amount=amount,
+                      balance=balances[0], target_balance=balances[1])
+            return balances[0]
+        if debit and self.karma(sender_id) < amount:
+            return None
+        balance = self._change(sender_id, -amount) if debit else self.karma(sender_id)
+        target_balance = self._change(target_id, amount)
+        self._log("transfer", user=sender_id, target=target_id, amount=amount,
+                  balance=balance, target_balance=target_balance)
+        return balance
+
+    def purchase(self, user_id, pid, price, purchased_at, debit=True):
+        # Records a purchase and charges for it. Returns the new balance, or
+        # None if the user can't afford it or already owns it.
+        if self.backend.transactional:
+            self._flush_users({user_id})
+            balance = self.backend.purchase(user_id, pid, price, purchased_at, debit)
+            if balance is None:
+                return None
+            user = self._writable(user_id)
+            user.karma = balance
+            user.add(self.pids.bit(pid), to_epoch(purchased_at))
+            self._rescore(user_id)
+            self._log("purchase", user=user_id, pid=pid, price=price if debit else 0,
+                      at=purchased_at, balance=balance)
+            return balance
+        if self.has_purchase(user_id, pid) or (debit and self.karma(user_id) < price):
+            return None
+        balance = self._change(user_id, -price) if debit else self.karma(user_id)
+        self.add_purchase(user_id, pid, purchased_at)
+        self._log("purchase", user=user_id, pid=pid, price=price if debit else 0,
+                  at=purchased_at, balance=balance)
+        return balance
+
+    def mark_dirty(self, user_id):
+        self._dirty.add(user_id)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    # Persistence
+    def _data(self, users=None):
+        # The karma.json schema, built entry by entry as the backend writes it
+        users = self.users if users is None else users
+        return {"users": UsersView(users), "purchases": PurchasesView(users, self.pids)}
+
+    def _flush_users(self, user_ids):
+        # Push pending changes for these users before a backend transaction
+        # reads their rows
+        pending = self._dirty & user_ids
+        if pending:
+            self.backend.save_karma(self._data(), pending)
+            self._dirty -= pending
+
+    def _merge_external(self):
+        # When karma.json changed behind our back (the Node bot's /rewards
+        # and /buy), its edits are folded in before ours are written over
+        # them: each user keeps the file's karma plus whatever we changed
+        # since our last save, and users and purchases we don't know yet are
+        # added
+        if self.shared or not self.backend.karma_changed():
+            return
+        try:
+            data = self.backend.load_karma(object_hook=decode_hook(self.pids))
+        except CorruptDataError as e:
+            # The Node bot writes in place; we probably caught it halfway
+            raise ConcurrentWriteError(e.path)
+        for user_id, other in from_json(data, self.pids).items():
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = User(0, None)
+            pending = user_id in self._base
+            karma = other.karma + user.karma - self._base.get(user_id, user.karma)
+            new = other.owned & ~user.owned
+            rename = user.username is None and other.username is not None
+            # Extra fields are only ever edited in the file
+            extra = other.extra != user.extra
+            if karma == user.karma and not new and not rename and not extra:
+                continue
+            user = self._writable(user_id)
+            if extra:
+                user.extra = other.extra
+            if rename:
+                self._index_username(user_id, None, other.username)
+                user.rename(other.username)
+                self._log("user", user=user_id, username=other.username)
+            if karma != user.karma:
+                self._log("karma", user=user_id, delta=karma - user.karma, balance=karma)
+                user.karma = karma
+            if new:
+                for pid, epoch in other.purchases(self.pids):
+                    bit = self.pids.bits[pid]
+                    if new >> bit & 1:
+                        user.add(bit, epoch)
+                        self._log("purchase", user=user_id, pid=pid, price=0, at=to_iso(epoch), balance=karma)
+                self._rescore(user_id)
+            # The file now holds other.karma for this user
+            if pending:
+                self._base[user_id] = other.karma
+            else:
+                del self._base[user_id]
+
+    def _prepare(self, snapshot):
+        # On the event loop: merges outside edits and takes over the pending
+        # changes as a job for _write(), or returns None if there's nothing
+        # to write yet
+        self._merge_external()
+        seq = None
+        if self.ledger is not None:
+            # Once the ledger is flushed its changes survive the bot crashing;
+            # only with fsync (LEDGER_FSYNC=1) do they also survive the
+            # machine going down. The backend only gets a snapshot every
+            # snapshot_interval seconds
+            self.ledger.flush()
+            if not snapshot and time.monotonic() - self._snapshot_at < self.snapshot_interval:
+                return None
+            self._snapshot_at = time.monotonic()
+            seq = self.ledger.last_seq
+            if seq == self.ledger.snapshot_seq:
+                seq = None
+        if not self._dirty and not self._usernames_dirty and seq is None:
+            return None
+        # A full JSON rewrite goes to a thread; SQLite only writes the dirty
+        # rows and its connection stays on the loop
+        threaded = bool(self._dirty) and not self.backend.transactional
+        if threaded:
+            self._frozen = self.users.copy()
+        usernames = None
+        if self._usernames_dirty:
+            usernames = dict(self.usernames) if threaded else self.usernames
+        job = {"data": self._data(self._frozen), "dirty": self._dirty, "base": self._base,
+               "usernames": usernames, "seq": seq, "threaded": threaded, "saved": False}
+        self._dirty, self._base, self._usernames_dirty = set(), {}, False
+        return job
+
+    def _write(self, job):
+        # Backend calls only, so this can run on a worker thread
+        if job["dirty"]:
+            self.backend.save_karma(job["data"], job["dirty"])
+            job["saved"] = True
+        if job["dirty"] or job["usernames"] is not None:
+            # Also re-stamps an unchanged index against the new karma data
+            self.backend.save_username_index(job["usernames"])
+
+    def _finish(self, job, error):
+        self._frozen = None
+        if error is None:
+            if job["seq"] is not None:
+                self.ledger.mark_snapshot(job["seq"])
+            return
+        # Hand what wasn't written back to the next flush; the file still
+        # holds the karma recorded in the old bases
+        if not job["saved"]:
+            self._dirty |= job["dirty"]
+            self._base.update(job["base"])
+        if job["usernames"] is not None:
+            self._usernames_dirty = True
+
+    def flush(self, snapshot=False):
+        # Writes pending changes right away, for callers outside the event
+        # loop (scripts, benchmarks)
+        job = self._prepare(snapshot)
+        if job is None:
+            return
+        try:
+            self._write(job)
+        except BaseException as e:
+            self._finish(job, e)
+            raise
+        self._finish(job, None)
+
+    async def save(self, snapshot=False):
+        # flush() for the event loop: one save at a time, and a JSON rewrite
+        # runs on a worker thread
+        while self._writing is not None:
+            await asyncio.shield(self._writing)
+        job = self._prepare(snapshot)
+        if job is None:
+            return
+        if not job["threaded"]:
+            try:
+                self._write(job)
+            except BaseException as e:
+                self._finish(job, e)
+                raise
+            self._finish(job, None)
+            return
+        # Shielded: a cancelled caller doesn't stop the write halfway
+        self._writing = asyncio.ensure_future(self._write_in_thread(job))
+        error = await asyncio.shield(self._writing)
+        if error is not None:
+            raise error
+
+    async def _write_in_thread(self, job):
+        error = None
+        try:
+            await asyncio.to_thread(self._write, job)
+        except Exception as e:
+            error = e
+        finally:
+            self._writing = None
+        self._finish(job, error)
+        return error
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                if self.shared:
+                    self._poll_purchases()
+                await self.save()
+            except Exception as e:
+                print(f"❌ Error flushing karma data: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            for attempt in range(5):
+                try:
+                    await self.save(snapshot=True)
+                    break
+                except ConcurrentWriteError as e:
+                    # The Node bot wrote karma.json just now; merge and try again
+                    print(f"⚠️ {e}, retrying")
+                    await asyncio.sleep(0.2)
+            else:
+                kept = "they are still in the ledger" if self.ledger is not None else "they are lost"
+                print(f"❌ Karma changes not saved at shutdown, karma.json kept changing; {kept}")
+        finally:
+            # Also when saving failed outright (disk, database errors)
+            if self.ledger is not None:
+                self.ledger.close()
@@ -0,0 +1,157 @@
+import json
+import os
+import time
+
+from storage import atomic_write_json
+
+# Append-only log of karma changes, kept as numbered JSONL segments in
+# data/ledger/. Every event carries a sequence number and the balances it
+# produced, so replaying it is idempotent: applying an event twice leaves
+# the same state as applying it once. A snapshot (karma.json / the SQLite
+# tables) records the last sequence number it contains in snapshot.json;
+# on startup the store loads the snapshot and replays the newer tail.
+#
+# Segment files are named after their first sequence number. Segments fully
+# covered by a snapshot are deleted, except for the newest `retain` of them,
+# which stay around as an audit trail.
+
+SNAPSHOT_FILE = 'snapshot.json'
+
+
+class KarmaLedger:
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, retain=16, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retain = retain
+        self.fsync = fsync
+        self.last_seq = 0
+        self._file = None
+        self._size = 0
+        self._unflushed = 0
+
+    # Segments
+    def _segments(self):
+        # (first_seq, path), oldest first
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.jsonl') and name[:-6].isdigit():
+                segments.append((int(name[:-6]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.directory, f"{first_seq:012d}.jsonl")
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        if not segments:
+            self.last_seq = self.snapshot_seq
+            self._roll()
+            return
+        path = segments[-1][1]
+        # A crash can leave half an event at the end; cut it off so new
+        # events start on a fresh line
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+        self.last_seq = max(segments[-1][0] - 1, self.snapshot_seq)
+        for event in self._read(path):
+            self.last_seq = event["seq"]
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = end
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._segment_path(self.last_seq + 1), 'a', encoding='utf-8')
+        self._size = 0
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    return
+                yield json.loads(line)
+
+    # Writing
+    def append(self, op, **fields):
+        if self._size >= self.segment_bytes:
+            self._roll()
+        self.last_seq += 1
+        event = {"seq": self.last_seq, "ts": int(time.time()), "op": op, **fields}
+        line = json.dumps(event, separators=(',', ':'), ensure_ascii=False) + '\n'
+        self._file.write(line)
+        self._size += len(line)
+        self._unflushed += 1
+        return self.last_seq
+
+    def flush(self):
+        if not self._unflushed:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._unflushed = 0
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    # Reading
+    def replay(self, after=0):
+        # Events with seq > after, oldest first
+        self.flush()
+        segments = self._segments()
+        for i, (first_seq, path) in enumerate(segments):
+            # Skip segments that end before `after`
+            if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+                continue
+            for event in self._read(path):
+                if event["seq"] > after:
+                    yield event
+
+    # Snapshots
+    @property
+    def snapshot_seq(self):
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)["seq"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    def mark_snapshot(self, seq):
+        # Called once everything up to seq is safely in the snapshot
+        self.flush()
+        atomic_write_json(os.path.join(self.directory, SNAPSHOT_FILE), {"seq": seq}, indent=None)
+        if self.last_seq == seq and self._size:
+            # Start a new segment so the covered one can be compacted away
+            self._roll()
+        covered = []
+        segments = self._segments()
+        for i, (first_seq, path) in enumerate(segments[:-1]):
+            if segments[i + 1][0] <= seq + 1:
+                covered.append(path)
+        for path in covered[:max(len(covered) - self.retain, 0)]:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    # python ledger.py history <user_id> - every recorded change for a user
+    import sys
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ledger')
+    if len(sys.argv) != 3 or sys.argv[1] != 'history':
+        print("Usage: python ledger.py history <user_id>")
+        sys.exit(1)
+    user_id = sys.argv[2]
+    if not os.path.isdir(directory):
+        print("No ledger yet (set KARMA_LEDGER=1)")
+        sys.exit(1)
+    ledger = KarmaLedger(directory)
+    for event in ledger.replay():
+        if user_id in (event.get("user"), event.get("target")):
+            print(json.dumps(event, ensure_ascii=False))
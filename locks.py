@@ -0,0 +1,59 @@
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+
+# Per-key async locks for serializing handlers that read-modify-write the
+# same user's karma or the same chat's settings while updates are processed
+# concurrently.
+
+
+class KeyedLock:
+    # One asyncio.Lock per key, created on demand and dropped once nobody
+    # holds or waits for it, so memory tracks active keys only
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        # Keys are taken in sorted order so two handlers locking the same
+        # pair (e.g. a /give in each direction) can't deadlock
+        keys = sorted({key for key in keys if key is not None})
+        acquired = []
+        try:
+            for key in keys:
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._release(key, locked=False)
+                    raise
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self._release(key, locked=True)
+
+    def _release(self, key, locked):
+        entry = self._locks[key]
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def serialized(locks, key_fn):
+    # Handler decorator: runs the handler while holding every key returned
+    # by key_fn(update, context)
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            async with locks.hold(*key_fn(update, context)):
+                return await handler(update, context)
+        return wrapper
+    return decorator
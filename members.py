@@ -0,0 +1,63 @@
+from cache import SingleFlight, TTLCache
+
+# Chat member and admin roster lookups, cached per chat so /info, /shipping
+# and admin checks don't each cost a Bot API round trip. Entries expire
+# after a TTL and are refreshed in place from chat_member / my_chat_member
+# updates; concurrent misses for the same key share one API call.
+
+ADMIN_STATUSES = ("creator", "administrator")
+
+
+class MemberCache:
+    def __init__(self, member_ttl=300.0, admin_ttl=600.0, max_members=10000, max_chats=2000):
+        self.members = TTLCache(max_members, member_ttl)
+        self.admins = TTLCache(max_chats, admin_ttl)
+        self.fetches = 0
+        self._flights = SingleFlight()
+
+    async def get_member(self, bot, chat_id, user_id):
+        key = (chat_id, user_id)
+        member = self.members.get(key)
+        if member is not None:
+            return member
+
+        async def fetch():
+            self.fetches += 1
+            member = await bot.get_chat_member(chat_id, user_id)
+            self.members.set(key, member)
+            return member
+
+        return await self._flights.do(("member",) + key, fetch)
+
+    async def administrators(self, bot, chat_id):
+        admins = self.admins.get(chat_id)
+        if admins is not None:
+            return admins
+
+        async def fetch():
+            self.fetches += 1
+            admins = tuple(await bot.get_chat_administrators(chat_id))
+            self.admins.set(chat_id, admins)
+            for member in admins:
+                self.members.set((chat_id, member.user.id), member)
+            return admins
+
+        return await self._flights.do(("admins", chat_id), fetch)
+
+    async def is_admin(self, bot, chat_id, user_id):
+        # One roster fetch answers the check for every user in the chat
+        admins = await self.administrators(bot, chat_id)
+        return any(member.user.id == user_id for member in admins)
+
+    def update(self, chat_member_updated):
+        # Applies a ChatMemberUpdated so cached entries don't go stale
+        chat_id = chat_member_updated.chat.id
+        member = chat_member_updated.new_chat_member
+        user_id = member.user.id
+        self.members.set((chat_id, user_id), member)
+        admins = self.admins.get(chat_id)
+        if admins is not None:
+            admins = tuple(m for m in admins if m.user.id != user_id)
+            if member.status in ADMIN_STATUSES:
+                admins += (member,)
+            self.admins.set(chat_id, admins)
@@ -0,0 +1,201 @@
+import asyncio
+import bisect
+import functools
+import time
+import importlib
+from collections import defaultdict
+
+from telegram.request import HTTPXRequest
+
+# Minimal Prometheus-style metrics: counters, gauges and fixed-bucket
+# latency histograms with labels, rendered in the text exposition format.
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.gauges = defaultdict(lambda: defaultdict(int))
+        self.histograms = defaultdict(dict)
+        self._callbacks = {}
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[name][_key(labels)] += amount
+
+    def gauge_add(self, name, amount, **labels):
+        self.gauges[name][_key(labels)] += amount
+
+    def register(self, name, fn):
+        # Gauge read from fn() at render time, for state owned elsewhere
+        self._callbacks[name] = fn
+
+    def observe(self, name, value, **labels):
+        series = self.histograms[name]
+        key = _key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(name, {}).get(_key(labels))
+
+    def render(self):
+        lines = []
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_fmt_labels(key)} {value}" for key, value in series.items())
+        for name, series in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_fmt_labels(key)} {value}" for key, value in series.items())
+        for name, fn in self._callbacks.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, h in series.items():
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_fmt_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{name}_sum{_fmt_labels(key)} {h.sum}")
+                lines.append(f"{name}_count{_fmt_labels(key)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def instrument(metrics, name, handler):
+    # Wraps a PTB handler callback with latency, error and in-flight metrics
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        metrics.gauge_add("handler_in_flight", 1, handler=name)
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc("handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("handler_latency_seconds", time.perf_counter() - start, handler=name)
+            metrics.gauge_add("handler_in_flight", -1, handler=name)
+    return wrapper
+
+
+class TimedBackend:
+    # Storage backend proxy that times every call as storage_seconds{op=...}
+
+    def __init__(self, backend, metrics):
+        self._backend = backend
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._metrics.observe("storage_seconds", time.perf_counter() - start, op=name)
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+class TimedRequest(HTTPXRequest):
+    # Bot API transport that times each call as bot_api_seconds{method=...}
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            self._metrics.inc("bot_api_errors_total", method=endpoint)
+            raise
+        else:
+            # API errors (429, 400, ...) come back as status codes here
+            if code >= 400:
+                self._metrics.inc("bot_api_errors_total", method=endpoint)
+            return code, payload
+        finally:
+            self._metrics.observe("bot_api_seconds", time.perf_counter() - start, method=endpoint)
+
+
+class MetricsServer:
+    def __init__(self, metrics, host='127.0.0.1', port=9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        # aiohttp is imported on a worker thread so the event loop keeps
+        # serving updates while it loads
+        web = await asyncio.to_thread(importlib.import_module, 'aiohttp.web')
+        web_app = web.Application()
+        web_app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if not self.port:
+            self.port = self._runner.addresses[0][1]
+        print(f"📊 Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,80 @@
+import asyncio
+
+from cache import TTLCache
+from outbox import MODERATION
+
+# Filtered-word violations are buffered per chat for `window` seconds and
+# handled together: the offending messages are removed with one
+# deleteMessages call per 100 ids (one delete per message on library
+# versions without it) and each offender gets a single warning for the
+# whole batch instead of one per message.
+#
+# Violation counts per (chat, user) are kept in memory and forgotten after
+# `reset_after` seconds without a new violation; a user reaching
+# `escalate_at` gets a stronger warning.
+
+BULK_DELETE_LIMIT = 100
+
+
+class ModerationQueue:
+    def __init__(self, outbox, window=1.0, escalate_at=5, reset_after=3600.0, max_users=50000):
+        self.outbox = outbox
+        self.window = window
+        self.escalate_at = escalate_at
+        self.counts = TTLCache(max_users, reset_after)
+        self.stats = {"violations": 0, "batches": 0, "warnings": 0}
+        self._pending = {}
+
+    def violations(self, chat_id, user_id):
+        return self.counts.get((chat_id, user_id), 0)
+
+    def report(self, bot, message):
+        chat_id = message.chat_id
+        user = message.from_user
+        key = (chat_id, user.id)
+        self.counts.set(key, self.counts.get(key, 0) + 1)
+        self.stats["violations"] += 1
+
+        batch = self._pending.get(chat_id)
+        if batch is None:
+            handle = asyncio.get_running_loop().call_later(self.window, self.flush, chat_id)
+            batch = self._pending[chat_id] = {"bot": bot, "message_ids": [], "users": {}, "handle": handle}
+        batch["message_ids"].append(message.message_id)
+        removed = batch["users"].get(user.id, (None, 0))[1]
+        batch["users"][user.id] = (f"@{user.username}" if user.username else user.first_name, removed + 1)
+
+    def flush(self, chat_id):
+        batch = self._pending.pop(chat_id, None)
+        if batch is None:
+            return
+        batch["handle"].cancel()
+        self.stats["batches"] += 1
+        bot = batch["bot"]
+        ids = batch["message_ids"]
+
+        delete_messages = getattr(bot, "delete_messages", None)
+        if delete_messages is not None:
+            for start in range(0, len(ids), BULK_DELETE_LIMIT):
+                chunk = ids[start:start + BULK_DELETE_LIMIT]
+                self.outbox.submit(chat_id, lambda chunk=chunk: delete_messages(chat_id, chunk),
+                                   MODERATION, limited=False, idempotent=True)
+        else:
+            for message_id in ids:
+                self.outbox.submit(chat_id, lambda message_id=message_id: bot.delete_message(chat_id, message_id),
+                                   MODERATION, limited=False, idempotent=True)
+
+        for user_id, (name, removed) in batch["users"].items():
+            text = self._warning(name, removed, self.violations(chat_id, user_id))
+            self.outbox.submit(chat_id, lambda text=text: bot.send_message(chat_id, text), MODERATION)
+            self.stats["warnings"] += 1
+
+    def _warning(self, name, removed, total):
+        if total >= self.escalate_at:
+            return f"🚨 {name} keeps using filtered words ({total} violations)! Admins, please take a look."
+        if removed == 1:
+            return f"⚠️ {name} used a filtered word!"
+        return f"⚠️ {name} used filtered words in {removed} messages!"
+
+    def flush_all(self):
+        for chat_id in list(self._pending):
+            self.flush(chat_id)
@@ -0,0 +1,341 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+# Outbound Bot API calls go through one queue instead of being awaited
+# inline by handlers. Sends are paced by a global token bucket and one
+# bucket per chat (Telegram allows roughly 30 messages/s overall, 1/s in a
+# private chat and 20/min in a group), run in priority order - moderation
+# first, fun replies last - and are retried after a RetryAfter or a network
+# error that kept the request from reaching Telegram. Other network errors
+# (a read timeout, say) may hide a request that went through, so they are
+# only retried for calls submitted as idempotent, like deletes. A full
+# queue drops new low-priority sends rather than growing without limit.
+# Failures are counted and logged instead of disappearing.
+#
+# Callers get an asyncio.Future for the call's result; awaiting it is
+# optional.
+
+MODERATION = 0
+REPLY = 1
+FUN = 2
+
+# Causes of PTB's NetworkError / TimedOut raised before the request was sent
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        # Seconds until a token can be taken, 0 if one is available
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "chat_id", "call", "limited", "idempotent", "future", "attempts")
+
+    def __init__(self, priority, seq, chat_id, call, limited, idempotent, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.call = call
+        self.limited = limited
+        self.idempotent = idempotent
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Chat:
+    __slots__ = ("jobs", "bucket")
+
+    def __init__(self, bucket):
+        self.jobs = []
+        self.bucket = bucket
+
+    def wait_time(self, job, now):
+        # Deletes and other unlimited calls only honour a RetryAfter pause
+        if job.limited:
+            return self.bucket.wait_time(now)
+        return max(self.bucket.paused_until - now, 0.0)
+
+
+class Outbox:
+    def __init__(self, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3,
+                 max_queue=10000, max_retries=3, concurrency=16):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self.depth = 0
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "queue_high_water": 0,
+        }
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # (priority, seq, chat_id) of chats whose first job can go now;
+        # entries are checked against the chat when popped
+        self._ready = []
+        self._batches = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._gate = None
+        self._task = None
+        # In-flight send task -> its job
+        self._sending = {}
+        # Jobs waiting out a retry backoff -> their timer; counted in depth
+        self._backoff = {}
+
+    # Submitting
+    def submit(self, chat_id, call, priority=REPLY, limited=True, idempotent=False):
+        # call: zero-argument coroutine function doing the Bot API request.
+        # limited=False skips the per-chat message bucket (e.g. deletes);
+        # idempotent=True means repeating the call is harmless.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(self._log_failure)
+        if self.depth >= self.max_queue and priority > MODERATION:
+            self.stats["dropped"] += 1
+            future.set_exception(OutboxFull(f"outbox full ({self.depth} queued)"))
+            return future
+        self._start()
+        job = _Job(priority, next(self._seq), chat_id, call, limited, idempotent, future)
+        self._push(job)
+        self.stats["queued"] += 1
+        self.stats["queue_high_water"] = max(self.stats["queue_high_water"], self.depth)
+        return future
+
+    def coalesce(self, key, item, chat_id, build, delay=2.0, priority=FUN):
+        # Collects items under `key` for `delay` seconds, then sends them as
+        # one call: build(items) returns the zero-argument coroutine function
+        batch = self._batches.get(key)
+        if batch is None:
+            handle = asyncio.get_running_loop().call_later(delay, self._flush_batch, key)
+            batch = self._batches[key] = {"items": [], "chat_id": chat_id, "build": build,
+                                          "priority": priority, "handle": handle}
+        else:
+            self.stats["coalesced"] += 1
+        batch["items"].append(item)
+
+    def _flush_batch(self, key):
+        batch = self._batches.pop(key, None)
+        if batch is not None:
+            batch["handle"].cancel()
+            self.submit(batch["chat_id"], batch["build"](batch["items"]), batch["priority"])
+
+    def _log_failure(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None and not isinstance(error, OutboxFull):
+            print(f"⚠️ Send failed: {error}")
+
+    # Scheduling
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Negative ids are groups and channels
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate, self.chat_burst))
+        return chat
+
+    def _push(self, job):
+        chat = self._chat(job.chat_id)
+        heapq.heappush(chat.jobs, job)
+        self.depth += 1
+        if chat.jobs[0] is job:
+            self._schedule(job.chat_id)
+
+    def _schedule(self, chat_id):
+        # Puts the chat's first job on the ready heap, now or once its
+        # bucket allows it
+        chat = self._chats.get(chat_id)
+        if chat is None or not chat.jobs:
+            return
+        job = chat.jobs[0]
+        delay = chat.wait_time(job, time.monotonic())
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._schedule, chat_id)
+            return
+        heapq.heappush(self._ready, (job.priority, job.seq, chat_id))
+        self._wakeup.set()
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._gate = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        swept = time.monotonic()
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or not chat.jobs or chat.jobs[0].seq != seq:
+                continue
+            job = chat.jobs[0]
+            now = time.monotonic()
+            if chat.wait_time(job, now) > 0:
+                self._schedule(chat_id)
+                continue
+            delay = self._global.wait_time(now)
+            if delay > 0:
+                # Something more urgent may be queued by the time we wake
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(delay)
+                continue
+            await self._gate.acquire()
+            if self._chats.get(chat_id) is not chat or not chat.jobs or chat.jobs[0] is not job:
+                # A more urgent job arrived while all send slots were busy
+                self._gate.release()
+                self._schedule(chat_id)
+                continue
+            now = time.monotonic()
+            heapq.heappop(chat.jobs)
+            self.depth -= 1
+            self._global.take(now)
+            if job.limited:
+                chat.bucket.take(now)
+            task = asyncio.get_running_loop().create_task(self._send(job))
+            self._sending[task] = job
+            task.add_done_callback(self._sent)
+            self._schedule(chat_id)
+
+            if now - swept > 60:
+                # Forget chats that have gone quiet and have a full bucket
+                swept = now
+                for key in [key for key, c in self._chats.items() if not c.jobs and c.bucket.idle(now)]:
+                    del self._chats[key]
+
+    def _sent(self, task):
+        del self._sending[task]
+
+    async def _send(self, job):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            # The chat is flood-limited: hold all of its sends, not just this one
+            self._chat(job.chat_id).bucket.pause(e.retry_after)
+            self._retry(job, e)
+        except (BadRequest, Forbidden) as e:
+            self._fail(job, e)
+        except NetworkError as e:
+            # Includes TimedOut
+            if job.idempotent or isinstance(e.__cause__, UNSENT_ERRORS):
+                self._retry(job, e, backoff=2 ** job.attempts)
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.stats["sent"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._gate.release()
+
+    def _retry(self, job, error, backoff=0.0):
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            self._fail(job, error)
+            return
+        self.stats["retried"] += 1
+        if backoff:
+            self.depth += 1
+            self._backoff[job] = asyncio.get_running_loop().call_later(backoff, self._resume, job)
+        else:
+            self._push(job)
+
+    def _resume(self, job):
+        del self._backoff[job]
+        self.depth -= 1
+        self._push(job)
+
+    def _fail(self, job, error):
+        self.stats["failed"] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    # Shutdown
+    async def stop(self, timeout=10.0):
+        # Sends pending batches, then waits up to `timeout` for the queue
+        # (backoff retries included) to drain. Whatever is left is cancelled,
+        # futures and all
+        for key in list(self._batches):
+            self._flush_batch(key)
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        sending = list(self._sending.items())
+        if sending:
+            # May or may not have reached Telegram
+            print(f"⚠️ Gave up on {len(sending)} sends still in flight on shutdown")
+        for task, job in sending:
+            task.cancel()
+            job.future.cancel()
+        await asyncio.gather(*(task for task, _ in sending), return_exceptions=True)
+        for job, handle in self._backoff.items():
+            handle.cancel()
+            job.future.cancel()
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                job.future.cancel()
+        if self.depth:
+            print(f"⚠️ Dropped {self.depth} unsent messages on shutdown")
+            self.stats["dropped"] += self.depth
+        self._backoff.clear()
+        self._chats.clear()
+        self._ready.clear()
+        self.depth = 0
@@ -0,0 +1,195 @@
+import sys
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+
+# Compact in-memory form of the karma data. karma.json keeps one small dict
+# per user plus a dict of pid -> ISO timestamp per buyer; with a million
+# users the per-object overhead of those dicts and strings is most of the
+# process. Here each user is one slotted User, usernames are interned,
+# and owned statuses are a bitmask (bit numbers handed out per pid by a
+# PidIndex) with purchase times as epoch seconds. Any other fields a user
+# entry carries (added by hand or by the Node bot) are kept as they are in
+# `extra`, so saving never drops them.
+#
+# The backends keep speaking the JSON schema: decode_hook() builds records
+# straight out of the decoder so the dicts never pile up, and UsersView /
+# PurchasesView present the records as that schema again when saving.
+# Purchase times are kept to the second and written back as naive UTC
+# ISO strings.
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(iso):
+    try:
+        moment = datetime.fromisoformat(iso)
+    except (TypeError, ValueError):
+        return 0
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return int((moment - EPOCH).total_seconds())
+
+
+def to_iso(epoch):
+    return (EPOCH + timedelta(seconds=epoch)).isoformat()
+
+
+def _intern(name):
+    return sys.intern(name) if isinstance(name, str) else name
+
+
+class PidIndex:
+    # Bit number for each product id, assigned in order of first sight
+    def __init__(self):
+        self.bits = {}
+        self.pids = []
+
+    def bit(self, pid):
+        bit = self.bits.get(pid)
+        if bit is None:
+            bit = self.bits[pid] = len(self.pids)
+            self.pids.append(sys.intern(pid))
+        return bit
+
+
+class User:
+    # `bought` holds one epoch timestamp per set bit of `owned`, lowest bit
+    # first; `extra` is a dict of unknown fields, or None (nearly always)
+    __slots__ = ("karma", "username", "owned", "bought", "extra")
+
+    def __init__(self, karma=0, username=None):
+        self.karma = karma
+        self.username = sys.intern(username) if username.__class__ is str else username
+        self.owned = 0
+        self.bought = ()
+        self.extra = None
+
+    def rename(self, username):
+        self.username = _intern(username)
+
+    def copy(self):
+        user = User(self.karma, self.username)
+        user.owned = self.owned
+        user.bought = self.bought
+        user.extra = self.extra
+        return user
+
+    def has(self, bit):
+        return self.owned >> bit & 1
+
+    def add(self, bit, epoch):
+        if self.has(bit):
+            return
+        # Position of the new timestamp = number of owned bits below it
+        slot = bin(self.owned & ((1 << bit) - 1)).count("1")
+        self.owned |= 1 << bit
+        self.bought = self.bought[:slot] + (epoch,) + self.bought[slot:]
+
+    def pids(self, pids):
+        # Owned product ids in bit order
+        mask, bit = self.owned, 0
+        while mask:
+            if mask & 1:
+                yield pids.pids[bit]
+            mask >>= 1
+            bit += 1
+
+    def purchases(self, pids):
+        # (pid, epoch) pairs, oldest purchase first
+        return sorted(zip(self.pids(pids), self.bought), key=lambda item: item[1])
+
+    def empty(self):
+        # Nothing worth a users entry: no karma, name, purchases or extras
+        return not (self.karma or self.username is not None or self.owned or self.extra)
+
+    def as_json(self):
+        if self.extra:
+            return {"karma": self.karma, "username": self.username, **self.extra}
+        return {"karma": self.karma, "username": self.username}
+
+
+def decode_hook(pids):
+    # json object_hook turning user entries into User records and each
+    # user's purchases into an (owned, bought) pair as they are decoded
+    def hook(obj):
+        # Called once per JSON object, so the common case (a user entry)
+        # is checked first and cheaply
+        karma = obj.get("karma")
+        if karma.__class__ is int and (len(obj) == 2 and "username" in obj or len(obj) == 1):
+            return User(karma, obj.get("username"))
+        if obj and "username" not in obj and all(isinstance(value, str) for value in obj.values()):
+            user = User()
+            for pid, purchased_at in obj.items():
+                user.add(pids.bit(pid), to_epoch(purchased_at))
+            return (user.owned, user.bought)
+        return obj
+    return hook
+
+
+def from_json(data, pids):
+    # {"users": ..., "purchases": ...} (as decoded by decode_hook, or plain
+    # dicts) -> {user_id: User}
+    hook = decode_hook(pids)
+    users = {}
+    for user_id, user in data["users"].items():
+        if not isinstance(user, User):
+            entry = user
+            user = User(entry.get("karma", 0), entry.get("username"))
+            user.extra = {key: value for key, value in entry.items() if key not in ("karma", "username")} or None
+        users[user_id] = user
+    for user_id, owned in data["purchases"].items():
+        if isinstance(owned, dict):
+            owned = hook(owned) if owned else (0, ())
+        user = users.get(user_id)
+        if user is None:
+            # Purchases of a user without a users entry
+            user = users[user_id] = User(0, None)
+        user.owned, user.bought = owned
+    return users
+
+
+class UsersView(Mapping):
+    # users as in karma.json: {user_id: {"karma": ..., "username": ...}}.
+    # Empty records (e.g. from an empty purchases entry, see from_json) are
+    # left out; a user with purchases is listed even without karma or name.
+    def __init__(self, users):
+        self._users = users
+
+    def _listed(self, user):
+        return user is not None and not user.empty()
+
+    def __getitem__(self, user_id):
+        user = self._users.get(user_id)
+        if not self._listed(user):
+            raise KeyError(user_id)
+        return user.as_json()
+
+    def __iter__(self):
+        return (user_id for user_id, user in self._users.items() if self._listed(user))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class PurchasesView(Mapping):
+    # purchases as in karma.json: {user_id: {pid: ISO timestamp}}
+    def __init__(self, users, pids):
+        self._users = users
+        self._pids = pids
+
+    def __getitem__(self, user_id):
+        user = self._users.get(user_id)
+        if user is None or not user.owned:
+            raise KeyError(user_id)
+        return {pid: to_iso(epoch) for pid, epoch in user.purchases(self._pids)}
+
+    def __iter__(self):
+        return (user_id for user_id, user in self._users.items() if user.owned)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def to_json(users, pids):
+    # The full karma.json document as plain dicts
+    return {"users": dict(UsersView(users)), "purchases": dict(PurchasesView(users, pids))}
@@ -1,50 +1,336 @@
-import subprocess
 import sys
 import time
 import os
+import asyncio
+import hmac
+import json
+import secrets
+import signal
+import subprocess
+import zlib
+
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Supervisor for the bots: every child (the Node bot and one or more
+# karma_bot.py processes) is watched concurrently and restarted with
+# exponential backoff when it dies. On SIGTERM/SIGINT each child gets
+# SIGTERM and DRAIN_TIMEOUT seconds to finish in-flight work and flush its
+# write-behind data before it is killed.
+#
+# On Windows terminate() is TerminateProcess, a hard kill, so children are
+# started in their own process group and stopped with CTRL_BREAK_EVENT
+# instead, which both bots handle as SIGBREAK.
+
+WINDOWS = sys.platform == 'win32'
+
+class Child:
+    def __init__(self, name, args, env=None, port=None, backoff=1.0, max_backoff=60.0):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.port = port
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.process = None
+        self.restarts = 0
+        self.started_at = None
+        self._stopping = False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def run(self):
+        failures = 0
+        options = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if WINDOWS else {}
+        while not self._stopping:
+            try:
+                self.process = await asyncio.create_subprocess_exec(*self.args, cwd=BASE_DIR, env=self.env, **options)
+            except OSError as e:
+                print(f"❌ Could not start {self.name}: {e}")
+                return
+            self.started_at = time.monotonic()
+            print(f"✅ {self.name} started (pid {self.process.pid})")
+            code = await self.process.wait()
+            if self._stopping:
+                break
+            # A child that stayed up for a while starts over with a short delay
+            failures = 0 if time.monotonic() - self.started_at > 60 else failures + 1
+            delay = min(self.backoff * 2 ** failures, self.max_backoff)
+            print(f"⚠️ {self.name} exited with {code}, restarting in {delay:.0f}s")
+            self.restarts += 1
+            await asyncio.sleep(delay)
+
+    async def stop(self, drain_timeout=15.0):
+        self._stopping = True
+        if not self.alive:
+            return
+        if WINDOWS:
+            self.process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {self.name} did not drain in {drain_timeout:.0f}s, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+    def rss(self):
+        # Resident memory in bytes (Linux only)
+        if not self.alive:
+            return None
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def status(self):
+        alive = self.alive
+        return {
+            "name": self.name,
+            "pid": self.process.pid if alive else None,
+            "alive": alive,
+            "uptime": round(time.monotonic() - self.started_at) if alive else 0,
+            "restarts": self.restarts,
+            "rss": self.rss(),
+        }
+
+    async def health(self, session):
+        # status() plus the child's own webhook stats when it serves HTTP
+        info = self.status()
+        if self.port is not None:
+            try:
+                async with session.get(f"{self.url}/healthz", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                    info["webhook"] = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                info["webhook"] = None
+        return info
+
+# Sharded mode (PY_WORKERS > 1): the supervisor receives Telegram's webhook
+# calls and forwards each update to one of N karma_bot.py workers, picked
+# by a hash of the chat id so a chat always lands on the same worker, which
+# handles that chat's updates one at a time in the order they reach it
+# (see webhook.py). Workers share one SQLite database in SHARED_STORAGE
+# mode, so karma stays consistent for users active in several chats.
+#
+# The Node bot is not started in sharded mode, nor next to a single Python
+# bot in BOT_MODE=webhook. It long-polls with the same BOT_TOKEN and deletes
+# the webhook when it starts, which would cut the webhook off; Telegram only
+# delivers a bot's updates one way at a time. Its commands go unanswered.
+
+# Commands only the Node bot handles
+NODE_ONLY_COMMANDS = ("warn", "warns", "mute", "unmute", "ban", "unban", "clean", "poll",
+                      "pin", "unpin", "broadcast", "listchats", "chats", "rank", "lb")
+
+def skip_node_bot(mode):
+    print(f"⚠️ {mode}: the JavaScript bot is not started, so "
+          f"{', '.join('/' + name for name in NODE_ONLY_COMMANDS)} won't be answered")
+
+CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+             "my_chat_member", "chat_member", "chat_join_request")
+
+def routing_key(update):
+    for key in CHAT_KEYS:
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update and "message" in update["callback_query"]:
+        return update["callback_query"]["message"]["chat"]["id"]
+    # Inline queries, polls etc. have no chat; keep each user on one worker
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return update.get("update_id", 0)
+
+def shard_for(update, count):
+    return zlib.crc32(str(routing_key(update)).encode()) % count
 
-def run_bots():
+class StatusServer:
+    # GET /healthz with the status of every child. In sharded mode it also
+    # routes POSTed updates to the workers.
+
+    def __init__(self, children, workers=(), secret_token=None, internal_token=None, path='/telegram'):
+        self.children = children
+        self.workers = list(workers)
+        self.secret_token = secret_token
+        self.internal_token = internal_token
+        self.path = path
+        self.session = None
+        self.runner = None
+        self.stats = {"routed": 0, "rejected": 0, "unavailable": 0}
+
+    async def _handle_update(self, request):
+        given = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(given, self.secret_token):
+            self.stats["rejected"] += 1
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            worker = self.workers[shard_for(json.loads(body), len(self.workers))]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.stats["rejected"] += 1
+            return web.Response(status=400)
+        try:
+            async with self.session.post(
+                worker.url + self.path,
+                data=body,
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-Telegram-Bot-Api-Secret-Token': self.internal_token
+                }
+            ) as response:
+                # A busy worker answers 503, which tells Telegram to retry
+                self.stats["routed"] += 1
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats["unavailable"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+    async def _handle_health(self, request):
+        children = await asyncio.gather(*(c.health(self.session) for c in self.children))
+        body = {"alive": sum(1 for c in children if c["alive"]), "children": children}
+        if self.workers:
+            body["router"] = self.stats
+        return web.json_response(body)
+
+    async def start(self, host, port):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        web_app = web.Application()
+        if self.workers:
+            web_app.router.add_post(self.path, self._handle_update)
+        web_app.router.add_get('/healthz', self._handle_health)
+        self.runner = web.AppRunner(web_app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        if self.workers:
+            print(f"🌐 Routing updates on http://{host}:{port}{self.path} to {len(self.workers)} workers")
+        else:
+            print(f"📊 Supervisor status on http://{host}:{port}/healthz")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.session is not None:
+            await self.session.close()
+
+async def set_webhook(url, secret_token):
+    # Same update types karma_bot.py asks for when it sets the webhook itself;
+    # without allowed_updates Telegram keeps the previous list, which leaves
+    # out chat_member updates by default
+    from telegram import Update
+    api = f"https://api.telegram.org/bot{os.getenv('BOT_TOKEN')}/setWebhook"
+    payload = {"url": url, "secret_token": secret_token, "allowed_updates": Update.ALL_TYPES}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(api, json=payload) as response:
+            result = await response.json()
+            if not result.get("ok"):
+                raise RuntimeError(f"setWebhook failed: {result.get('description')}")
+
+def sharded_workers(count, internal_token, path):
+    # Create / migrate the shared database once, before any worker opens it
+    from storage import open_backend
+    open_backend(os.path.join(BASE_DIR, 'data'), 'sqlite').close()
+
+    base_port = int(os.getenv('WORKER_BASE_PORT', '9100'))
+    workers = []
+    for index in range(count):
+        env = dict(os.environ)
+        env.pop('WEBHOOK_URL', None)
+        env.update({
+            "BOT_MODE": "webhook",
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PORT": str(base_port + index),
+            "WEBHOOK_PATH": path,
+            "WEBHOOK_SECRET": internal_token,
+            "STORAGE_BACKEND": "sqlite",
+            "SHARED_STORAGE": "1",
+            "WORKER_INDEX": str(index),
+            # Each worker takes its share of the bot's global send rate
+            "WORKER_COUNT": str(count),
+        })
+        workers.append(Child(f"Python worker {index}", [sys.executable, "karma_bot.py"],
+                             env=env, port=base_port + index))
+    return workers
+
+async def run_bots():
+    print("🤖 Starting AegisIX Multi-Bot System...")
+    count = int(os.getenv('PY_WORKERS', '1'))
+    drain_timeout = float(os.getenv('DRAIN_TIMEOUT', '15'))
+    path = os.getenv('WEBHOOK_PATH', '/telegram')
+
+    if count > 1:
+        secret_token = os.getenv('WEBHOOK_SECRET')
+        if not secret_token:
+            raise RuntimeError("WEBHOOK_SECRET must be set to run sharded workers")
+        internal_token = secrets.token_urlsafe(32)
+        workers = sharded_workers(count, internal_token, path)
+        # See above: the Node bot's polling can't coexist with the webhook
+        skip_node_bot("Sharded mode")
+        children = workers
+        server = StatusServer(children, workers, secret_token, internal_token, path)
+        host, port = os.getenv('WEBHOOK_HOST', '0.0.0.0'), int(os.getenv('WEBHOOK_PORT', '8443'))
+    else:
+        workers = [Child("Python bot", [sys.executable, "karma_bot.py"])]
+        if os.getenv('BOT_MODE', 'polling').lower() == 'webhook':
+            skip_node_bot("Webhook mode")
+            children = workers
+        else:
+            children = [Child("JavaScript bot", ["node", "index.js"])] + workers
+        server = StatusServer(children)
+        host, port = '127.0.0.1', int(os.getenv('SUPERVISOR_PORT', '9099'))
+
+    # SIGTERM / SIGINT start a graceful drain (no signal handlers on Windows;
+    # Ctrl+C arrives as KeyboardInterrupt there)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    tasks = []
     try:
-        print("🤖 Starting AegisIX Multi-Bot System...")
-        
-        # Start JavaScript bot
-        js_bot = subprocess.Popen(
-            ["node", "index.js"],
-            cwd=os.path.dirname(os.path.abspath(__file__))
-        )
-        print("✅ JavaScript bot started")
-        
-        # Small delay between starts
-        time.sleep(2)
-        
-        # Start Python bot
-        py_bot = subprocess.Popen(
-            [sys.executable, "karma_bot.py"],
-            cwd=os.path.dirname(os.path.abspath(__file__))
-        )
-        print("✅ Python bot started")
-        
-        print("\n🎮 Both bots are now running!")
-        print("Press Ctrl+C to stop both bots")
-        
-        # Wait for both processes
-        js_bot.wait()
-        py_bot.wait()
-        
-    except KeyboardInterrupt:
-        print("\n⏳ Stopping bots...")
-        js_bot.terminate()
-        py_bot.terminate()
-        
-        # Wait for processes to end
-        js_bot.wait()
-        py_bot.wait()
+        tasks = [asyncio.create_task(child.run()) for child in children]
+        try:
+            await server.start(host, port)
+        except OSError as e:
+            if count > 1:
+                raise
+            # Only the status page is lost; the bots run as usual
+            print(f"⚠️ Supervisor status unavailable: {e}")
+        if count > 1 and os.getenv('WEBHOOK_URL'):
+            await set_webhook(os.getenv('WEBHOOK_URL'), secret_token)
+
+        print(f"\n🎮 {len(children)} bot processes are now running!")
+        print("Press Ctrl+C to stop all bots")
+        await stop.wait()
+    finally:
+        print(f"\n⏳ Stopping bots (waiting up to {drain_timeout:.0f}s for them to drain)...")
+        await asyncio.gather(*(child.stop(drain_timeout) for child in children))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.stop()
         print("👋 All bots stopped")
-        
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        if 'js_bot' in locals(): js_bot.terminate()
-        if 'py_bot' in locals(): py_bot.terminate()
 
 if __name__ == "__main__":
-    run_bots()
\ No newline at end of file
+    load_dotenv()
+    try:
+        asyncio.run(run_bots())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"❌ Error: {e}")
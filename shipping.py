@@ -0,0 +1,75 @@
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+# /shipping history, bounded per chat: at most `limit` couples no older than
+# `retention_days`. A chat's history is loaded from the backend the first
+# time it's used and then kept in memory together with per-user pairing
+# counts, so recording a couple is an append and stats never rescan it.
+# The backend copy is trimmed back to `limit` every `limit` appends, which
+# keeps it within twice the limit at constant amortized cost.
+
+
+class _ChatShips:
+    def __init__(self, couples, limit):
+        self.couples = deque(maxlen=limit)
+        self.partners = {}
+        self.appended = 0
+        for couple in couples:
+            self.add(couple)
+
+    def _count(self, couple, step):
+        first, second = couple["couple"]
+        for user, other in ((first, second), (second, first)):
+            counts = self.partners.setdefault(user.lower(), Counter())
+            counts[other] += step
+            if counts[other] <= 0:
+                del counts[other]
+                if not counts:
+                    del self.partners[user.lower()]
+
+    def add(self, couple):
+        if len(self.couples) == self.couples.maxlen:
+            self._count(self.couples[0], -1)
+        self.couples.append(couple)
+        self._count(couple, 1)
+
+    def expire(self, cutoff):
+        while self.couples and self.couples[0]["date"] < cutoff:
+            self._count(self.couples.popleft(), -1)
+
+
+class ShipHistory:
+    def __init__(self, backend, limit=100, retention_days=90):
+        self.backend = backend
+        self.limit = limit
+        self.retention = timedelta(days=retention_days)
+        self._chats = {}
+
+    def _cutoff(self):
+        return (datetime.now() - self.retention).isoformat()
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatShips(self.backend.load_ships(chat_id, self.limit), self.limit)
+        chat.expire(self._cutoff())
+        return chat
+
+    def record(self, chat_id, couple):
+        chat = self._chat(chat_id)
+        chat.add(couple)
+        self.backend.append_ship(chat_id, couple)
+        chat.appended += 1
+        if chat.appended >= self.limit:
+            self.backend.trim_ships(chat_id, self.limit, self._cutoff())
+            chat.appended = 0
+
+    def recent(self, chat_id, count=5):
+        # Newest first
+        couples = self._chat(chat_id).couples
+        return [couples[-i] for i in range(1, min(count, len(couples)) + 1)]
+
+    def partners(self, chat_id, user):
+        # How often `user` was shipped with each partner, most frequent first
+        counts = self._chat(chat_id).partners.get(user.lower())
+        return counts.most_common() if counts else []
@@ -0,0 +1,749 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+# Storage backends for the Python bot. Both expose the same operations so
+# karma_bot.py never touches files directly; pick one with STORAGE_BACKEND.
+
+KARMA_FILE = 'karma.json'
+COOLDOWN_FILE = 'cooldowns.json'
+FILTERS_FILE = 'filters.json'
+SHIPPING_FILE = 'shipping.json'
+SHIPPING_DIR = 'shipping'
+TIMERS_FILE = 'timers.json'
+USERNAMES_FILE = 'usernames.json'
+USERNAMES_STAMP_FILE = 'usernames.stamp.json'
+SQLITE_FILE = 'aegis.db'
+
+
+class CorruptDataError(Exception):
+    # Raised instead of quietly starting over from an empty data file
+    def __init__(self, path, error, backup=None):
+        self.path = path
+        self.backup = backup
+        hint = f"; last good backup: {backup}" if backup else ""
+        super().__init__(f"{path} is corrupt ({error}){hint}")
+
+
+class ConcurrentWriteError(Exception):
+    # Raised instead of replacing a file that another process (the Node bot
+    # writes karma.json too) changed since we last read it; nothing is written
+    def __init__(self, path):
+        self.path = path
+        super().__init__(f"{path} was changed by another process while it was being saved")
+
+
+def atomic_write_json(path, data, backups=0, indent=2):
+    # Write to a temp file in the same directory, fsync it and rename it over
+    # the target, so readers see either the old or the new file and never a
+    # truncated one. With backups > 0 the previous versions are kept as
+    # path.bak.1 (newest) .. path.bak.N.
+    _atomic_write(path, lambda f: json.dump(data, f, indent=indent, ensure_ascii=False,
+                                            separators=None if indent else (',', ':')), backups)
+
+
+def _write_sections(f, data):
+    # {"section": {key: value, ...}, ...} with one entry per line
+    f.write('{')
+    for i, (section, entries) in enumerate(data.items()):
+        f.write(',\n' if i else '\n')
+        f.write(f'  {json.dumps(section)}: {{')
+        first = True
+        for key, value in entries.items():
+            f.write('\n    ' if first else ',\n    ')
+            f.write(json.dumps(key, ensure_ascii=False) + ': ' + json.dumps(value, ensure_ascii=False))
+            first = False
+        f.write('}' if first else '\n  }')
+    f.write('\n}\n')
+
+
+def atomic_write_lines(path, items):
+    # Same as atomic_write_json, for JSONL files (one compact item per line)
+    def write(f):
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n')
+    _atomic_write(path, write)
+
+
+def _atomic_write(path, write, backups=0, check=None):
+    # check() runs right before the rename and may raise to abort it
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if check is not None:
+            check()
+        if backups > 0 and os.path.exists(path):
+            _rotate_backups(path, backups)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_dir(directory)
+
+
+def _rotate_backups(path, backups):
+    for n in range(backups - 1, 0, -1):
+        older = f"{path}.bak.{n}"
+        if os.path.exists(older):
+            os.replace(older, f"{path}.bak.{n + 1}")
+    newest = f"{path}.bak.1"
+    try:
+        if os.path.exists(newest):
+            os.unlink(newest)
+        os.link(path, newest)
+    except OSError:
+        # No hard links on this filesystem
+        shutil.copy2(path, newest)
+
+
+def _fsync_dir(directory):
+    # Persist the rename itself; not supported on Windows
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _stamp(path):
+    # Size and mtime, or None if the file doesn't exist
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _latest_good_backup(path):
+    n = 1
+    while os.path.exists(f"{path}.bak.{n}"):
+        try:
+            with open(f"{path}.bak.{n}", 'r', encoding='utf-8') as f:
+                json.load(f)
+            return f"{path}.bak.{n}"
+        except (OSError, json.JSONDecodeError):
+            n += 1
+    return None
+
+
+class JsonBackend:
+    # The original layout: one JSON document per kind of data, rewritten
+    # whole on every change.
+    transactional = False
+
+    def __init__(self, data_dir, backups=0):
+        self.data_dir = data_dir
+        self.backups = backups
+        self.karma_file = os.path.join(data_dir, KARMA_FILE)
+        self.cooldown_file = os.path.join(data_dir, COOLDOWN_FILE)
+        self.filters_file = os.path.join(data_dir, FILTERS_FILE)
+        self.shipping_file = os.path.join(data_dir, SHIPPING_FILE)
+        self.shipping_dir = os.path.join(data_dir, SHIPPING_DIR)
+        self.usernames_file = os.path.join(data_dir, USERNAMES_FILE)
+        self.usernames_stamp_file = os.path.join(data_dir, USERNAMES_STAMP_FILE)
+        self.timers_file = os.path.join(data_dir, TIMERS_FILE)
+        # karma.json's stamp as of our last read or write of it
+        self._karma_seen = None
+
+    def _read(self, path, default, strict=True, object_hook=None):
+        # A missing file means no data yet; an unreadable one is an error
+        # unless the file is only a cache we can rebuild (strict=False)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f, object_hook=object_hook)
+        except FileNotFoundError:
+            return default
+        except json.JSONDecodeError as e:
+            if not strict:
+                return default
+            raise CorruptDataError(path, e, _latest_good_backup(path))
+
+    def _write(self, path, data, backups=None):
+        atomic_write_json(path, data, self.backups if backups is None else backups)
+
+    # Karma
+    def load_karma(self, object_hook=None):
+        # object_hook (see records.decode_hook) is applied to every decoded
+        # object, so callers can build their own records while parsing
+        stamp = self._karma_stamp()
+        data = self._read(self.karma_file, {}, object_hook=object_hook)
+        self._karma_seen = stamp
+        return {"users": data.get("users", {}), "purchases": data.get("purchases", {})}
+
+    def save_karma(self, data, dirty=None):
+        # Written one entry at a time, so data may hold mappings that build
+        # each entry on demand (records.UsersView / PurchasesView). Refuses
+        # to replace a file someone else rewrote since we last read it.
+        def check():
+            if self.karma_changed():
+                raise ConcurrentWriteError(self.karma_file)
+        _atomic_write(self.karma_file, lambda f: _write_sections(f, data), self.backups, check)
+        self._karma_seen = self._karma_stamp()
+
+    def karma_changed(self):
+        # True if another process (the Node bot) rewrote karma.json since we
+        # last read or wrote it
+        return self._karma_stamp() != self._karma_seen
+
+    def _karma_stamp(self):
+        return _stamp(self.karma_file)
+
+    # The username index is a cache of karma.json. usernames.stamp.json
+    # records the stamps of both files as of the last save; if either file
+    # changed since (e.g. the Node bot rewrote karma.json) the index is not
+    # trusted and the caller rebuilds it.
+    def load_username_index(self):
+        stamps = self._read(self.usernames_stamp_file, {}, strict=False)
+        if (not stamps or stamps.get("karma") != self._karma_stamp()
+                or stamps.get("usernames") != _stamp(self.usernames_file)):
+            return None
+        return self._read(self.usernames_file, {}, strict=False).get("index")
+
+    def save_username_index(self, index=None):
+        # Called after every save_karma; index=None means the index didn't
+        # change and only needs re-stamping against the new karma.json
+        if index is not None:
+            self._write(self.usernames_file, {"index": index}, backups=0)
+        self._write(self.usernames_stamp_file,
+                    {"karma": self._karma_stamp(), "usernames": _stamp(self.usernames_file)}, backups=0)
+
+    # Cooldowns
+    def load_cooldowns(self):
+        return self._read(self.cooldown_file, {})
+
+    def cooldowns_stamp(self):
+        return _stamp(self.cooldown_file)
+
+    def save_cooldowns(self, claims):
+        # Merges {user_id: ISO time of last claim} into cooldowns.json,
+        # keeping whatever else (the Node bot) has written there
+        data = self.load_cooldowns()
+        data.update(claims)
+        self._write(self.cooldown_file, data)
+
+    # Cooldown deadlines ("name:key" -> epoch seconds). Kept apart from
+    # cooldowns.json, which the Node bot still reads and writes.
+    def load_timers(self):
+        return self._read(self.timers_file, None)
+
+    def save_timers(self, timers, dirty=None, expired=None):
+        atomic_write_json(self.timers_file, timers, indent=None)
+
+    # Word filters
+    def load_filters(self):
+        data = self._read(self.filters_file, {})
+        data.setdefault("groups", {})
+        data.setdefault("settings", {})
+        return data
+
+    def get_filters(self, chat_id):
+        return self.load_filters()["groups"].get(chat_id, [])
+
+    def filters_version(self):
+        # Changes whenever filters.json is rewritten, by us or anyone else
+        return _stamp(self.filters_file)
+
+    def get_filter_settings(self, chat_id):
+        return self.load_filters()["settings"].get(chat_id, {})
+
+    def set_filter_settings(self, chat_id, settings):
+        data = self.load_filters()
+        data["settings"][chat_id] = settings
+        self._write(self.filters_file, data)
+
+    def add_filter(self, chat_id, word):
+        data = self.load_filters()
+        words = data["groups"].setdefault(chat_id, [])
+        if word not in words:
+            words.append(word)
+            self._write(self.filters_file, data)
+
+    def remove_filter(self, chat_id, word):
+        data = self.load_filters()
+        words = data["groups"].get(chat_id, [])
+        if word in words:
+            words.remove(word)
+            self._write(self.filters_file, data)
+
+    # Shipping
+    def load_shipping(self):
+        data = self._read(self.shipping_file, {})
+        data.setdefault("last_ship", {})
+        data.setdefault("couples", {})
+        if os.path.isdir(self.shipping_dir):
+            # Couples moved to per-chat files; those are current
+            data["couples"] = {
+                name[:-6]: self.load_ships(name[:-6], None)
+                for name in os.listdir(self.shipping_dir) if name.endswith('.jsonl')
+            }
+        return data
+
+    # Shipping history: one append-only JSONL file per chat in
+    # data/shipping/, kept short by trim_ships(). shipping.json (which held
+    # every couple ever shipped) is split into these files once.
+    def _ships_file(self, chat_id):
+        return os.path.join(self.shipping_dir, f"{chat_id}.jsonl")
+
+    def _split_legacy_ships(self):
+        if os.path.isdir(self.shipping_dir):
+            return
+        tmp_dir = self.shipping_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for chat_id, couples in self.load_shipping()["couples"].items():
+            atomic_write_lines(os.path.join(tmp_dir, f"{chat_id}.jsonl"), couples)
+        os.replace(tmp_dir, self.shipping_dir)
+
+    def load_ships(self, chat_id, limit):
+        # The chat's newest `limit` couples (all with limit=None), oldest first
+        self._split_legacy_ships()
+        try:
+            with open(self._ships_file(chat_id), 'r', encoding='utf-8') as f:
+                # A torn last line from a crash is skipped
+                couples = [json.loads(line) for line in f if line.endswith('\n')]
+        except FileNotFoundError:
+            return []
+        return couples[-limit:] if limit else couples
+
+    def append_ship(self, chat_id, couple):
+        self._split_legacy_ships()
+        with open(self._ships_file(chat_id), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(couple, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def trim_ships(self, chat_id, keep, cutoff):
+        # Keeps the newest `keep` couples dated at or after cutoff
+        couples = [c for c in self.load_ships(chat_id, keep) if c["date"] >= cutoff]
+        atomic_write_lines(self._ships_file(chat_id), couples)
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    karma INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users (lower(username));
+CREATE TABLE IF NOT EXISTS purchases (
+    user_id TEXT NOT NULL,
+    pid TEXT NOT NULL,
+    purchased_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, pid)
+);
+CREATE TABLE IF NOT EXISTS cooldowns (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timers (
+    key TEXT PRIMARY KEY,
+    deadline INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS filters (
+    chat_id TEXT NOT NULL,
+    word TEXT NOT NULL,
+    PRIMARY KEY (chat_id, word)
+);
+CREATE TABLE IF NOT EXISTS filter_settings (
+    chat_id TEXT PRIMARY KEY,
+    whole_word INTEGER NOT NULL DEFAULT 0,
+    casefold INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ship_last (
+    chat_id TEXT PRIMARY KEY,
+    shipped_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ship_couples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    partner1 TEXT NOT NULL,
+    partner2 TEXT NOT NULL,
+    percentage INTEGER NOT NULL,
+    date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ship_couples_chat ON ship_couples (chat_id, id);
+"""
+
+
+class SqliteBackend:
+    # Every change is a small transaction touching only the affected rows,
+    # so per-command cost no longer depends on how much data is stored.
+    # WAL mode lets readers (and other processes) run alongside a writer.
+    transactional = True
+
+    def __init__(self, path):
+        self.path = path
+        # Opened on karma_bot's startup loader thread and used from the event
+        # loop afterwards, never from two threads at once
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    # Karma
+    def load_karma(self, object_hook=None):
+        # Same contract as JsonBackend.load_karma
+        hook = object_hook or (lambda obj: obj)
+        users = {
+            user_id: hook({"karma": karma, "username": username})
+            for user_id, username, karma in self.conn.execute(
+                "SELECT user_id, username, karma FROM users")
+        }
+        purchases = {}
+        for user_id, pid, purchased_at in self.conn.execute(
+                "SELECT user_id, pid, purchased_at FROM purchases ORDER BY rowid"):
+            purchases.setdefault(user_id, {})[pid] = purchased_at
+        if object_hook is not None:
+            purchases = {user_id: object_hook(owned) for user_id, owned in purchases.items()}
+        return {"users": users, "purchases": purchases}
+
+    def save_karma(self, data, dirty=None):
+        user_ids = data["users"].keys() if dirty is None else dirty
+        with self._transaction():
+            for user_id in user_ids:
+                user = data["users"].get(user_id)
+                if user is None:
+                    continue
+                self.conn.execute(
+                    "INSERT INTO users (user_id, username, karma) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, karma = excluded.karma",
+                    (user_id, user.get("username"), user.get("karma", 0)))
+                for pid, purchased_at in data["purchases"].get(user_id, {}).items():
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO purchases (user_id, pid, purchased_at) VALUES (?, ?, ?)",
+                        (user_id, pid, purchased_at))
+
+    # Row-level access for processes sharing the database (SHARED_STORAGE)
+    def load_user(self, user_id):
+        row = self.conn.execute("SELECT username, karma FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None, {}
+        owned = dict(self.conn.execute(
+            "SELECT pid, purchased_at FROM purchases WHERE user_id = ? ORDER BY rowid", (user_id,)))
+        return {"karma": row[1], "username": row[0]}, owned
+
+    def find_user_id(self, username):
+        row = self.conn.execute(
+            "SELECT user_id FROM users WHERE lower(username) = ?", (username.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def upsert_username(self, user_id, username):
+        self.conn.execute(
+            "INSERT INTO users (user_id, username, karma) VALUES (?, ?, 0) "
+            "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username",
+            (user_id, username))
+
+    def add_karma(self, user_id, amount):
+        with self._transaction():
+            self.conn.execute("UPDATE users SET karma = karma + ? WHERE user_id = ?", (amount, user_id))
+            return self._karma(user_id)
+
+    def set_karma(self, user_id, amount):
+        self.conn.execute("UPDATE users SET karma = ? WHERE user_id = ?", (amount, user_id))
+
+    def karma_changed(self):
+        # Other processes only change rows through these methods, and shared
+        # stores re-read the rows they use
+        return False
+
+    def add_karma_many(self, changes, allow_negative=False):
+        # [(user_id, delta)] in one transaction. Returns one new balance per
+        # change, None where the user is missing or would go below zero.
+        balances = []
+        with self._transaction():
+            for user_id, delta in changes:
+                cursor = self.conn.execute(
+                    "UPDATE users SET karma = karma + ? WHERE user_id = ? AND (? OR karma + ? >= 0)",
+                    (delta, user_id, allow_negative, delta))
+                balances.append(self._karma(user_id) if cursor.rowcount else None)
+        return balances
+
+    def purchases_cursor(self):
+        return self.conn.execute("SELECT coalesce(max(rowid), 0) FROM purchases").fetchone()[0]
+
+    def purchases_after(self, cursor):
+        # Purchases recorded since `cursor` (by any process) and the new cursor
+        rows = self.conn.execute(
+            "SELECT rowid, user_id, pid, purchased_at FROM purchases WHERE rowid > ? ORDER BY rowid",
+            (cursor,)).fetchall()
+        return [row[1:] for row in rows], (rows[-1][0] if rows else cursor)
+
+    def load_username_index(self):
+        # Read straight off idx_users_username, which SQLite keeps current
+        return dict(self.conn.execute(
+            "SELECT lower(username), user_id FROM users INDEXED BY idx_users_username "
+            "WHERE lower(username) IS NOT NULL"))
+
+    def save_username_index(self, index=None):
+        pass
+
+    def transfer(self, sender_id, target_id, amount, debit=True):
+        # Returns the new (sender, target) balances, or None if the sender
+        # can't cover the amount
+        with self._transaction():
+            if debit:
+                cur = self.conn.execute(
+                    "UPDATE users SET karma = karma - ? WHERE user_id = ? AND karma >= ?",
+                    (amount, sender_id, amount))
+                if cur.rowcount != 1:
+                    raise _Rollback
+            self.conn.execute(
+                "UPDATE users SET karma = karma + ? WHERE user_id = ?", (amount, target_id))
+            return self._karma(sender_id), self._karma(target_id)
+
+    def purchase(self, user_id, pid, price, purchased_at, debit=True):
+        # Returns the new balance, or None if the user can't afford the item
+        # or already owns it
+        with self._transaction():
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO purchases (user_id, pid, purchased_at) VALUES (?, ?, ?)",
+                (user_id, pid, purchased_at))
+            if cur.rowcount != 1:
+                raise _Rollback
+            if debit:
+                cur = self.conn.execute(
+                    "UPDATE users SET karma = karma - ? WHERE user_id = ? AND karma >= ?",
+                    (price, user_id, price))
+                if cur.rowcount != 1:
+                    raise _Rollback
+            return self._karma(user_id)
+
+    def _karma(self, user_id):
+        row = self.conn.execute("SELECT karma FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    # Cooldowns
+    def load_cooldowns(self):
+        return dict(self.conn.execute("SELECT key, value FROM cooldowns"))
+
+    def load_timers(self):
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'timers'").fetchone() is None:
+            return None
+        return dict(self.conn.execute("SELECT key, deadline FROM timers"))
+
+    def get_timer(self, key):
+        row = self.conn.execute("SELECT deadline FROM timers WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def try_start_timer(self, key, deadline, now):
+        # Atomic check-and-set across processes: sets the deadline unless an
+        # unexpired one exists. Returns 0 on success, else the seconds left.
+        with self._transaction():
+            cur = self.conn.execute(
+                "INSERT INTO timers (key, deadline) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET deadline = excluded.deadline WHERE timers.deadline <= ?",
+                (key, deadline, now))
+            if cur.rowcount == 1:
+                return 0
+            return max(self.get_timer(key) - now, 1)
+
+    def purge_timers(self, now):
+        return self.conn.execute("DELETE FROM timers WHERE deadline <= ?", (now,)).rowcount
+
+    def save_timers(self, timers, dirty=None, expired=None):
+        keys = timers.keys() if dirty is None else dirty
+        with self._transaction():
+            self.conn.executemany(
+                "INSERT INTO timers (key, deadline) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET deadline = excluded.deadline",
+                ((key, timers[key]) for key in keys if key in timers))
+            self.conn.executemany("DELETE FROM timers WHERE key = ?", ((key,) for key in expired or ()))
+            self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('timers', '1')")
+
+    # Word filters
+    def load_filters(self):
+        groups = {}
+        for chat_id, word in self.conn.execute("SELECT chat_id, word FROM filters ORDER BY rowid"):
+            groups.setdefault(chat_id, []).append(word)
+        settings = {
+            chat_id: {"whole_word": bool(whole_word), "casefold": bool(casefold)}
+            for chat_id, whole_word, casefold in self.conn.execute(
+                "SELECT chat_id, whole_word, casefold FROM filter_settings")
+        }
+        return {"groups": groups, "settings": settings}
+
+    def get_filters(self, chat_id):
+        return [row[0] for row in self.conn.execute(
+            "SELECT word FROM filters WHERE chat_id = ? ORDER BY rowid", (chat_id,))]
+
+    def filters_version(self):
+        # A counter in meta bumped by every filter edit, from any process;
+        # karma and other writes leave it alone
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'filters_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_filters_version(self):
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('filters_version', '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def get_filter_settings(self, chat_id):
+        row = self.conn.execute(
+            "SELECT whole_word, casefold FROM filter_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+        return {"whole_word": bool(row[0]), "casefold": bool(row[1])} if row else {}
+
+    def set_filter_settings(self, chat_id, settings):
+        self.conn.execute(
+            "INSERT INTO filter_settings (chat_id, whole_word, casefold) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET whole_word = excluded.whole_word, casefold = excluded.casefold",
+            (chat_id, int(settings.get("whole_word", False)), int(settings.get("casefold", False))))
+        self._bump_filters_version()
+
+    def add_filter(self, chat_id, word):
+        cursor = self.conn.execute("INSERT OR IGNORE INTO filters (chat_id, word) VALUES (?, ?)", (chat_id, word))
+        if cursor.rowcount:
+            self._bump_filters_version()
+
+    def remove_filter(self, chat_id, word):
+        cursor = self.conn.execute("DELETE FROM filters WHERE chat_id = ? AND word = ?", (chat_id, word))
+        if cursor.rowcount:
+            self._bump_filters_version()
+
+    # Shipping
+    def load_shipping(self):
+        data = {"last_ship": dict(self.conn.execute("SELECT chat_id, shipped_at FROM ship_last")),
+                "couples": {}}
+        for chat_id, p1, p2, percentage, date in self.conn.execute(
+                "SELECT chat_id, partner1, partner2, percentage, date FROM ship_couples ORDER BY id"):
+            data["couples"].setdefault(chat_id, []).append(
+                {"couple": [p1, p2], "percentage": percentage, "date": date})
+        return data
+
+    def load_ships(self, chat_id, limit):
+        rows = self.conn.execute(
+            "SELECT partner1, partner2, percentage, date FROM ship_couples "
+            "WHERE chat_id = ? ORDER BY id DESC LIMIT ?", (chat_id, limit)).fetchall()
+        return [{"couple": [p1, p2], "percentage": percentage, "date": date}
+                for p1, p2, percentage, date in reversed(rows)]
+
+    def append_ship(self, chat_id, couple):
+        self.conn.execute(
+            "INSERT INTO ship_couples (chat_id, partner1, partner2, percentage, date) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, couple["couple"][0], couple["couple"][1], couple["percentage"], couple["date"]))
+
+    def trim_ships(self, chat_id, keep, cutoff):
+        self.conn.execute(
+            "DELETE FROM ship_couples WHERE chat_id = ? AND (date < ? OR id <= "
+            "(SELECT id FROM ship_couples WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?))",
+            (chat_id, cutoff, chat_id, keep))
+
+    # Migration
+    def is_migrated(self):
+        return self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone() is not None
+
+    def migrate_from(self, source):
+        # One-shot import of everything held by another backend (normally the
+        # JSON files). Runs in a single transaction so a failure leaves the
+        # database untouched.
+        karma = source.load_karma()
+        shipping = source.load_shipping()
+        with self._transaction():
+            for user_id, user in karma["users"].items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO users (user_id, username, karma) VALUES (?, ?, ?)",
+                    (user_id, user.get("username"), user.get("karma", 0)))
+            for user_id, owned in karma["purchases"].items():
+                for pid, purchased_at in owned.items():
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO purchases (user_id, pid, purchased_at) VALUES (?, ?, ?)",
+                        (user_id, pid, purchased_at))
+            # karma.json can list purchases for users it has no entry for;
+            # every purchase owner gets a users row so shared stores see them
+            self.conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, karma) "
+                "SELECT DISTINCT user_id, NULL, 0 FROM purchases")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cooldowns (key, value) VALUES (?, ?)",
+                source.load_cooldowns().items())
+            filters_data = source.load_filters()
+            for chat_id, words in filters_data["groups"].items():
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO filters (chat_id, word) VALUES (?, ?)",
+                    ((chat_id, word) for word in words))
+            for chat_id, settings in filters_data["settings"].items():
+                self.set_filter_settings(chat_id, settings)
+            self._bump_filters_version()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ship_last (chat_id, shipped_at) VALUES (?, ?)",
+                shipping["last_ship"].items())
+            for chat_id, couples in shipping["couples"].items():
+                self.conn.executemany(
+                    "INSERT INTO ship_couples (chat_id, partner1, partner2, percentage, date) VALUES (?, ?, ?, ?, ?)",
+                    ((chat_id, c["couple"][0], c["couple"][1], c["percentage"], c["date"]) for c in couples))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', datetime('now'))")
+
+    def close(self):
+        self.conn.close()
+
+
+class _Rollback(Exception):
+    pass
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so two processes doing
+    # read-check-update on the same row serialize instead of deadlocking.
+    # Raising _Rollback inside the block aborts quietly and the surrounding
+    # call returns None.
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+            return False
+        self.conn.execute("ROLLBACK")
+        return exc_type is _Rollback
+
+
+def open_backend(data_dir, kind=None):
+    kind = (kind or os.getenv('STORAGE_BACKEND', 'json')).lower()
+    if kind == 'json':
+        return JsonBackend(data_dir, int(os.getenv('JSON_BACKUPS', '1')))
+    if kind == 'sqlite':
+        backend = SqliteBackend(os.getenv('SQLITE_PATH') or os.path.join(data_dir, SQLITE_FILE))
+        if not backend.is_migrated():
+            backend.migrate_from(JsonBackend(data_dir))
+        return backend
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+if __name__ == '__main__':
+    # python storage.py migrate - import the JSON files into SQLite by hand
+    import sys
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    if sys.argv[1:] != ['migrate']:
+        print("Usage: python storage.py migrate")
+        sys.exit(1)
+    backend = SqliteBackend(os.getenv('SQLITE_PATH') or os.path.join(data_dir, SQLITE_FILE))
+    backend.migrate_from(JsonBackend(data_dir))
+    print(f"✅ Migrated JSON data into {backend.path}")
+    backend.close()
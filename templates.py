@@ -0,0 +1,30 @@
+# Message bodies that only change when the data behind them does (the store
+# listing, /help, /dev). Each one is rendered once and handed out as-is
+# until it is invalidated, e.g. after the product catalog changes.
+
+
+class TemplateCache:
+    def __init__(self):
+        self._renderers = {}
+        self._rendered = {}
+
+    def register(self, name, render):
+        self._renderers[name] = render
+        self._rendered.pop(name, None)
+
+    def get(self, name):
+        text = self._rendered.get(name)
+        if text is None:
+            text = self._rendered[name] = self._renderers[name]()
+        return text
+
+    def invalidate(self, *names):
+        # No names drops everything
+        if not names:
+            self._rendered.clear()
+        for name in names:
+            self._rendered.pop(name, None)
+
+    def render_all(self):
+        for name in self._renderers:
+            self.get(name)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bot's modules live at the top of the repo, not in a package
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
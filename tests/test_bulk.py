@@ -0,0 +1,46 @@
+from bulk import apply_rows, parse_rows
+from karma_store import KarmaStore
+from storage import JsonBackend
+
+
+def test_csv_rows_skip_the_header_and_blank_lines():
+    rows, failed = parse_rows("user,delta\n@alice,50\n\n123456789, -10\nbob\ncarol,lots\n")
+    assert rows == [(2, "@alice", 50), (4, "123456789", -10)]
+    assert failed == [(5, "expected user and delta"), (6, "bad delta 'lots'")]
+
+
+def test_json_rows_accept_objects_and_pairs():
+    rows, failed = parse_rows('[{"user": "@alice", "delta": 50}, ["2", -10.0], {"user": "bob"}, 7, ["x", true]]')
+    assert rows == [(1, "@alice", 50), (2, "2", -10)]
+    assert failed == [(3, "expected user and delta"), (4, "expected user and delta"), (5, "bad delta True")]
+
+
+def open_store(tmp_path):
+    store = KarmaStore(JsonBackend(str(tmp_path)))
+    store.load()
+    store.ensure_user("1", "alice")
+    store.ensure_user("2", "bob")
+    store.add_karma("2", 5)
+    return store
+
+
+def test_adjust_many_skips_unknown_users_and_overdrafts(tmp_path):
+    store = open_store(tmp_path)
+    applied, failed = store.adjust_many([("@Alice", 10), ("3", 1), ("2", -6), ("bob", -5)])
+    assert applied == [(0, "1", 10), (3, "2", 0)]
+    assert failed == [(1, "unknown user"), (2, "insufficient karma")]
+
+    applied, failed = store.adjust_many([("2", -6)], allow_negative=True)
+    assert applied == [(0, "2", -6)] and failed == []
+
+
+def test_apply_rows_reports_by_row_number(tmp_path):
+    store = open_store(tmp_path)
+    report = apply_rows(store, "@alice,50\nnobody,5\nbob,-2\nbob,x")
+    assert report["rows"] == 4
+    assert report["applied"] == [(1, "1", 50), (3, "2", 3)]
+    assert report["failed"] == [(2, "unknown user"), (4, "bad delta 'x'")]
+    assert (report["credited"], report["debited"]) == (50, 2)
+    # Applied in memory, written by the caller's save
+    store.flush()
+    assert JsonBackend(str(tmp_path)).load_karma()["users"]["1"]["karma"] == 50
@@ -0,0 +1,80 @@
+import json
+import os
+
+from catalog import Catalog
+from templates import TemplateCache
+
+
+def write_catalog(path, products, version=1):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"version": version,
+                   "tiers": [{"name": "Low", "min_rank": 1, "max_rank": 5},
+                             {"name": "High", "min_rank": 6, "max_rank": 10}],
+                   "products": products}, f)
+    # Make sure the change is seen even on a coarse mtime
+    stamp = os.stat(path).st_mtime + 1 + version
+    os.utime(path, (stamp, stamp))
+
+
+PRODUCTS = {
+    "p001": {"name": "Crown", "price": 5000, "rank": 9},
+    "P002": {"name": "Star", "price": 100, "rank": 2},
+    "P003": {"name": "Moon", "price": 900, "rank": 2},
+}
+
+
+def open_catalog(tmp_path):
+    path = str(tmp_path / "catalog.json")
+    write_catalog(path, PRODUCTS)
+    catalog = Catalog(path, recheck_interval=0)
+    catalog.load()
+    return catalog, path
+
+
+def test_indexes(tmp_path):
+    catalog, _ = open_catalog(tmp_path)
+    assert catalog.get("p002")["name"] == "Star"
+    assert catalog.get("P001")["tier"] == "High"
+    assert [pid for pid, _ in catalog.in_tier("Low")] == ["P002", "P003"]
+    assert [pid for pid, _ in catalog.with_rank(2)] == ["P002", "P003"]
+    assert [pid for pid, _ in catalog.affordable(900)] == ["P002", "P003"]
+    assert catalog.name("P999") == "P999"
+
+
+def test_edits_are_reloaded_and_bad_edits_ignored(tmp_path):
+    catalog, path = open_catalog(tmp_path)
+    changes = []
+    catalog.on_change(lambda: changes.append(catalog.version))
+
+    write_catalog(path, {**PRODUCTS, "P004": {"name": "Sun", "price": 1, "rank": 1}}, version=2)
+    assert "P004" in catalog
+    assert changes == [2]
+
+    write_catalog(path, {"P005": {"name": "Bad", "price": -1, "rank": 1}}, version=3)
+    assert "P005" not in catalog
+    assert "P004" in catalog
+    assert catalog.version == 2 and changes == [2]
+
+
+def test_templates_render_once_until_invalidated(tmp_path):
+    catalog, path = open_catalog(tmp_path)
+    templates = TemplateCache()
+    renders = []
+
+    def render_store():
+        renders.append(1)
+        return ", ".join(product["name"] for _, product in catalog.affordable(10 ** 9))
+
+    templates.register("store", render_store)
+    templates.register("help", lambda: "help")
+    catalog.on_change(lambda: templates.invalidate("store"))
+    templates.render_all()
+    assert templates.get("store") == "Star, Moon, Crown"
+    assert len(renders) == 1
+
+    write_catalog(path, {"P002": {"name": "Star", "price": 100, "rank": 2}}, version=2)
+    catalog.maybe_reload()
+    assert templates.get("store") == "Star"
+    assert len(renders) == 2
+    templates.invalidate()
+    assert templates.get("help") == "help"
@@ -0,0 +1,56 @@
+import json
+import os
+import time
+
+from cooldowns import DAY, CooldownManager
+from storage import JsonBackend
+
+# /rewards cooldowns shared with the Node bot through cooldowns.json
+
+
+def node_time(epoch):
+    # new Date(epoch * 1000).toISOString()
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(epoch))
+
+
+def write_cooldowns(data_dir, data):
+    with open(os.path.join(data_dir, "cooldowns.json"), "w") as f:
+        json.dump(data, f)
+    # Make sure the change is seen even on a coarse mtime
+    stamp = time.time() + 1
+    os.utime(os.path.join(data_dir, "cooldowns.json"), (stamp, stamp))
+
+
+def manager(data_dir):
+    cooldowns = CooldownManager(JsonBackend(str(data_dir)), legacy=JsonBackend(str(data_dir)))
+    cooldowns.load()
+    return cooldowns
+
+
+def test_node_claims_are_honoured_and_bad_entries_skipped(tmp_path):
+    now = int(time.time())
+    write_cooldowns(tmp_path, {"1": node_time(now - 3600), "2": "not a time", "3": None,
+                               "4": node_time(now - 2 * DAY)})
+    cooldowns = manager(tmp_path)
+    assert DAY - 3600 - 5 <= cooldowns.remaining("rewards", "1") <= DAY - 3600
+    assert cooldowns.remaining("rewards", "2") == 0
+    assert cooldowns.remaining("rewards", "4") == 0
+
+
+def test_claims_made_by_node_while_running_are_picked_up(tmp_path):
+    cooldowns = manager(tmp_path)
+    assert cooldowns.try_start("rewards", "1", DAY) == 0
+    write_cooldowns(tmp_path, {"5": node_time(int(time.time()))})
+    assert cooldowns.try_start("rewards", "5", DAY) > 0
+
+
+def test_our_claims_are_written_back_for_node(tmp_path):
+    write_cooldowns(tmp_path, {"5": node_time(int(time.time()) - 60)})
+    cooldowns = manager(tmp_path)
+    assert cooldowns.try_start("rewards", "1", DAY) == 0
+    cooldowns.flush()
+    with open(os.path.join(tmp_path, "cooldowns.json")) as f:
+        data = json.load(f)
+    assert set(data) == {"1", "5"}
+    assert data["1"].endswith("Z")
+    assert manager(tmp_path).remaining("rewards", "1") > DAY - 60
@@ -0,0 +1,47 @@
+from karma_store import KarmaStore, Leaderboard
+from storage import JsonBackend
+
+
+def test_top_walks_scores_from_the_highest_down():
+    board = Leaderboard()
+    for user_id, score in (("1", 5), ("2", 9), ("3", 5), ("4", 1)):
+        board.set(user_id, score)
+    assert board.top(3) == [("2", 9), ("1", 5), ("3", 5)]
+    assert board.top(10) == [("2", 9), ("1", 5), ("3", 5), ("4", 1)]
+    assert len(board) == 4
+
+
+def test_ties_share_a_position():
+    board = Leaderboard()
+    for user_id, score in (("1", 5), ("2", 9), ("3", 5), ("4", 1)):
+        board.set(user_id, score)
+    assert [board.position(user_id) for user_id in "1234"] == [2, 1, 2, 4]
+    assert board.position("5") is None
+
+
+def test_rescoring_and_removal_keep_buckets_tidy():
+    board = Leaderboard()
+    board.set("1", 5)
+    board.set("2", 5)
+    board.set("1", 7)
+    assert board.top(2) == [("1", 7), ("2", 5)]
+    board.remove("2")
+    board.remove("2")
+    assert board.top(5) == [("1", 7)]
+    # The empty score 5 bucket is gone, not just emptied
+    assert board._order == [7]
+    assert board.position("1") == 1
+
+
+def test_store_ranks_buyers_by_their_statuses(tmp_path):
+    ranks = {"P001": 1, "P002": 3}
+    store = KarmaStore(JsonBackend(str(tmp_path)), rank_of=lambda pid: ranks.get(pid, 0))
+    store.load()
+    for user_id in "123":
+        store.ensure_user(user_id, f"user{user_id}")
+    store.add_purchase("1", "P001", "2026-01-01T00:00:00")
+    store.add_purchase("2", "P001", "2026-01-01T00:00:00")
+    store.add_purchase("2", "P002", "2026-01-02T00:00:00")
+    assert store.leaderboard.top(10) == [("2", 4), ("1", 1)]
+    # Users without purchases aren't ranked
+    assert store.leaderboard.position("3") is None
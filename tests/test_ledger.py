@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+import pytest
+
+from karma_store import KarmaStore
+from ledger import KarmaLedger
+from storage import ConcurrentWriteError, JsonBackend
+
+
+def open_ledger(directory, **options):
+    ledger = KarmaLedger(str(directory), **options)
+    ledger.open()
+    return ledger
+
+
+def test_truncated_tail_is_cut_off_on_open(tmp_path):
+    ledger = open_ledger(tmp_path)
+    for balance in (1, 2, 3):
+        ledger.append("karma", user="1", delta=1, balance=balance)
+    ledger.close()
+    # A crash mid-write leaves half an event behind
+    segment = sorted(name for name in os.listdir(tmp_path) if name.endswith(".jsonl"))[-1]
+    with open(tmp_path / segment, "a", encoding="utf-8") as f:
+        f.write('{"seq":4,"ts":0,"op":"karma","us')
+
+    ledger = open_ledger(tmp_path)
+    assert ledger.last_seq == 3
+    assert [event["balance"] for event in ledger.replay()] == [1, 2, 3]
+    # New events start on a line of their own
+    assert ledger.append("karma", user="1", delta=1, balance=4) == 4
+    assert [event["seq"] for event in ledger.replay()] == [1, 2, 3, 4]
+
+
+def test_replay_after_snapshot_only_returns_the_tail(tmp_path):
+    ledger = open_ledger(tmp_path, segment_bytes=200, retain=0)
+    for balance in range(1, 21):
+        ledger.append("karma", user="1", delta=1, balance=balance)
+    ledger.mark_snapshot(15)
+    assert [event["seq"] for event in ledger.replay(ledger.snapshot_seq)] == [16, 17, 18, 19, 20]
+    # Segments wholly covered by the snapshot were compacted away
+    first_segment = min(int(name[:-6]) for name in os.listdir(tmp_path) if name.endswith(".jsonl"))
+    assert 1 < first_segment <= 16
+    ledger.close()
+
+    ledger = open_ledger(tmp_path, segment_bytes=200, retain=0)
+    assert ledger.snapshot_seq == 15
+    assert ledger.last_seq == 20
+
+
+def test_store_replays_changes_made_after_its_last_snapshot(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+
+    def open_store():
+        ledger = open_ledger(tmp_path / "ledger")
+        store = KarmaStore(JsonBackend(str(data_dir)), ledger=ledger, snapshot_interval=3600)
+        store.load()
+        return store, ledger
+
+    store, ledger = open_store()
+    store.ensure_user("1", "alice")
+    store.ensure_user("2", "bob")
+    store.add_karma("1", 10)
+    store.flush(snapshot=True)
+    store.add_karma("1", 5)
+    store.transfer("1", "2", 4)
+    store.purchase("2", "P005", 0, "2026-01-01T00:00:00")
+    # Not a snapshot: only the ledger has these changes
+    store.flush()
+    ledger.close()
+
+    store, ledger = open_store()
+    assert store.karma("1") == 11
+    assert store.karma("2") == 4
+    assert store.has_purchase("2", "P005")
+    assert store.find_by_username("bob") == "2"
+    ledger.close()
+
+
+def test_stop_closes_the_ledger_when_the_final_save_fails(tmp_path, monkeypatch, capsys):
+    ledger = open_ledger(tmp_path / "ledger")
+    store = KarmaStore(JsonBackend(str(tmp_path)), ledger=ledger)
+    store.load()
+    store.ensure_user("1", "alice")
+
+    def disk_full(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(store.backend, "save_karma", disk_full)
+    with pytest.raises(OSError):
+        asyncio.run(store.stop())
+    assert ledger._file is None
+
+    # Giving up after repeated concurrent writes says so
+    ledger = open_ledger(tmp_path / "ledger")
+    store = KarmaStore(JsonBackend(str(tmp_path)), ledger=ledger)
+    store.load()
+    store.ensure_user("2", "bob")
+
+    def busy(*args, **kwargs):
+        raise ConcurrentWriteError(str(tmp_path / "karma.json"))
+
+    monkeypatch.setattr(store.backend, "save_karma", busy)
+    asyncio.run(store.stop())
+    assert "❌ Karma changes not saved at shutdown" in capsys.readouterr().out
+    assert ledger._file is None
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from locks import KeyedLock, serialized
+
+
+def test_same_key_runs_one_at_a_time_other_keys_overlap():
+    locks = KeyedLock()
+    log = []
+
+    async def work(key, name):
+        async with locks.hold(key):
+            log.append(f"{name} in")
+            await asyncio.sleep(0.01)
+            log.append(f"{name} out")
+
+    async def main():
+        await asyncio.gather(work("user:1", "a"), work("user:1", "b"), work("user:2", "c"))
+
+    asyncio.run(main())
+    assert log.index("a out") < log.index("b in")
+    # c didn't wait for either of them
+    assert log.index("c in") < log.index("a out")
+    # Nobody holds or waits: no locks left behind
+    assert len(locks) == 0
+
+
+def test_opposite_pairs_do_not_deadlock():
+    locks = KeyedLock()
+
+    async def give(sender, target):
+        async with locks.hold(f"user:{sender}", f"user:{target}", None):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.wait_for(asyncio.gather(give(1, 2), give(2, 1), give(1, 1)), 1)
+
+    asyncio.run(main())
+    assert len(locks) == 0
+
+
+def test_cancelled_waiter_leaves_no_lock_behind():
+    locks = KeyedLock()
+
+    async def main():
+        async with locks.hold("chat:1"):
+            waiter = asyncio.ensure_future(locks.hold("chat:1").__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        return len(locks)
+
+    assert asyncio.run(main()) == 0
+
+
+def test_serialized_locks_the_keys_from_the_update():
+    locks = KeyedLock()
+    held = []
+
+    @serialized(locks, lambda update, context: [f"user:{update}"])
+    async def handler(update, context):
+        held.append(len(locks))
+        return update
+
+    assert handler.__name__ == "handler"
+    assert asyncio.run(handler(7, None)) == 7
+    assert held == [1] and len(locks) == 0
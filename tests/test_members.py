@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+from members import MemberCache
+
+
+def member(user_id, status="member"):
+    return SimpleNamespace(user=SimpleNamespace(id=user_id), status=status)
+
+
+class FakeBot:
+    # Answers after a short delay and counts the API calls
+    def __init__(self):
+        self.calls = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls.append(("member", chat_id, user_id))
+        await asyncio.sleep(0.01)
+        return member(user_id)
+
+    async def get_chat_administrators(self, chat_id):
+        self.calls.append(("admins", chat_id))
+        await asyncio.sleep(0.01)
+        return [member(1, "creator"), member(2, "administrator")]
+
+
+def test_concurrent_misses_share_one_call():
+    bot, cache = FakeBot(), MemberCache()
+
+    async def main():
+        found = await asyncio.gather(*(cache.get_member(bot, -100, 7) for _ in range(5)))
+        checks = await asyncio.gather(cache.is_admin(bot, -100, 2), cache.is_admin(bot, -100, 7))
+        return found, checks
+
+    found, checks = asyncio.run(main())
+    assert all(m is found[0] for m in found)
+    assert checks == [True, False]
+    assert bot.calls == [("member", -100, 7), ("admins", -100)]
+    # The roster also filled in the admins' member entries
+    assert asyncio.run(cache.get_member(bot, -100, 1)).status == "creator"
+    assert len(bot.calls) == 2
+
+
+def test_entries_expire_after_their_ttl():
+    bot, cache = FakeBot(), MemberCache(member_ttl=0.05, admin_ttl=0.05)
+
+    async def main():
+        await cache.get_member(bot, -100, 7)
+        await cache.get_member(bot, -100, 7)
+        await asyncio.sleep(0.06)
+        await cache.get_member(bot, -100, 7)
+
+    asyncio.run(main())
+    assert bot.calls == [("member", -100, 7)] * 2
+
+
+def test_member_updates_refresh_the_roster():
+    bot, cache = FakeBot(), MemberCache()
+
+    async def main():
+        await cache.administrators(bot, -100)
+        cache.update(SimpleNamespace(chat=SimpleNamespace(id=-100), new_chat_member=member(2, "member")))
+        cache.update(SimpleNamespace(chat=SimpleNamespace(id=-100), new_chat_member=member(9, "administrator")))
+        return await cache.is_admin(bot, -100, 2), await cache.is_admin(bot, -100, 9)
+
+    assert asyncio.run(main()) == (False, True)
+    assert bot.calls == [("admins", -100)]
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+
+from moderation import ModerationQueue
+from outbox import MODERATION
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, chat_id, call, priority, **options):
+        self.calls.append((chat_id, call, priority, options))
+
+
+class FakeBot:
+    def __init__(self, bulk=True):
+        self.log = []
+        if bulk:
+            self.delete_messages = lambda chat_id, ids: self.log.append(("delete_messages", chat_id, list(ids)))
+
+    def delete_message(self, chat_id, message_id):
+        self.log.append(("delete_message", chat_id, message_id))
+
+    def send_message(self, chat_id, text):
+        self.log.append(("send_message", chat_id, text))
+
+
+def message(message_id, user_id, username=None, chat_id=-100):
+    user = SimpleNamespace(id=user_id, username=username, first_name=f"User {user_id}")
+    return SimpleNamespace(chat_id=chat_id, from_user=user, message_id=message_id)
+
+
+def run(queue, bot, messages, wait=0.05):
+    outbox = queue.outbox
+
+    async def main():
+        for m in messages:
+            queue.report(bot, m)
+        await asyncio.sleep(wait)
+
+    asyncio.run(main())
+    for _, call, _, _ in outbox.calls:
+        call()
+    return outbox.calls
+
+
+def test_a_window_becomes_one_delete_and_one_warning_per_user():
+    queue, bot = ModerationQueue(FakeOutbox(), window=0.01), FakeBot()
+    calls = run(queue, bot, [message(1, 7, "spammer"), message(2, 7, "spammer"), message(3, 8)])
+    assert bot.log == [
+        ("delete_messages", -100, [1, 2, 3]),
+        ("send_message", -100, "⚠️ @spammer used filtered words in 2 messages!"),
+        ("send_message", -100, "⚠️ User 8 used a filtered word!"),
+    ]
+    assert all(priority == MODERATION for _, _, priority, _ in calls)
+    # Deletes skip the per-chat rate limit and are safe to retry
+    assert calls[0][3] == {"limited": False, "idempotent": True}
+    assert queue.stats == {"violations": 3, "batches": 1, "warnings": 2}
+
+
+def test_deletes_are_chunked_or_sent_one_by_one():
+    queue, bot = ModerationQueue(FakeOutbox(), window=0.01), FakeBot()
+    run(queue, bot, [message(i, 7) for i in range(1, 251)])
+    assert [len(entry[2]) for entry in bot.log if entry[0] == "delete_messages"] == [100, 100, 50]
+
+    queue, bot = ModerationQueue(FakeOutbox(), window=0.01), FakeBot(bulk=False)
+    run(queue, bot, [message(1, 7), message(2, 7)])
+    assert bot.log[:2] == [("delete_message", -100, 1), ("delete_message", -100, 2)]
+
+
+def test_repeat_offenders_get_escalated():
+    queue, bot = ModerationQueue(FakeOutbox(), window=10, escalate_at=3), FakeBot()
+
+    async def main():
+        queue.report(bot, message(1, 7, "spammer"))
+        queue.report(bot, message(2, 7, "spammer"))
+        # Nothing goes out before the window closes unless flushed
+        assert queue.outbox.calls == []
+        queue.flush_all()
+        queue.report(bot, message(3, 7, "spammer"))
+        queue.flush_all()
+
+    asyncio.run(main())
+    for _, call, _, _ in queue.outbox.calls:
+        call()
+    assert [text for kind, _, text in bot.log if kind == "send_message"] == [
+        "⚠️ @spammer used filtered words in 2 messages!",
+        "🚨 @spammer keeps using filtered words (3 violations)! Admins, please take a look.",
+    ]
+    assert queue.violations(-100, 7) == 3
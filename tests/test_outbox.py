@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pytest
+from telegram.error import NetworkError, TimedOut
+
+from outbox import Outbox
+
+# Which network failures the outbox sends again: only the ones where the
+# request can't have reached Telegram, unless the call is idempotent
+
+
+def flaky(error, calls):
+    # Fails once with `error`, then succeeds
+    async def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise error
+        return "ok"
+    return call
+
+
+def failure(cause):
+    # What PTB's HTTPXRequest raises for an httpx error
+    error_type = TimedOut if isinstance(cause, httpx.TimeoutException) else NetworkError
+    try:
+        try:
+            raise cause
+        except httpx.HTTPError as e:
+            raise error_type("request failed") from e
+    except NetworkError as e:
+        return e
+
+
+def send(error, **options):
+    calls = []
+
+    async def main():
+        outbox = Outbox()
+        try:
+            return await outbox.submit(-100, flaky(error, calls), **options)
+        finally:
+            await outbox.stop(timeout=0)
+
+    try:
+        return asyncio.run(main()), len(calls)
+    except NetworkError:
+        return None, len(calls)
+
+
+@pytest.mark.parametrize("cause", [httpx.ConnectError("refused"), httpx.ConnectTimeout("slow"),
+                                   httpx.PoolTimeout("busy")])
+def test_unsent_requests_are_retried(cause):
+    assert send(failure(cause)) == ("ok", 2)
+
+
+@pytest.mark.parametrize("cause", [httpx.ReadTimeout("no answer"), httpx.RemoteProtocolError("cut off")])
+def test_possibly_sent_requests_are_not_retried(cause):
+    assert send(failure(cause)) == (None, 1)
+
+
+def test_idempotent_calls_are_retried_after_any_network_error():
+    assert send(failure(httpx.ReadTimeout("no answer")), idempotent=True) == ("ok", 2)
+
+
+def test_stop_waits_for_backoff_retries():
+    calls = []
+
+    async def main():
+        outbox = Outbox()
+        future = outbox.submit(-100, flaky(failure(httpx.ConnectError("refused")), calls))
+        # Let the first attempt fail into its 1s backoff
+        while not calls:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        assert outbox.depth == 1
+        await outbox.stop(timeout=5)
+        return await future
+
+    assert asyncio.run(main()) == "ok"
+    assert len(calls) == 2
+
+
+def test_stop_cancels_what_it_cannot_finish():
+    async def never():
+        await asyncio.Event().wait()
+
+    async def main():
+        outbox = Outbox()
+        in_flight = outbox.submit(-100, never)
+        backoff = outbox.submit(-200, flaky(failure(httpx.ConnectError("refused")), []))
+        await asyncio.sleep(0.05)
+        await outbox.stop(timeout=0)
+        assert outbox.depth == 0
+        return in_flight.cancelled(), backoff.cancelled()
+
+    assert asyncio.run(main()) == (True, True)
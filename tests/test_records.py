@@ -0,0 +1,43 @@
+import json
+
+from records import PidIndex, UsersView, decode_hook, from_json, to_json
+
+
+def round_trip(document):
+    pids = PidIndex()
+    users = from_json(json.loads(json.dumps(document), object_hook=decode_hook(pids)), pids)
+    return users, json.loads(json.dumps(to_json(users, pids)))
+
+
+def test_plain_users_and_purchases_survive_a_round_trip():
+    document = {
+        "users": {"1": {"karma": 10, "username": "alice"}, "2": {"karma": 0, "username": None}},
+        "purchases": {"1": {"P005": "2026-01-01T00:00:00", "P001": "2026-02-01T12:30:00"}},
+    }
+    users, saved = round_trip(document)
+    assert saved["users"]["1"] == document["users"]["1"]
+    assert saved["purchases"] == document["purchases"]
+
+
+def test_unknown_user_fields_are_kept():
+    document = {
+        "users": {"1": {"karma": 3, "username": "alice", "joined": "2025-05-05", "flags": [1, 2]},
+                  "2": {"karma": 4, "note": "only karma and a note"}},
+        "purchases": {},
+    }
+    users, saved = round_trip(document)
+    assert saved["users"]["1"] == document["users"]["1"]
+    assert saved["users"]["2"] == {"karma": 4, "username": None, "note": "only karma and a note"}
+    assert users["1"].copy().extra == {"joined": "2025-05-05", "flags": [1, 2]}
+
+
+def test_users_with_purchases_but_no_karma_or_name_are_listed():
+    document = {
+        "users": {"1": {"karma": 0, "username": None}},
+        "purchases": {"1": {"P005": "2026-01-01T00:00:00"}, "2": {"P004": "2026-01-01T00:00:00"}, "3": {}},
+    }
+    users, saved = round_trip(document)
+    assert saved["users"] == {"1": {"karma": 0, "username": None}, "2": {"karma": 0, "username": None}}
+    assert set(saved["purchases"]) == {"1", "2"}
+    # The empty purchases entry left an empty record that isn't listed
+    assert "3" in users and "3" not in UsersView(users)
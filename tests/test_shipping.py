@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from shipping import ShipHistory
+from storage import JsonBackend, SqliteBackend
+
+
+def couple(first, second, days_ago=0):
+    date = (datetime.now() - timedelta(days=days_ago)).isoformat()
+    return {"couple": [first, second], "percentage": 50, "date": date}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "json":
+        return JsonBackend(str(tmp_path))
+    return SqliteBackend(str(tmp_path / "karma.db"))
+
+
+def test_ring_evicts_the_oldest_couple_and_its_counts(backend):
+    ships = ShipHistory(backend, limit=3)
+    for pair in (("Ann", "bob"), ("ann", "cid"), ("dee", "eve"), ("ann", "bob")):
+        ships.record("-100", couple(*pair))
+    assert [c["couple"] for c in ships.recent("-100")] == [["ann", "bob"], ["dee", "eve"], ["ann", "cid"]]
+    # The first Ann + bob fell out of the ring
+    assert ships.partners("-100", "ANN") == [("cid", 1), ("bob", 1)]
+    assert ships.partners("-100", "bob") == [("ann", 1)]
+    assert ships.recent("-200") == []
+
+
+def test_storage_is_trimmed_every_limit_appends(backend):
+    ships = ShipHistory(backend, limit=3)
+    for i in range(7):
+        ships.record("-100", couple(f"u{i}", "x"))
+    # Trimmed after the 3rd and 6th append, then one more
+    assert len(backend.load_ships("-100", 100)) == 4
+    # A fresh history reads back the newest `limit`
+    reloaded = ShipHistory(backend, limit=3)
+    assert [c["couple"][0] for c in reloaded.recent("-100")] == ["u6", "u5", "u4"]
+
+
+def test_old_couples_expire(backend):
+    backend.append_ship("-100", couple("old", "pair", days_ago=100))
+    backend.append_ship("-100", couple("new", "pair", days_ago=1))
+    ships = ShipHistory(backend, limit=10, retention_days=90)
+    assert [c["couple"][0] for c in ships.recent("-100")] == ["new"]
+    assert ships.partners("-100", "old") == []
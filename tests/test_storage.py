@@ -0,0 +1,170 @@
+import json
+import os
+
+import pytest
+
+from karma_store import KarmaStore
+from storage import CorruptDataError, JsonBackend, SqliteBackend, atomic_write_json
+
+
+def open_pair(tmp_path):
+    # Two connections to one database, like two worker processes
+    path = str(tmp_path / "karma.db")
+    return SqliteBackend(path), SqliteBackend(path)
+
+
+def add_user(backend, user_id, karma):
+    backend.save_karma({"users": {user_id: {"karma": karma, "username": f"user{user_id}"}}, "purchases": {}})
+
+
+def karma_of(backend):
+    return {user_id: user["karma"] for user_id, user in backend.load_karma()["users"].items()}
+
+
+def test_transfer_without_funds_changes_nothing(tmp_path):
+    backend, _ = open_pair(tmp_path)
+    add_user(backend, "1", 5)
+    add_user(backend, "2", 0)
+    assert backend.transfer("1", "2", 10) is None
+    assert karma_of(backend) == {"1": 5, "2": 0}
+    assert backend.transfer("1", "2", 5) == (0, 5)
+
+
+def test_transfer_rolls_back_on_error(tmp_path, monkeypatch):
+    backend, reader = open_pair(tmp_path)
+    add_user(backend, "1", 50)
+    add_user(backend, "2", 0)
+
+    def fail(user_id):
+        raise RuntimeError("disk on fire")
+
+    # Fails after both balance updates ran inside the transaction
+    monkeypatch.setattr(backend, "_karma", fail)
+    try:
+        backend.transfer("1", "2", 20)
+    except RuntimeError:
+        pass
+    monkeypatch.undo()
+    assert karma_of(reader) == {"1": 50, "2": 0}
+    # The connection isn't left inside the failed transaction
+    assert backend.transfer("1", "2", 20) == (30, 20)
+
+
+def test_unaffordable_purchase_is_rolled_back(tmp_path):
+    backend, reader = open_pair(tmp_path)
+    add_user(backend, "1", 100)
+    # The purchase row is inserted before the debit fails
+    assert backend.purchase("1", "P001", 5000, "2026-01-01T00:00:00") is None
+    assert reader.load_karma()["purchases"] == {}
+    assert karma_of(reader) == {"1": 100}
+
+
+def test_owned_item_is_not_charged_twice(tmp_path):
+    backend, reader = open_pair(tmp_path)
+    add_user(backend, "1", 1000)
+    assert backend.purchase("1", "P005", 500, "2026-01-01T00:00:00") == 500
+    assert backend.purchase("1", "P005", 500, "2026-01-02T00:00:00") is None
+    assert karma_of(reader) == {"1": 500}
+    assert reader.load_karma()["purchases"] == {"1": {"P005": "2026-01-01T00:00:00"}}
+
+
+def test_username_index_stays_valid_after_a_karma_only_flush(tmp_path):
+    store = KarmaStore(JsonBackend(str(tmp_path)))
+    store.load()
+    store.ensure_user("1", "Alice")
+    store.ensure_user("2", "bob")
+    store.flush()
+    store.add_karma("1", 5)
+    store.flush()
+    assert JsonBackend(str(tmp_path)).load_username_index() == {"alice": "1", "bob": "2"}
+
+    # Someone else rewriting karma.json invalidates it
+    with open(tmp_path / "karma.json", "a") as f:
+        f.write(" ")
+    assert JsonBackend(str(tmp_path)).load_username_index() is None
+
+
+def karma_document(karma):
+    return {"users": {"1": {"karma": karma, "username": "alice"}}, "purchases": {}}
+
+
+def test_failed_write_leaves_the_old_file_and_no_temp_files(tmp_path):
+    path = str(tmp_path / "karma.json")
+    atomic_write_json(path, karma_document(1))
+    with pytest.raises(TypeError):
+        # Not JSON serializable: fails halfway through writing
+        atomic_write_json(path, {"users": {"1": {"karma": object()}}})
+    with open(path) as f:
+        assert json.load(f) == karma_document(1)
+    assert os.listdir(tmp_path) == ["karma.json"]
+
+
+def test_backups_keep_the_previous_versions(tmp_path):
+    backend = JsonBackend(str(tmp_path), backups=2)
+    for karma in (1, 2, 3):
+        backend.save_karma(karma_document(karma))
+    for name, karma in (("karma.json", 3), ("karma.json.bak.1", 2), ("karma.json.bak.2", 1)):
+        with open(tmp_path / name) as f:
+            assert json.load(f)["users"]["1"]["karma"] == karma
+
+
+def test_corrupt_karma_file_is_refused_and_names_a_good_backup(tmp_path):
+    backend = JsonBackend(str(tmp_path), backups=1)
+    backend.save_karma(karma_document(1))
+    backend.save_karma(karma_document(2))
+    with open(tmp_path / "karma.json", "w") as f:
+        f.write('{"users": {"1": {"kar')
+    with pytest.raises(CorruptDataError) as error:
+        backend.load_karma()
+    assert error.value.backup == str(tmp_path / "karma.json.bak.1")
+    # The damaged file is left alone for the owner to look at
+    with open(tmp_path / "karma.json") as f:
+        assert f.read() == '{"users": {"1": {"kar'
+
+
+def test_filters_version_moves_only_on_filter_edits(tmp_path):
+    writer, reader = open_pair(tmp_path)
+    version = reader.filters_version()
+    add_user(writer, "1", 5)
+    writer.add_karma("1", 2)
+    assert reader.filters_version() == version
+
+    writer.add_filter("-100", "spam")
+    assert reader.filters_version() != version
+    version = reader.filters_version()
+    # Re-adding an existing word changes nothing
+    writer.add_filter("-100", "spam")
+    assert reader.filters_version() == version
+    writer.set_filter_settings("-100", {"whole_word": True})
+    assert reader.filters_version() != version
+    version = reader.filters_version()
+    writer.remove_filter("-100", "spam")
+    assert reader.filters_version() != version
+
+
+def test_migration_gives_every_purchase_owner_a_user_row(tmp_path):
+    source = JsonBackend(str(tmp_path))
+    source.save_karma({"users": {"1": {"karma": 5, "username": "alice"}},
+                       "purchases": {"1": {"P001": "2026-01-01T00:00:00"},
+                                     "2": {"P002": "2026-01-02T00:00:00"}}})
+    backend = SqliteBackend(str(tmp_path / "karma.db"))
+    backend.migrate_from(source)
+    assert backend.load_user("2") == ({"karma": 0, "username": None}, {"P002": "2026-01-02T00:00:00"})
+
+
+def test_shared_leaderboard_drops_users_without_a_row(tmp_path):
+    backend, other = open_pair(tmp_path)
+    add_user(backend, "1", 100)
+    add_user(backend, "2", 100)
+    store = KarmaStore(backend, rank_of=lambda pid: 1, shared=True)
+    store.load()
+    store.purchase("1", "P001", 10, "2026-01-01T00:00:00")
+    store.purchase("2", "P001", 10, "2026-01-01T00:00:00")
+
+    # Another worker records a purchase with no users row, and deletes one
+    other.conn.execute("INSERT INTO purchases (user_id, pid, purchased_at) VALUES ('3', 'P001', 'x')")
+    other.conn.execute("DELETE FROM users WHERE user_id = '2'")
+    store._poll_purchases()
+    assert "3" not in store.leaderboard.scores
+    assert store.get("2") is None
+    assert store.leaderboard.top(10) == [("1", 1)]
@@ -0,0 +1,104 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from urban import UrbanClient
+
+# UrbanClient against a local stand-in for the Urban Dictionary API. Each
+# test gets the server's handler state in `api`: how many requests it saw,
+# and optionally a delay or an HTTP status to answer with.
+
+
+def run(test, **api):
+    api.setdefault("delay", 0)
+    api.setdefault("status", 200)
+    api["hits"] = 0
+
+    async def define(request):
+        api["hits"] += 1
+        await asyncio.sleep(api["delay"])
+        if api["status"] != 200:
+            return web.Response(status=api["status"])
+        term = request.query["term"]
+        return web.json_response({"list": [{"word": term, "definition": f"{term}!"}]})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/v0/define", define)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            client = UrbanClient(session, str(server.make_url("/v0/define")),
+                                 timeout=api.pop("timeout", 5.0), cache_ttl=api.pop("ttl", 3600.0))
+            await test(client, api)
+
+    asyncio.run(main())
+
+
+def test_cache_hit_skips_the_api():
+    async def test(client, api):
+        first = await client.define("Yeet")
+        second = await client.define("  yeet ")
+        assert first == second == {"word": "yeet", "definition": "yeet!"}
+        assert api["hits"] == 1
+        assert client.cache.hits == 1
+
+    run(test)
+
+
+def test_expired_entry_is_fetched_again():
+    async def test(client, api):
+        await client.define("yeet")
+        await asyncio.sleep(0.06)
+        await client.define("yeet")
+        assert api["hits"] == 2
+
+    run(test, ttl=0.05)
+
+
+def test_concurrent_lookups_share_one_request():
+    async def test(client, api):
+        results = await asyncio.gather(*(client.define("yeet") for _ in range(10)))
+        assert all(result == results[0] for result in results)
+        assert api["hits"] == 1
+        assert client.requests == 1
+
+    run(test, delay=0.05)
+
+
+def test_timeout_reaches_every_waiter_and_is_not_cached():
+    async def test(client, api):
+        results = await asyncio.gather(*(client.define("yeet") for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+        assert api["hits"] == 1
+        assert len(client.cache) == 0
+        api["delay"] = 0
+        assert await client.define("yeet") is not None
+
+    run(test, delay=0.5, timeout=0.1)
+
+
+def test_http_error_is_raised_and_not_cached():
+    async def test(client, api):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await client.define("yeet")
+        api["status"] = 200
+        assert await client.define("yeet") is not None
+        assert api["hits"] == 2
+
+    run(test, status=500)
+
+
+def test_follower_takes_over_when_the_leader_is_cancelled():
+    async def test(client, api):
+        leader = asyncio.ensure_future(client.define("yeet"))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(client.define("yeet"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert (await follower)["word"] == "yeet"
+        assert leader.cancelled()
+        assert api["hits"] == 2
+
+    run(test, delay=0.05)
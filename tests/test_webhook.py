@@ -0,0 +1,146 @@
+import asyncio
+
+import aiohttp
+
+from webhook import SECRET_HEADER, WebhookServer
+
+# Replays recorded Telegram updates against a WebhookServer on a free local
+# port, with a stand-in Application that records what it is given
+
+SECRET = "s3cret"
+
+
+def message_update(update_id, chat_id=-1001, user_id=42, text="+1"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Test"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+class FakeApp:
+    def __init__(self, gate=None):
+        self.bot = None
+        self.updates = []
+        self.gate = gate
+
+    async def process_update(self, update):
+        if self.gate is not None:
+            await self.gate.wait()
+        self.updates.append(update.update_id)
+
+
+def run(test, app=None, **options):
+    async def main():
+        server = WebhookServer(app or FakeApp(), port=0, secret_token=SECRET, **options)
+        await server.start()
+        url = f"http://{server.host}:{server.port}{server.path}"
+        try:
+            async with aiohttp.ClientSession(headers={SECRET_HEADER: SECRET}) as session:
+                await test(server, session, url)
+        finally:
+            await server.stop()
+        return server
+
+    return asyncio.run(main())
+
+
+def test_valid_updates_are_processed():
+    app = FakeApp()
+
+    async def test(server, session, url):
+        for update_id in range(1, 4):
+            async with session.post(url, json=message_update(update_id)) as response:
+                assert response.status == 200
+
+    server = run(test, app)
+    assert sorted(app.updates) == [1, 2, 3]
+    assert server.stats["accepted"] == server.stats["processed"] == 3
+    assert server.stats["failed"] == 0
+
+
+def test_bad_secret_is_rejected():
+    app = FakeApp()
+
+    async def test(server, session, url):
+        async with session.post(url, json=message_update(1), headers={SECRET_HEADER: "wrong"}) as response:
+            assert response.status == 403
+
+    server = run(test, app)
+    assert app.updates == []
+    assert server.stats["rejected_unauthorized"] == 1
+    assert server.stats["processed"] == 0
+
+
+def test_malformed_updates_are_rejected():
+    app = FakeApp()
+
+    async def test(server, session, url):
+        for body in (b"{not json", b"null", b'"text"'):
+            async with session.post(url, data=body) as response:
+                assert response.status == 400
+
+    server = run(test, app)
+    assert app.updates == []
+    assert server.stats["rejected_invalid"] == 3
+
+
+def test_full_queue_answers_503_and_keeps_what_it_accepted():
+    app = FakeApp()
+
+    async def test(server, session, url):
+        app.gate = asyncio.Event()
+        statuses = []
+        for update_id in range(1, 5):
+            async with session.post(url, json=message_update(update_id)) as response:
+                statuses.append(response.status)
+            # Let the worker pick the first update up
+            await asyncio.sleep(0.01)
+        assert statuses == [200, 200, 503, 503]
+        app.gate.set()
+
+    # One update in progress plus one waiting fill it
+    server = run(test, app, queue_size=2, workers=1)
+    assert app.updates == [1, 2]
+    assert server.stats["rejected_full"] == 2
+    assert server.stats["processed"] == 2
+    assert server.stats["queue_high_water"] == 2
+
+
+def test_each_chat_is_processed_in_order_while_chats_run_concurrently():
+    app = FakeApp()
+    running = {}
+    overlapped = []
+
+    async def process_update(update):
+        chat_id = update.effective_chat.id
+        assert chat_id not in running, "two updates of one chat at once"
+        running[chat_id] = update.update_id
+        if len(running) > 1:
+            overlapped.append(update.update_id)
+        # Later updates finish faster, so a free-for-all would reorder them
+        await asyncio.sleep(0.02 / (update.update_id % 10 + 1))
+        del running[chat_id]
+        app.updates.append(update.update_id)
+
+    app.process_update = process_update
+
+    async def test(server, session, url):
+        for n in range(1, 6):
+            for chat_id in (-1001, -1002):
+                update_id = (1 if chat_id == -1001 else 2) * 100 + n
+                async with session.post(url, json=message_update(update_id, chat_id)) as response:
+                    assert response.status == 200
+        while server.depth:
+            await asyncio.sleep(0.01)
+
+    server = run(test, app, workers=8)
+    assert [u for u in app.updates if u < 200] == [101, 102, 103, 104, 105]
+    assert [u for u in app.updates if u > 200] == [201, 202, 203, 204, 205]
+    assert overlapped
+    assert server.stats["processed"] == 10
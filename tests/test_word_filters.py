@@ -0,0 +1,74 @@
+from storage import JsonBackend, SqliteBackend
+from word_filters import FilterCache, WordMatcher
+
+
+def test_whole_word_only_matches_at_word_boundaries():
+    loose = WordMatcher(["ass"])
+    strict = WordMatcher(["ass"], whole_word=True)
+    assert loose.search("first class") == "ass"
+    assert strict.search("first class") is None
+    assert strict.search("you ass!") == "ass"
+    # Case doesn't matter either way
+    assert strict.search("ASS") == "ass"
+
+
+def test_longest_overlapping_word_wins():
+    assert WordMatcher(["spam", "spammer"]).search("a SPAMMER here") == "spammer"
+    assert WordMatcher([""]).search("anything") is None
+    assert WordMatcher([]).search("anything") is None
+
+
+def test_casefold_matches_what_lower_cannot():
+    assert WordMatcher(["strasse"]).search("STRASSE") == "strasse"
+    assert WordMatcher(["strasse"]).search("Straße") is None
+    assert WordMatcher(["strasse"], casefold=True).search("Straße") == "strasse"
+    assert WordMatcher(["straße"], casefold=True, whole_word=True).search("die STRASSE.") == "strasse"
+
+
+def open_cache(backend):
+    # Never rechecks on its own, so only edits can notice outside changes
+    cache = FilterCache(backend, recheck_interval=3600)
+    cache.load()
+    return cache
+
+
+def test_own_edits_update_in_place(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "karma.db"))
+    backend.add_filter("-200", "ham")
+    cache = open_cache(backend)
+    other_chat = cache.matcher("-200")
+    cache.add("-100", "spam")
+    cache.set_settings("-100", {"whole_word": True, "casefold": False})
+    assert cache.words("-100") == ["spam"]
+    # Nothing was reloaded
+    assert cache.matcher("-200") is other_chat
+
+
+def test_edit_after_an_outside_edit_reloads_sqlite(tmp_path):
+    path = str(tmp_path / "karma.db")
+    cache = open_cache(SqliteBackend(path))
+    SqliteBackend(path).add_filter("-100", "spam")
+    cache.add("-100", "eggs")
+    assert cache.words("-100") == ["spam", "eggs"]
+
+
+def test_edit_after_an_outside_edit_reloads_json(tmp_path):
+    cache = open_cache(JsonBackend(str(tmp_path)))
+    JsonBackend(str(tmp_path)).add_filter("-100", "spam")
+    cache.add("-200", "eggs")
+    assert cache.words("-100") == ["spam"]
+
+
+def test_outside_edit_landing_during_ours_reloads(tmp_path):
+    path = str(tmp_path / "karma.db")
+    backend = SqliteBackend(path)
+    cache = open_cache(backend)
+    add_filter = backend.add_filter
+
+    def racing(chat_id, word):
+        SqliteBackend(path).add_filter("-300", "spam")
+        add_filter(chat_id, word)
+
+    backend.add_filter = racing
+    cache.add("-100", "eggs")
+    assert cache.words("-300") == ["spam"]
@@ -0,0 +1,41 @@
+import aiohttp
+
+from cache import SingleFlight, TTLCache
+
+URBAN_API_URL = 'https://api.urbandictionary.com/v0/define'
+
+
+class UrbanClient:
+    # Urban Dictionary lookups over the bot's shared aiohttp session, with
+    # a TTL+LRU cache keyed by the normalized term and concurrent lookups of
+    # the same term collapsed into one upstream request
+
+    def __init__(self, session, base_url=URBAN_API_URL, timeout=5.0, cache_size=512, cache_ttl=3600.0):
+        self.session = session
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.requests = 0
+        self._flights = SingleFlight()
+
+    @staticmethod
+    def normalize(term):
+        return " ".join(term.split()).casefold()
+
+    async def define(self, term):
+        # Top definition for term, or None if there isn't one. Raises
+        # aiohttp.ClientError / asyncio.TimeoutError when the API fails.
+        key = self.normalize(term)
+        if key in self.cache:
+            return self.cache.get(key)
+        return await self._flights.do(key, lambda: self._fetch(key))
+
+    async def _fetch(self, key):
+        self.requests += 1
+        async with self.session.get(self.base_url, params={"term": key}, timeout=self.timeout) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        definitions = data.get("list") or []
+        definition = definitions[0] if definitions else None
+        self.cache.set(key, definition)
+        return definition
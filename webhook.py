@@ -0,0 +1,151 @@
+import asyncio
+import hmac
+import json
+import time
+from collections import deque
+
+from aiohttp import web
+from telegram import Update
+
+# Webhook ingress for the Python bot: Telegram (or anything replaying its
+# JSON) POSTs updates to a local aiohttp endpoint, they are queued in a
+# bounded queue and a fixed pool of workers feeds them to the Application.
+# A full queue answers 503 so Telegram backs off and retries later instead
+# of the bot buffering without limit.
+#
+# Updates are queued per chat (per user for updates without a chat): a
+# worker takes a chat, processes its oldest update and puts the chat back
+# at the end of the line, so different chats run concurrently while one
+# chat's updates are handled one at a time in arrival order.
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    def __init__(self, app, host='127.0.0.1', port=8443, path='/telegram',
+                 secret_token=None, queue_size=1000, workers=8):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.queue_size = queue_size
+        # Updates queued or being processed, across all chats
+        self.depth = 0
+        # chat key -> its updates, oldest (possibly in progress) first
+        self._chats = {}
+        # Keys of chats with an update ready to go, each at most once
+        self._ready = asyncio.Queue()
+        self.stats = {
+            "received": 0,
+            "accepted": 0,
+            "processed": 0,
+            "failed": 0,
+            "rejected_unauthorized": 0,
+            "rejected_invalid": 0,
+            "rejected_full": 0,
+            "queue_high_water": 0,
+        }
+        self._runner = None
+        self._tasks = []
+
+    def metrics(self):
+        return {**self.stats, "queue_depth": self.depth, "queue_size": self.queue_size}
+
+    async def _handle_update(self, request):
+        self.stats["received"] += 1
+        if self.secret_token is not None:
+            given = request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(given, self.secret_token):
+                self.stats["rejected_unauthorized"] += 1
+                return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError("update is not a JSON object")
+            update = Update.de_json(data, self.app.bot)
+            if update is None:
+                raise ValueError("empty update")
+        except (json.JSONDecodeError, TypeError, KeyError, ValueError):
+            self.stats["rejected_invalid"] += 1
+            return web.Response(status=400)
+        if self.depth >= self.queue_size:
+            self.stats["rejected_full"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        self._enqueue(update)
+        self.stats["accepted"] += 1
+        self.stats["queue_high_water"] = max(self.stats["queue_high_water"], self.depth)
+        return web.Response()
+
+    @staticmethod
+    def _chat_key(update):
+        chat = update.effective_chat
+        if chat is not None:
+            return chat.id
+        user = update.effective_user
+        if user is not None:
+            return ("user", user.id)
+        # Nothing to keep in order with
+        return ("update", update.update_id)
+
+    def _enqueue(self, update):
+        self.depth += 1
+        key = self._chat_key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            self._chats[key] = deque((update,))
+            self._ready.put_nowait(key)
+        else:
+            # Goes out once the chat's earlier updates are done
+            pending.append(update)
+
+    async def _handle_health(self, request):
+        return web.json_response(self.metrics())
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            try:
+                await self.app.process_update(pending[0])
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"❌ Error processing webhook update: {e}")
+            finally:
+                pending.popleft()
+                self.depth -= 1
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+    async def start(self):
+        web_app = web.Application()
+        web_app.router.add_post(self.path, self._handle_update)
+        web_app.router.add_get('/healthz', self._handle_health)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            # Port 0 picks a free port; report the real one
+            self.port = self._runner.addresses[0][1]
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"🌐 Webhook listening on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self, drain_timeout=5.0):
+        # Stop accepting, give queued updates a chance to finish, then stop
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        deadline = time.monotonic() + drain_timeout
+        while self.depth and self._tasks and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth:
+            print(f"⚠️ Dropped {self.depth} queued updates at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,127 @@
+import re
+import time
+
+# Per-chat word filters. Each chat's list is compiled into a single regex so
+# a message is scanned once no matter how many words are filtered.
+
+DEFAULT_SETTINGS = {"whole_word": False, "casefold": False}
+
+
+class WordMatcher:
+    def __init__(self, words, whole_word=False, casefold=False):
+        self.words = tuple(words)
+        self.whole_word = whole_word
+        self.casefold = casefold
+        self._fold = str.casefold if casefold else str.lower
+        # Longest first so the alternation reports the longest overlapping word
+        alternatives = sorted({self._fold(w) for w in words if w}, key=len, reverse=True)
+        if not alternatives:
+            self._regex = None
+            return
+        pattern = "|".join(map(re.escape, alternatives))
+        if whole_word:
+            pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+        self._regex = re.compile(pattern)
+
+    def search(self, text):
+        # Returns the first filtered word found in text, or None
+        if self._regex is None:
+            return None
+        match = self._regex.search(self._fold(text))
+        return match.group(0) if match else None
+
+
+class FilterCache:
+    # All word filters held in memory, keyed by chat_id, so the message
+    # handler never touches storage. Chats without filters leave through a
+    # single dict lookup and are counted in `skipped`. Lists edited through
+    # this cache are updated in place; edits made by another process are
+    # picked up by checking the backend's filters_version() at most once
+    # every `recheck_interval` seconds.
+
+    def __init__(self, backend, recheck_interval=2.0):
+        self.backend = backend
+        self.recheck_interval = recheck_interval
+        self.skipped = 0
+        self.checked = 0
+        self._groups = {}
+        self._settings = {}
+        self._matchers = {}
+        self._version = None
+        self._checked_at = 0.0
+
+    def load(self):
+        data = self.backend.load_filters()
+        self._groups = {chat_id: list(words) for chat_id, words in data["groups"].items() if words}
+        self._settings = data.get("settings", {})
+        self._matchers.clear()
+        self._version = self.backend.filters_version()
+        self._checked_at = time.monotonic()
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.recheck_interval:
+            return
+        self._checked_at = now
+        if self.backend.filters_version() != self._version:
+            self.load()
+
+    def matcher(self, chat_id):
+        # The compiled matcher for a chat, or None if it filters nothing
+        self._maybe_reload()
+        words = self._groups.get(chat_id)
+        if not words:
+            self.skipped += 1
+            return None
+        self.checked += 1
+        matcher = self._matchers.get(chat_id)
+        if matcher is None:
+            settings = self.settings(chat_id)
+            matcher = self._matchers[chat_id] = WordMatcher(
+                words, settings["whole_word"], settings["casefold"]
+            )
+        return matcher
+
+    def words(self, chat_id):
+        self._maybe_reload()
+        return list(self._groups.get(chat_id, []))
+
+    def settings(self, chat_id):
+        return {**DEFAULT_SETTINGS, **self._settings.get(chat_id, {})}
+
+    # Edits write through to storage and update the cache in place
+    def add(self, chat_id, word):
+        before = self.backend.filters_version()
+        self.backend.add_filter(chat_id, word)
+        words = self._groups.setdefault(chat_id, [])
+        if word not in words:
+            words.append(word)
+        self._changed(chat_id, before)
+
+    def remove(self, chat_id, word):
+        before = self.backend.filters_version()
+        self.backend.remove_filter(chat_id, word)
+        words = self._groups.get(chat_id, [])
+        if word in words:
+            words.remove(word)
+        if not words:
+            self._groups.pop(chat_id, None)
+        self._changed(chat_id, before)
+
+    def set_settings(self, chat_id, settings):
+        before = self.backend.filters_version()
+        self.backend.set_filter_settings(chat_id, settings)
+        self._settings[chat_id] = settings
+        self._changed(chat_id, before)
+
+    def _changed(self, chat_id, before):
+        # `before` is the version just ahead of our edit. If another process
+        # edited filters since we last looked, or in between (SQLite's counter
+        # moved by more than our own bump; JSON stamps can only be compared),
+        # the in-place update isn't the whole story: reload everything
+        version = self.backend.filters_version()
+        if before != self._version or (isinstance(version, int) and version - before > 1):
+            self.load()
+            return
+        self._matchers.pop(chat_id, None)
+        self._version = version